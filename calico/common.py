@@ -175,14 +175,16 @@ def complete_logging(logfile=None,
     logging is available as early in execution as possible, i.e. before the
     config file has been parsed.
 
-    This function must only be called once, after
+    This function must be called after
     :meth:`default_logging() <calico.common.default_logging>`
-    has been called.
+    has been called.  It may be called again to apply a change to the
+    configuration.
     """
     root_logger = logging.getLogger()
 
     # If default_logging got called already, we'll have some loggers in place.
-    # Update their levels.
+    # Update their levels.  Note: file handlers are StreamHandlers too, so we
+    # check for them first.
     file_handler = None
     for handler in root_logger.handlers[:]:
         if isinstance(handler, logging.handlers.SysLogHandler):
@@ -190,17 +192,20 @@ def complete_logging(logfile=None,
                 root_logger.removeHandler(handler)
             else:
                 handler.setLevel(syslog_level)
+        elif isinstance(handler, logging.handlers.TimedRotatingFileHandler):
+            if (file_level is None or not logfile or
+                    handler.baseFilename != os.path.abspath(logfile)):
+                # Logging to file disabled or moved to a different file.
+                root_logger.removeHandler(handler)
+                handler.close()
+            else:
+                file_handler = handler
+                handler.setLevel(file_level)
         elif isinstance(handler, logging.StreamHandler):
             if stream_level is None:
                 root_logger.removeHandler(handler)
             else:
                 handler.setLevel(stream_level)
-        elif isinstance(handler, logging.handlers.TimedRotatingFileHandler):
-            file_handler = handler
-            if file_level is None:
-                root_logger.removeHandler(handler)
-            else:
-                handler.setLevel(file_level)
 
     # If we've been given a log file, log to file as well.
     if logfile and file_level is not None:
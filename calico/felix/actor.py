@@ -87,6 +87,16 @@ some gotchas:
   can block on a full queue and the receiving actor may be blocked on the
   queue of the sender, trying to send another message.
 
+Tracking work
+~~~~~~~~~~~~~
+
+To find out when all the work that was triggered by some event has
+been done, a WorkTracker can be made active while sending the
+messages for the event.  The messages carry the WorkTracker, as do
+any messages that are sent while they are processed, and so on.  Once
+all of those messages have been processed, and their batches finished,
+the WorkTracker's callback is called.
+
 Unhandled Exceptions
 ~~~~~~~~~~~~~~~~~~~~
 
@@ -225,6 +235,10 @@ class Actor(object):
             # Give subclass a chance to filter the batch/update its state.
             batch = self._start_msg_batch(batch)
             assert batch is not None, "_start_msg_batch() should return batch."
+            # Any messages that we send while processing the batch are part
+            # of the work of the messages in the batch.
+            actor_storage.work_trackers = frozenset().union(
+                *[msg.work_trackers for msg in batch])
             results = []  # Will end up same length as batch.
             for msg in batch:
                 _log.debug("Message %s recd by %s from %s, queue length %d",
@@ -259,6 +273,8 @@ class Actor(object):
                 # Most-likely a bug.  Report failure to all callers.
                 _log.exception("_finish_msg_batch failed.")
                 results = [(None, e)] * len(results)
+            finally:
+                actor_storage.work_trackers = frozenset()
 
             # Batch complete and finalized, set all the results.
             assert len(batch) == len(results)
@@ -268,6 +284,7 @@ class Actor(object):
                         future.set_exception(exc)
                     else:
                         future.set(result)
+                msg.release_work()
         if num_splits > 0:
             _log.warn("Split batches complete. Number of splits: %s",
                       num_splits)
@@ -342,6 +359,15 @@ class Actor(object):
         """
         pass
 
+    def _discard_queued_messages(self):
+        """
+        Discards the messages on the queue of an actor that is being
+        thrown away without being started, releasing any work that they
+        were tracking.
+        """
+        while not self._event_queue.empty():
+            self._event_queue.get_nowait().release_work()
+
     def _maybe_yield(self):
         """
         With some probability, yields processing to another greenlet.
@@ -375,6 +401,59 @@ def wait_and_check(async_results):
         r.get()
 
 
+class WorkTracker(object):
+    """
+    Tracks a tree of work through the actors, see the module docstring.
+
+    Use as a context manager: messages that are sent inside the with
+    block are tracked.
+    """
+    def __init__(self, name, callback):
+        """
+        :param str name: name of the work, for logging.
+        :param callback: called, with no arguments, once all the work has
+            been done.  It is called from whichever greenlet finished the
+            work so it should typically send a message.
+        """
+        self.name = name
+        self.callback = callback
+        self._pending = 0
+        self._saved_trackers = None
+
+    def incref(self):
+        self._pending += 1
+
+    def decref(self):
+        self._pending -= 1
+        assert self._pending >= 0, ("Work tracker %s released too many "
+                                    "times" % self.name)
+        if self._pending == 0:
+            _log.debug("All work for %s is done", self.name)
+            self.callback()
+
+    def __enter__(self):
+        self.incref()
+        self._saved_trackers = _active_work_trackers()
+        actor_storage.work_trackers = self._saved_trackers | set([self])
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        actor_storage.work_trackers = self._saved_trackers
+        self._saved_trackers = None
+        self.decref()
+
+    def __str__(self):
+        return "WorkTracker(%s, pending=%s)" % (self.name, self._pending)
+
+
+def _active_work_trackers():
+    """
+    :returns frozenset[WorkTracker]: the work trackers that messages sent
+        from the current greenlet should carry.
+    """
+    return getattr(actor_storage, "work_trackers", frozenset())
+
+
 _refs = {}
 _ref_idx = 0
 
@@ -392,6 +471,19 @@ class Message(object):
         self.name = method.func.__name__
         self.needs_own_batch = needs_own_batch
         self.recipient = recipient
+        self.work_trackers = _active_work_trackers()
+        for tracker in self.work_trackers:
+            tracker.incref()
+
+    def release_work(self):
+        """
+        Called once the message has been processed, releases the work
+        trackers that it carries.  Idempotent.
+        """
+        work_trackers = self.work_trackers
+        self.work_trackers = frozenset()
+        for tracker in work_trackers:
+            tracker.decref()
 
     def __str__(self):
         data = ("%s (%s)" % (self.uuid, self.name))
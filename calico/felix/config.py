@@ -46,6 +46,21 @@ LOGLEVELS = {"none":      None,
              "crit":      logging.CRITICAL,
              "critical":  logging.CRITICAL}
 
+# Config parameters that can't be changed while Felix is running, because
+# they are baked into the chains, ipsets and actors that Felix has already
+# created.  Felix restarts if any of these change.  The rest are picked up
+# live.
+RESTART_REQUIRED = frozenset([
+    "IFACE_PREFIX",
+    "DATAPLANE_DRIVER",
+    "SHARE_PROFILE_CHAINS",
+    "SHARE_TO_CHAINS",
+    "RULE_REORDER_INT_SEC",
+    "ROUTE_REFRESH_INT_SEC",
+    "CONNTRACK_FAST_PATH",
+    "ANTI_SPOOF_IPSET_THRESHOLD",
+])
+
 
 class ConfigException(Exception):
     def __init__(self, message, source):
@@ -94,6 +109,13 @@ class Config(object):
         self.METADATA_IP = "127.0.0.1"
         self.METADATA_PORT = "8775"
         self.RESYNC_INT_SEC = 1800
+        self.ROUTE_REFRESH_INT_SEC = 60
+        self.SHARE_PROFILE_CHAINS = False
+        self.SHARE_TO_CHAINS = False
+        self.RULE_REORDER_INT_SEC = 0
+        self.CONNTRACK_FAST_PATH = False
+        self.ANTI_SPOOF_IPSET_THRESHOLD = 0
+        self.DATAPLANE_DRIVER = "iptables"
         self.IFACE_PREFIX = None
         self.LOGFILE = "/var/log/calico/felix.log"
         self.LOGLEVFILE = "INFO"
@@ -105,11 +127,46 @@ class Config(object):
         self.LOGLEVSCR = LOGLEVELS.get(self.LOGLEVSCR.lower(), logging.DEBUG)
 
     def update_config(self, cfg_dict):
+        """
+        Updates the config from the parameters loaded from etcd.  May be
+        called again, with the full set of parameters, when the config in
+        etcd changes.  If the new config is invalid, the existing config is
+        left unchanged.
+
+        :returns set[str]: the names of the config attributes that changed.
+        :raises ConfigException: if the config is invalid.
+        """
+        old_values = self._values()
+        try:
+            self._update_config(cfg_dict)
+        except Exception:
+            self.__dict__.update(old_values)
+            raise
+        new_values = self._values()
+        return set(name for name, value in new_values.iteritems()
+                   if old_values.get(name) != value)
+
+    def _values(self):
+        return dict((name, value) for name, value in self.__dict__.iteritems()
+                    if name.isupper())
+
+    def _update_config(self, cfg_dict):
         self.STARTUP_CLEANUP_DELAY = int(cfg_dict.pop("StartupCleanupDelay",
                                                       "30"))
         self.METADATA_IP = cfg_dict.pop("MetadataAddr", "127.0.0.1")
         self.METADATA_PORT = cfg_dict.pop("MetadataPort", "8775")
         self.RESYNC_INT_SEC = int(cfg_dict.pop("ResyncIntervalSecs", "1800"))
+        self.ROUTE_REFRESH_INT_SEC = int(
+            cfg_dict.pop("RouteRefreshIntervalSecs", "60"))
+        self.SHARE_PROFILE_CHAINS = cfg_dict.pop("ShareProfileChains",
+                                                 "false")
+        self.SHARE_TO_CHAINS = cfg_dict.pop("ShareProfileToChains", "false")
+        self.RULE_REORDER_INT_SEC = int(
+            cfg_dict.pop("RuleReorderIntervalSecs", "0"))
+        self.CONNTRACK_FAST_PATH = cfg_dict.pop("ConntrackFastPath", "false")
+        self.ANTI_SPOOF_IPSET_THRESHOLD = int(
+            cfg_dict.pop("AntiSpoofIpsetThreshold", "0"))
+        self.DATAPLANE_DRIVER = cfg_dict.pop("DataplaneDriver", "iptables")
         self.IFACE_PREFIX = cfg_dict.pop("InterfacePrefix", None)
         self.LOGFILE = cfg_dict.pop("LogFilePath", "/var/log/calico/felix.log")
         self.LOGLEVFILE = cfg_dict.pop("LogSeverityFile", "INFO")
@@ -183,6 +240,18 @@ class Config(object):
                                       "etcd:/calico/config/MetadataPort")
 
 
+        self.SHARE_PROFILE_CHAINS = self.validate_bool(
+            "ShareProfileChains", self.SHARE_PROFILE_CHAINS)
+        self.SHARE_TO_CHAINS = self.validate_bool(
+            "ShareProfileToChains", self.SHARE_TO_CHAINS)
+        self.CONNTRACK_FAST_PATH = self.validate_bool(
+            "ConntrackFastPath", self.CONNTRACK_FAST_PATH)
+
+        if self.DATAPLANE_DRIVER not in ("iptables", "nftables"):
+            raise ConfigException("Invalid DataplaneDriver value : %s" %
+                                  self.DATAPLANE_DRIVER,
+                                  "etcd:/calico/config/DataplaneDriver")
+
         if self.IFACE_PREFIX is None:
             raise ConfigException("Missing InterfacePrefix value",
                                   "etcd:/calico/config/InterfacePrefix")
@@ -206,6 +275,16 @@ class Config(object):
                         lKey, cfg_dict[lKey])
 
 
+    def validate_bool(self, name, value):
+        """
+        Validate a boolean value, which must be "true" or "false" (in any
+        case), returning it as a bool.
+        """
+        if value.lower() not in ("true", "false"):
+            raise ConfigException("Invalid %s value : %s" % (name, value),
+                                  "etcd:/calico/config/%s" % name)
+        return value.lower() == "true"
+
     def validate_addr(self, name, addr):
         """
         Validate an address, returning the IP address it resolves to. If the
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Metaswitch Networks
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+felix.convergence
+~~~~~~~~~~~~~~~~~
+
+Tracks how far through the etcd event stream the dataplane has got.
+
+The EtcdWatcher wraps the work that it kicks off for each batch of etcd
+indexes in a WorkTracker from track_indexes().  The tracker follows the
+messages through the splitter and the managers to the IptablesUpdaters
+and ipsets, which only finish processing them once their changes have
+been committed.  The EtcdWatcher also reports, for each of the subtrees
+that it polls independently, the etcd index that it has read that
+stream through.  Streams that are idle don't report anything, so, while
+someone is waiting for an index, the EtcdWatcher asks for the lagging
+streams with wait_for_lagging_streams() and checks them directly.  The
+ConvergenceTracker then maintains
+
+* the dataplane-applied-through index: the highest etcd index such that
+  every stream has been read through it and the changes for that index,
+  and all earlier ones, are live in the dataplane;
+* a histogram, per kind of update, of the time from receiving the update
+  from etcd to it being live.
+"""
+import collections
+import heapq
+import logging
+import time
+
+from gevent.event import Event
+
+from calico.felix.actor import Actor, actor_message, WorkTracker
+
+_log = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets.  Latencies
+# above the last bound go in an extra, overflow, bucket.
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Number of applied updates between logs of the histograms.
+STATS_LOG_INTERVAL = 1000
+
+
+class ConvergenceTracker(Actor):
+    def __init__(self):
+        super(ConvergenceTracker, self).__init__()
+        # Number of outstanding trackers by etcd index.
+        self._pending = collections.defaultdict(int)
+        self._highest_started_index = None
+        # etcd index that each stream has been read through, if the
+        # EtcdWatcher reports them.
+        self._confirmed_by_stream = {}
+        self._snapshot_applied = False
+        self.applied_through_index = None
+        # Heap of (etcd index, Event) for callers of wait_for_index().
+        self._waiters = []
+        # Set while _waiters is non-empty.
+        self._waiters_present = Event()
+        self.latency_histograms = collections.defaultdict(
+            lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self._applied_since_log = 0
+
+    def track_indexes(self, etcd_indexes, kind, start_time=None):
+        """
+        Creates a WorkTracker for the work triggered by the etcd updates
+        with the given indexes.  Used as a context manager by the
+        EtcdWatcher, around its calls to the UpdateSplitter.
+
+        Unlike the actor_message methods, this may be called from another
+        greenlet; it only sends messages.
+
+        :param list[int] etcd_indexes: modifiedIndexes of the updates or the
+            etcd_index of the snapshot.
+        :param str kind: kind of update, selects the latency histogram.
+        :param float start_time: time that we received the updates, defaults
+            to now.
+        """
+        if start_time is None:
+            start_time = time.time()
+        self.on_indexes_started(etcd_indexes, async=True)
+
+        def on_work_done():
+            self.on_indexes_applied(etcd_indexes, kind,
+                                    time.time() - start_time, async=True)
+        return WorkTracker("etcd indexes %s-%s" % (etcd_indexes[0],
+                                                  etcd_indexes[-1]),
+                           on_work_done)
+
+    def wait_for_index(self, etcd_index, timeout=None):
+        """
+        Blocks the calling greenlet until the given etcd index has been
+        applied to the dataplane.  May be called from any greenlet.
+
+        :returns: True if the index was applied, False if we timed out.
+        """
+        event = self._get_index_event(etcd_index, async=False)
+        applied = event.wait(timeout)
+        if not applied:
+            self._discard_waiter(etcd_index, event, async=True)
+        return applied
+
+    def wait_for_lagging_streams(self):
+        """
+        Blocks the calling greenlet until someone is waiting for an etcd
+        index.  May be called from any greenlet.
+
+        :returns dict[str,int]: map from stream name to the etcd index
+            that it has been read through, for the streams that haven't
+            been read through the lowest index that is being waited for.
+            Empty if all the streams have, and we're only waiting for the
+            dataplane.
+        """
+        self._waiters_present.wait()
+        return self._get_lagging_streams(async=False)
+
+    @actor_message()
+    def on_indexes_started(self, etcd_indexes):
+        for etcd_index in etcd_indexes:
+            self._pending[etcd_index] += 1
+        self._highest_started_index = max(self._highest_started_index,
+                                          max(etcd_indexes))
+
+    @actor_message()
+    def on_streams_confirmed(self, indexes_by_stream):
+        """
+        Records that the given streams have been read through the given
+        etcd indexes: there are no more updates for them up to and
+        including those indexes.  Any updates up to those indexes must
+        already have been passed to track_indexes().
+
+        :param dict[str,int] indexes_by_stream: map from stream name to
+            etcd index.
+        """
+        for stream, etcd_index in indexes_by_stream.iteritems():
+            self._confirmed_by_stream[stream] = max(
+                self._confirmed_by_stream.get(stream), etcd_index)
+        self._update_applied_through_index()
+
+    @actor_message()
+    def on_indexes_applied(self, etcd_indexes, kind, latency):
+        _log.debug("etcd indexes %s (%s) applied after %.3fs", etcd_indexes,
+                   kind, latency)
+        for etcd_index in etcd_indexes:
+            self._pending[etcd_index] -= 1
+            if self._pending[etcd_index] <= 0:
+                del self._pending[etcd_index]
+        if kind == "snapshot":
+            _log.info("Snapshot at etcd index %s applied after %.2fs",
+                      etcd_indexes[0], latency)
+            self._snapshot_applied = True
+
+        # Every update in a batch counts towards the histogram.
+        histogram = self.latency_histograms[kind]
+        for ii, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                histogram[ii] += len(etcd_indexes)
+                break
+        else:
+            histogram[-1] += len(etcd_indexes)
+        self._applied_since_log += len(etcd_indexes)
+        if self._applied_since_log >= STATS_LOG_INTERVAL:
+            self._log_stats()
+
+        self._update_applied_through_index()
+
+    @actor_message()
+    def get_stats(self):
+        """
+        :returns dict: the applied-through index and a copy of the
+            latency histograms, as lists of (upper bound, count); the
+            bound of the overflow bucket is None.
+        """
+        bounds = LATENCY_BUCKETS + [None]
+        return {
+            "applied_through_index": self.applied_through_index,
+            "latency_histograms": dict(
+                (kind, zip(bounds, counts)) for kind, counts in
+                self.latency_histograms.iteritems()
+            ),
+        }
+
+    @actor_message()
+    def _get_index_event(self, etcd_index):
+        event = Event()
+        if (self.applied_through_index is not None and
+                etcd_index <= self.applied_through_index):
+            event.set()
+        else:
+            heapq.heappush(self._waiters, (etcd_index, event))
+            self._waiters_present.set()
+        return event
+
+    @actor_message()
+    def _discard_waiter(self, etcd_index, event):
+        try:
+            self._waiters.remove((etcd_index, event))
+        except ValueError:
+            # Applied after the caller timed out.
+            return
+        heapq.heapify(self._waiters)
+        if not self._waiters:
+            self._waiters_present.clear()
+
+    @actor_message()
+    def _get_lagging_streams(self):
+        if not self._waiters:
+            return {}
+        lowest_waiter = self._waiters[0][0]
+        return dict((stream, etcd_index) for stream, etcd_index in
+                    self._confirmed_by_stream.iteritems()
+                    if etcd_index < lowest_waiter)
+
+    def _update_applied_through_index(self):
+        if not self._snapshot_applied:
+            # Until the first snapshot has been applied, earlier indexes
+            # may not be live yet.
+            return
+        if self._confirmed_by_stream:
+            # The streams are polled independently, a later index on one
+            # stream doesn't mean that we've seen the earlier ones on
+            # another.
+            applied_through = min(self._confirmed_by_stream.values())
+        else:
+            applied_through = self._highest_started_index
+        if self._pending:
+            # Updates complete out of order, we can only claim to be up to
+            # date as far as the oldest update that is still in flight.
+            applied_through = min(applied_through, min(self._pending) - 1)
+        if applied_through != self.applied_through_index:
+            _log.debug("Dataplane now applied through etcd index %s",
+                       applied_through)
+            self.applied_through_index = applied_through
+        while self._waiters and self._waiters[0][0] <= applied_through:
+            _, event = heapq.heappop(self._waiters)
+            event.set()
+        if not self._waiters:
+            self._waiters_present.clear()
+
+    def _log_stats(self):
+        self._applied_since_log = 0
+        for kind, counts in sorted(self.latency_histograms.iteritems()):
+            _log.info("etcd to dataplane latency for %s updates: %s", kind,
+                      ", ".join("<=%ss: %s" % (b, c) for b, c in
+                                zip(LATENCY_BUCKETS, counts)) +
+                      ", >%ss: %s" % (LATENCY_BUCKETS[-1], counts[-1]))
+        _log.info("Dataplane applied through etcd index %s",
+                  self.applied_through_index)
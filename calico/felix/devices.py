@@ -20,21 +20,25 @@ Utility functions for managing devices in Felix.
 """
 import logging
 import collections
+import errno
 from calico.felix.actor import Actor, actor_message
 import gevent
 from gevent import subprocess
 import os
 import socket
-import struct
 
 from calico import common
-from calico.felix import futils
+from calico.felix import fnetlink, futils
 
 # Logger
 import re
 
 _log = logging.getLogger(__name__)
 
+# Key used to record the IPv6 proxy target in the SysctlCache alongside the
+# real sysctls.
+PROXY_TARGET_KEY = "ipv6-proxy-target"
+
 
 def interface_exists(interface):
     """
@@ -85,7 +89,7 @@ def list_interface_ips(ip_type, interface):
     return ips
 
 
-def configure_interface_ipv4(if_name):
+def configure_interface_ipv4(if_name, sysctl_cache=None):
     """
     Configure the various proc file system parameters for the interface for
     IPv4.
@@ -94,19 +98,19 @@ def configure_interface_ipv4(if_name):
     localhost, and enable proxy ARP.
 
     :param if_name: The name of the interface to configure.
+    :param SysctlCache sysctl_cache: if supplied, settings that have already
+    been applied to the interface are not rewritten.
     :returns: None
     """
-    with open('/proc/sys/net/ipv4/conf/%s/route_localnet' % if_name, 'wb') as f:
-        f.write('1')
-
-    with open("/proc/sys/net/ipv4/conf/%s/proxy_arp" % if_name, 'wb') as f:
-        f.write('1')
+    _write_sysctls(if_name, [
+        ('/proc/sys/net/ipv4/conf/%s/route_localnet' % if_name, '1'),
+        ("/proc/sys/net/ipv4/conf/%s/proxy_arp" % if_name, '1'),
+        ("/proc/sys/net/ipv4/neigh/%s/proxy_delay" % if_name, '0'),
+    ], sysctl_cache)
 
-    with open("/proc/sys/net/ipv4/neigh/%s/proxy_delay" % if_name, 'wb') as f:
-        f.write('0')
 
-
-def configure_interface_ipv6(if_name, proxy_target):
+def configure_interface_ipv6(if_name, proxy_target, nl_batch=None,
+                             sysctl_cache=None):
     """
     Configure an interface to support IPv6 traffic from an endpoint.
       - Enable proxy NDP on the interface.
@@ -115,16 +119,108 @@ def configure_interface_ipv6(if_name, proxy_target):
     :param if_name: The name of the interface to configure.
     :param proxy_target: IPv6 address which is proxied on this interface for
     NDP.
+    :param NetlinkBatch nl_batch: if supplied, the proxy entry is queued on
+    this batch (for the caller to execute) instead of forking "ip".
+    :param SysctlCache sysctl_cache: if supplied, the sysctl and proxy target
+    are skipped if they have already been applied to the interface.
     :returns: None
     :raises: FailedSystemCall
     """
-    with open("/proc/sys/net/ipv6/conf/%s/proxy_ndp" % if_name, 'wb') as f:
-        f.write('1')
+    _write_sysctls(if_name, [
+        ("/proc/sys/net/ipv6/conf/%s/proxy_ndp" % if_name, '1'),
+    ], sysctl_cache)
 
     # Allows None if no IPv6 proxy target is required.
     if proxy_target:
-        futils.check_call(["ip", "-6", "neigh", "add",
-                           "proxy", str(proxy_target), "dev", if_name])
+        proxy_setting = [(PROXY_TARGET_KEY, str(proxy_target))]
+        if sysctl_cache is not None:
+            proxy_setting = sysctl_cache.unapplied(if_name, proxy_setting)
+            if not proxy_setting:
+                _log.debug("Proxy target already programmed on %s", if_name)
+                return
+        if nl_batch is not None:
+            nl_batch.add_proxy_neighbour(futils.IPV6, str(proxy_target),
+                                         if_name)
+        else:
+            futils.check_call(["ip", "-6", "neigh", "add",
+                               "proxy", str(proxy_target), "dev", if_name])
+        if sysctl_cache is not None:
+            # If the batch later fails, the caller invalidates the cache.
+            sysctl_cache.record(if_name, proxy_setting)
+
+
+def _write_sysctls(if_name, settings, sysctl_cache):
+    """
+    Writes the given /proc/sys settings for an interface, skipping any that
+    the cache says have already been applied.
+
+    :param list[tuple[str,str]] settings: list of (path, value) pairs.
+    """
+    if sysctl_cache is not None:
+        settings = sysctl_cache.unapplied(if_name, settings)
+        if not settings:
+            _log.debug("Sysctls for %s already applied", if_name)
+            return
+    for path, value in settings:
+        with open(path, 'wb') as f:
+            f.write(value)
+    if sysctl_cache is not None:
+        sysctl_cache.record(if_name, settings)
+
+
+class SysctlCache(object):
+    """
+    Remembers the per-interface sysctls (and the IPv6 proxy target) that we
+    have applied, so that reconfiguring an interface only writes what has
+    changed.
+
+    Entries for an interface are discarded when the interface is deleted or
+    recreated with a new index (see on_link_update()), or explicitly by
+    invalidate(), for example after a failure.
+    """
+    def __init__(self):
+        # Maps interface name to dict mapping setting to applied value.
+        self._applied = {}
+        # Maps interface name to its index at the time we first configured
+        # it.
+        self._ifindexes = {}
+
+    def unapplied(self, if_name, settings):
+        """
+        :param list[tuple[str,str]] settings: list of (key, value) pairs.
+        :returns: the subset of settings that have not been applied.
+        """
+        applied = self._applied.get(if_name, {})
+        return [(k, v) for (k, v) in settings if applied.get(k) != v]
+
+    def record(self, if_name, settings):
+        """
+        Records that the given settings have been applied.
+        """
+        if if_name not in self._applied:
+            try:
+                self._ifindexes[if_name] = fnetlink.interface_index(if_name)
+            except IOError:
+                # Interface has gone already; nothing to remember.
+                _log.debug("Interface %s gone, not caching sysctls", if_name)
+                return
+            self._applied[if_name] = {}
+        self._applied[if_name].update(settings)
+
+    def invalidate(self, if_name):
+        """
+        Forgets everything that we've applied to the interface.
+        """
+        if self._applied.pop(if_name, None) is not None:
+            _log.debug("Discarding cached sysctls for %s", if_name)
+        self._ifindexes.pop(if_name, None)
+
+    def on_link_update(self, if_name, ifindex, deleted):
+        """
+        Called by the InterfaceWatcher for each link message.
+        """
+        if deleted or self._ifindexes.get(if_name, ifindex) != ifindex:
+            self.invalidate(if_name)
 
 
 def add_route(ip_type, ip, interface, mac):
@@ -167,7 +263,8 @@ def del_route(ip_type, ip, interface):
         futils.check_call(["ip", "-6", "route", "del", ip, "dev", interface])
 
 
-def set_routes(ip_type, ips, interface, mac=None):
+def set_routes(ip_type, ips, interface, mac=None, nl_batch=None,
+               route_table=None):
     """
     Set the routes on the interface to be the specified set.
 
@@ -175,15 +272,37 @@ def set_routes(ip_type, ips, interface, mac=None):
     :param set ips: IPs to set up (any not in the set are removed)
     :param str interface: Interface name
     :param str mac|NoneType: MAC address. May not be none unless ips is empty.
+    :param NetlinkBatch nl_batch: if supplied, the route and ARP changes are
+    queued on this batch (for the caller to execute) instead of forking
+    "ip" and "arp" for each one.
+    :param RouteTable route_table: if supplied, the current routes are taken
+    from this cache instead of being listed with "ip route".
     """
     if mac is None and ips:
         raise ValueError("mac must be supplied if ips is not empty")
 
-    current_ips = list_interface_ips(ip_type, interface)
-    for ip in (current_ips - ips):
-        del_route(ip_type, ip, interface)
-    for ip in (ips - current_ips):
-        add_route(ip_type, ip, interface, mac)
+    if route_table is not None:
+        ips_to_remove, ips_to_add = route_table.diff(ip_type, interface, ips)
+    else:
+        current_ips = list_interface_ips(ip_type, interface)
+        ips_to_remove = current_ips - ips
+        ips_to_add = ips - current_ips
+
+    if nl_batch is None:
+        for ip in ips_to_remove:
+            del_route(ip_type, ip, interface)
+        for ip in ips_to_add:
+            add_route(ip_type, ip, interface, mac)
+        return
+
+    for ip in ips_to_remove:
+        if ip_type == futils.IPV4:
+            nl_batch.del_neighbour(ip_type, ip, interface)
+        nl_batch.del_route(ip_type, ip, interface)
+    for ip in ips_to_add:
+        if ip_type == futils.IPV4:
+            nl_batch.add_neighbour(ip_type, ip, mac, interface)
+        nl_batch.add_route(ip_type, ip, interface)
 
 
 def interface_up(if_name):
@@ -218,6 +337,10 @@ def interface_up(if_name):
 # the kernel can never change them, so live with it for now.
 RTMGRP_LINK = 1
 
+# Not exposed by the socket module.  Like SO_RCVBUF but, as root, we can
+# exceed net.core.rmem_max.
+SO_RCVBUFFORCE = 33
+
 NLMSG_NOOP = 1
 NLMSG_ERROR = 2
 
@@ -226,6 +349,11 @@ RTM_DELLINK = 17
 
 IFLA_IFNAME = 3
 
+# Size of the netlink socket's receive buffer.  When we listen for route
+# notifications, we get one for every route that BIRD programs for a
+# remote workload, and they can arrive in large bursts.
+NETLINK_RCVBUF_SIZE = 4 * 1024 * 1024
+
 class RTNetlinkError(Exception):
     """
     How we report an error message.
@@ -233,11 +361,42 @@ class RTNetlinkError(Exception):
     pass
 
 class InterfaceWatcher(Actor):
-    def __init__(self, update_splitter):
+    def __init__(self, update_splitter, route_programmer=None,
+                 sysctl_cache=None):
+        """
+        :param NetlinkRouteProgrammer route_programmer: if supplied, the
+            watcher also listens for route changes and uses them to keep the
+            programmer's route table up to date.
+        :param SysctlCache sysctl_cache: if supplied, the watcher tells it
+            about interfaces being deleted and recreated.
+        """
         super(InterfaceWatcher, self).__init__()
         self.update_splitter = update_splitter
+        self.route_programmer = route_programmer
+        self.route_table = None
+        if route_programmer is not None:
+            self.route_table = route_programmer.route_table
+        self.sysctl_cache = sysctl_cache
         self.interfaces = {}
 
+        # Create the netlink socket and bind to RTMGRP_LINK (and the route
+        # groups, if required).  We do this up front so that any changes
+        # made after a dump of the route table are queued for us.  We bind
+        # to port 0 to let the kernel choose a free port.
+        groups = RTMGRP_LINK
+        if route_programmer is not None:
+            groups |= fnetlink.RTMGRP_IPV4_ROUTE | fnetlink.RTMGRP_IPV6_ROUTE
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                   socket.NETLINK_ROUTE)
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE,
+                                  NETLINK_RCVBUF_SIZE)
+        except socket.error:
+            # Not running as root; we get as much as rmem_max allows.
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                  NETLINK_RCVBUF_SIZE)
+        self._sock.bind((0, groups))
+
     @actor_message()
     def watch_interfaces(self):
         """
@@ -246,63 +405,73 @@ class InterfaceWatcher(Actor):
 
         :returns: Never returns.
         """
-        # Create the netlink socket and bind to RTMGRP_LINK,
-        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
-        s.bind((os.getpid(), RTMGRP_LINK))
-
         while True:
-            # Get the next set of data.
-            data = s.recv(65535)
-
-            # First 16 bytes is the message header; unpack it.
-            hdr = data[:16]
-            data = data[16:]
-            msg_len, msg_type, flags, seq, pid = struct.unpack("=LHHLL", hdr)
-
-            if msg_type == NLMSG_NOOP:
-                # Noop - get some more data.
+            # Get the next set of data; it may contain several messages.
+            try:
+                data = self._sock.recv(65535)
+            except socket.error as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The kernel dropped some notifications.
+                self._resync_after_overflow()
                 continue
-            elif msg_type == NLMSG_ERROR:
-                # We have got an error. Raise an exception which brings the
-                # process down.
-                raise RTNetlinkError("Netlink error message, header : %s",
-                                     futils.hex(hdr))
-
-            # Now 16 bytes of netlink header.
-            hdr = data[:16]
-            data = data[16:]
-            family, _, if_type, index, flags, change = struct.unpack("=BBHiII", hdr)
-
-            # Bytes left is the message length minus the two headers of 16 bytes each.
-            remaining = msg_len - 32
-
-            while remaining:
-                # The data content is an array of RTA objects, each of which
-                # has a 4 byte header and some data.
-                rta_len, rta_type = struct.unpack("=HH", data[:4])
-
-                # This check comes from RTA_OK, and terminates a string of routing
-                # attributes.
-                if rta_len < 4:
-                    break
-
-                rta_data = data[4:rta_len]
-
-                # Remove the RTA object from the data. The length to jump is
-                # the rta_len rounded up to the nearest 4 byte boundary.
-                increment = int((rta_len + 3) / 4) * 4
-                data = data[increment:]
-                remaining -= increment
-
-                if rta_type == IFLA_IFNAME:
-                    # We only really care about NEWLINK messages; if an
-                    # interface goes away, we don't need to care (since it
-                    # takes its routes with it, and the interface will
-                    # presumably go away too). We do log though, just in case.
-                    rta_data = rta_data[:-1]
-                    if msg_type == RTM_NEWLINK:
-                        _log.debug("Detected new network interface : %s", rta_data)
-                        self.update_splitter.on_interface_update(rta_data,
-                                                                 async=True)
-                    else:
-                        _log.debug("Network interface has gone away : %s", rta_data)
+
+            for msg_type, _, _, payload in fnetlink.parse_messages(data):
+                if msg_type == NLMSG_NOOP:
+                    # Noop - get some more data.
+                    continue
+                elif msg_type == NLMSG_ERROR:
+                    # We have got an error. Raise an exception which brings
+                    # the process down.
+                    raise RTNetlinkError("Netlink error message, payload : %s",
+                                         futils.hex(payload))
+
+                if self.route_table is not None:
+                    self.route_table.handle_message(msg_type, payload)
+
+                if msg_type not in (RTM_NEWLINK, RTM_DELLINK):
+                    continue
+
+                ifindex, if_name, _ = fnetlink.parse_link(payload)
+                if if_name is None:
+                    continue
+
+                if self.sysctl_cache is not None:
+                    self.sysctl_cache.on_link_update(
+                        if_name, ifindex, deleted=(msg_type == RTM_DELLINK))
+
+                # We only really care about NEWLINK messages; if an interface
+                # goes away, we don't need to care (since it takes its routes
+                # with it, and the interface will presumably go away too). We
+                # do log though, just in case.
+                if msg_type == RTM_NEWLINK:
+                    _log.debug("Detected new network interface : %s", if_name)
+                    self.update_splitter.on_interface_update(if_name,
+                                                             async=True)
+                else:
+                    _log.debug("Network interface has gone away : %s",
+                               if_name)
+
+    def _resync_after_overflow(self):
+        """
+        Called when the socket's receive buffer has overflowed and we have
+        missed some notifications.  Reloads the route table and replays a
+        link update for every interface, since we may have missed those
+        too.
+        """
+        _log.warning("Netlink receive buffer overflowed, notifications "
+                     "have been lost.  Resyncing.")
+        if self.route_programmer is None:
+            # We have no netlink dump to resync from.
+            return
+        try:
+            self.route_programmer.refresh_route_table()
+        except (socket.error, fnetlink.NetlinkError):
+            # The periodic route reconcile will reload the table.
+            _log.exception("Failed to reload route table after overflow")
+            return
+        for if_name, ifindex in self.route_table.interfaces():
+            if self.sysctl_cache is not None:
+                self.sysctl_cache.on_link_update(if_name, ifindex,
+                                                 deleted=False)
+            self.update_splitter.on_interface_update(if_name, async=True)
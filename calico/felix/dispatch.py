@@ -19,12 +19,20 @@ felix.dispatch
 Actor that controls the top-level dispatch chains that dispatch to
 per-endpoint chains.
 """
+from collections import defaultdict
 import logging
 from calico.felix.actor import Actor, actor_message
-from calico.felix.frules import CHAIN_TO_ENDPOINT, CHAIN_FROM_ENDPOINT
+from calico.felix.frules import (CHAIN_TO_ENDPOINT, CHAIN_FROM_ENDPOINT,
+                                 CHAIN_TO_IFACE_BUCKET_PREFIX,
+                                 CHAIN_FROM_IFACE_BUCKET_PREFIX)
 
 _log = logging.getLogger(__name__)
 
+# Number of characters after the interface prefix that we bucket
+# interfaces on.  OpenStack interface names continue with hex digits so
+# this gives up to 256 buckets.
+BUCKET_CHARS = 2
+
 
 class DispatchChains(Actor):
     """
@@ -33,6 +41,24 @@ class DispatchChains(Actor):
 
     LocalEndpoint Actors give us kicks as they come and go so we can
     add/remove them from the chains.
+
+    Incremental updates
+    ~~~~~~~~~~~~~~~~~~~
+
+    Rather than listing every interface in the top-level chains, we
+    split the interfaces into buckets by the BUCKET_CHARS characters
+    that follow the interface prefix.  The top-level chains contain one
+    --goto rule per non-empty bucket, matching on a wildcard interface
+    name, and each bucket chain contains the per-interface rules.  (The
+    iptables wildcard only matches a name prefix, so we can't bucket on
+    a hash of the whole name.)
+
+    When an endpoint comes or goes, we only rewrite the bucket chain
+    that contains its interface, which holds around 1/256th of the
+    interfaces, plus the top-level chains, of up to 256 rules, if the
+    bucket became empty or non-empty.  The per-interface rule
+    fragments are cached so that we don't recalculate the (possibly
+    hashed) chain names for the other interfaces in the bucket.
     """
 
     batch_delay = 0.1
@@ -43,7 +69,25 @@ class DispatchChains(Actor):
         self.ip_version = ip_version
         self.iptables_updater = iptables_updater
         self.iface_to_ep_id = {}
-        self._dirty = False
+        # Map from interface name to the chain that traffic to it should go
+        # to, for interfaces that don't use their own to-chain.
+        self.iface_to_to_chain = {}
+
+        # Cache of the rule fragments for each interface, maps from
+        # interface name to (bucket, to_rule, from_rule, to_chain,
+        # from_chain).
+        self._fragments_by_iface = {}
+        # Index from bucket ID to the set of interfaces in that bucket.
+        # Interfaces that can't be put into a bucket (for example, because
+        # their name is the same as the prefix) go in the None bucket and
+        # are dispatched directly from the top-level chains.
+        self._ifaces_by_bucket = defaultdict(set)
+        # Buckets whose chains need to be rewritten or deleted.
+        self._dirty_buckets = set()
+        # Buckets that we've programmed chains for.
+        self._programmed_buckets = set()
+        # Whether the top-level chains need to be rewritten.
+        self._root_dirty = False
 
     @actor_message()
     def apply_snapshot(self, iface_to_ep_id):
@@ -56,14 +100,22 @@ class DispatchChains(Actor):
             names of the relevant chains.
         """
         _log.info("Applying dispatch chains snapshot.")
-        self.iface_to_ep_id = dict(iface_to_ep_id)  # Take a copy.
-        # Always reprogram the chain, even if it's empty.  This makes sure that
-        # we resync and it stops the iptables layer from marking our chain as
-        # missing.
-        self._dirty = True
+        for iface in self.iface_to_ep_id.keys():
+            if iface not in iface_to_ep_id:
+                self._remove_iface(iface)
+        for iface, endpoint_id in iface_to_ep_id.iteritems():
+            # Keep any to-chain that the endpoint has already told us about.
+            self._add_iface(iface, endpoint_id,
+                            to_chain=self.iface_to_to_chain.get(iface))
+        # Always reprogram all the chains, even if they're empty.  This makes
+        # sure that we resync and it stops the iptables layer from marking our
+        # chains as missing.
+        self._dirty_buckets.update(self._programmed_buckets)
+        self._dirty_buckets.update(self._ifaces_by_bucket.keys())
+        self._root_dirty = True
 
     @actor_message()
-    def on_endpoint_added(self, iface_name, endpoint_id):
+    def on_endpoint_added(self, iface_name, endpoint_id, to_chain=None):
         """
         Message sent to us by the LocalEndpoint to tell us we should
         add it to the dispatch chain.
@@ -74,11 +126,12 @@ class DispatchChains(Actor):
         :param iface_name: name of the linux interface.
         :param endpoint_id: ID of the endpoint, used to form the
             chain names.
+        :param to_chain: chain to send traffic to the endpoint to, if not
+            the endpoint's own to-chain.  For example, its profile's
+            shared to-chain.
         """
         _log.debug("%s ready: %s/%s", self, iface_name, endpoint_id)
-        if self.iface_to_ep_id.get(iface_name) != endpoint_id:
-            self.iface_to_ep_id[iface_name] = endpoint_id
-            self._dirty = True
+        self._add_iface(iface_name, endpoint_id, to_chain=to_chain)
 
     @actor_message()
     def on_endpoint_removed(self, iface_name):
@@ -88,56 +141,196 @@ class DispatchChains(Actor):
         Idempotent: does nothing if there is no mapping.
         """
         _log.debug("%s asked to remove dispatch rule %s", self, iface_name)
-        # It should be present but be defensive and reprogram the chain
-        # just in case if not.
-        self.iface_to_ep_id.pop(iface_name, None)
-        self._dirty = True
+        if iface_name in self.iface_to_ep_id:
+            self._remove_iface(iface_name)
+        else:
+            # It should be present but be defensive and reprogram the chain
+            # just in case.
+            self._mark_iface_dirty(iface_name)
+
+    def _add_iface(self, iface_name, endpoint_id, to_chain=None):
+        """
+        Adds the interface to our indexes and marks its bucket dirty if
+        its mapping has changed.
+        """
+        if (self.iface_to_ep_id.get(iface_name) == endpoint_id and
+                self.iface_to_to_chain.get(iface_name) == to_chain):
+            return
+        self.iface_to_ep_id[iface_name] = endpoint_id
+        if to_chain is not None:
+            self.iface_to_to_chain[iface_name] = to_chain
+        else:
+            self.iface_to_to_chain.pop(iface_name, None)
+        self._fragments_by_iface[iface_name] = \
+            self._calculate_fragments(iface_name, to_chain=to_chain)
+        bucket = self._fragments_by_iface[iface_name][0]
+        if bucket is not None and not self._ifaces_by_bucket.get(bucket):
+            # Bucket is new, need to add it to the top-level chains.
+            self._root_dirty = True
+        self._ifaces_by_bucket[bucket].add(iface_name)
+        self._mark_iface_dirty(iface_name)
+
+    def _remove_iface(self, iface_name):
+        """
+        Removes the interface from our indexes and marks its bucket dirty.
+        """
+        self.iface_to_ep_id.pop(iface_name)
+        self.iface_to_to_chain.pop(iface_name, None)
+        bucket = self._fragments_by_iface.pop(iface_name)[0]
+        ifaces = self._ifaces_by_bucket[bucket]
+        ifaces.discard(iface_name)
+        if not ifaces:
+            del self._ifaces_by_bucket[bucket]
+            if bucket is not None:
+                # Bucket now empty, remove it from the top-level chains.
+                self._root_dirty = True
+        self._mark_iface_dirty(iface_name)
+
+    def _mark_iface_dirty(self, iface_name):
+        """
+        Marks the chain that dispatches to the given interface dirty.
+        """
+        self._mark_bucket_dirty(self._bucket_for_iface(iface_name))
+
+    def _mark_bucket_dirty(self, bucket):
+        if bucket is None:
+            self._root_dirty = True
+        else:
+            self._dirty_buckets.add(bucket)
+
+    def _bucket_for_iface(self, iface_name):
+        """
+        :returns: the ID of the bucket that the interface belongs in or None
+            if it should be dispatched directly from the top-level chains.
+        """
+        prefix = self.config.IFACE_PREFIX
+        if not iface_name.startswith(prefix):
+            return None
+        bucket = iface_name[len(prefix):len(prefix) + BUCKET_CHARS]
+        if len(bucket) == BUCKET_CHARS and bucket.isalnum():
+            return bucket
+        return None
+
+    def _calculate_fragments(self, iface_name, to_chain=None):
+        """
+        Calculates the dispatch rule fragments for the given interface.
+
+        :param to_chain: chain to send traffic to the interface to, or None
+            to use the endpoint's own to-chain.
+
+        :returns: tuple containing the bucket, the rules to add to the to and
+            from chains and the names of the endpoint chains they refer to.
+        """
+        from calico.felix.endpoint import chain_names, interface_to_suffix
+        bucket = self._bucket_for_iface(iface_name)
+        to_bucket_chain, from_bucket_chain = self._bucket_chain_names(bucket)
+        # Note that we use --goto, which means that the endpoint-specific
+        # chain will return to our parent rather than to this chain.
+        ep_suffix = interface_to_suffix(self.config, iface_name)
+        to_chain_name, from_chain_name = chain_names(ep_suffix)
+        if to_chain is not None:
+            to_chain_name = to_chain
+        to_rule = ("--append %s --out-interface %s --goto %s" %
+                   (to_bucket_chain, iface_name, to_chain_name))
+        from_rule = ("--append %s --in-interface %s --goto %s" %
+                     (from_bucket_chain, iface_name, from_chain_name))
+        return bucket, to_rule, from_rule, to_chain_name, from_chain_name
+
+    @staticmethod
+    def _bucket_chain_names(bucket):
+        """
+        :returns: pair of names of the to and from chains for the given
+            bucket.  For the None bucket, the top-level chains.
+        """
+        if bucket is None:
+            return CHAIN_TO_ENDPOINT, CHAIN_FROM_ENDPOINT
+        return (CHAIN_TO_IFACE_BUCKET_PREFIX + bucket,
+                CHAIN_FROM_IFACE_BUCKET_PREFIX + bucket)
 
     def _finish_msg_batch(self, batch, results):
-        if self._dirty:
+        if self._dirty_buckets or self._root_dirty:
             _log.debug("Interface mapping changed, reprogramming chains.")
             self._reprogram_chains()
-            self._dirty = False
 
     def _reprogram_chains(self):
         """
-        Recalculates the chains and writes them to iptables.
+        Recalculates the dirty chains and writes them to iptables.
+
+        Synchronous, doesn't return until the chains are in place.
+        """
+        _log.info("%s Updating dispatch chains, num entries: %s, "
+                  "dirty buckets: %s, top-level chains dirty: %s", self,
+                  len(self.iface_to_ep_id), len(self._dirty_buckets),
+                  self._root_dirty)
+        updates = {}
+        dependencies = {}
+        buckets_to_write = set()
+        buckets_to_delete = set()
+        for bucket in self._dirty_buckets:
+            if self._ifaces_by_bucket.get(bucket):
+                self._calculate_bucket_chains(bucket, updates, dependencies)
+                buckets_to_write.add(bucket)
+            elif bucket in self._programmed_buckets:
+                buckets_to_delete.add(bucket)
+        if self._root_dirty:
+            self._calculate_bucket_chains(None, updates, dependencies)
 
-        Synchronous, doesn't return until the chain is in place.
+        if updates:
+            self.iptables_updater.rewrite_chains(updates, dependencies,
+                                                 async=False)
+        if buckets_to_delete:
+            chains_to_delete = []
+            for bucket in buckets_to_delete:
+                chains_to_delete.extend(self._bucket_chain_names(bucket))
+            self.iptables_updater.delete_chains(chains_to_delete,
+                                                async=False)
+
+        self._programmed_buckets.update(buckets_to_write)
+        self._programmed_buckets -= buckets_to_delete
+        self._dirty_buckets.clear()
+        self._root_dirty = False
+
+    def _calculate_bucket_chains(self, bucket, updates, dependencies):
         """
-        _log.info("%s Updating dispatch chain, num entries: %s", self,
-                  len(self.iface_to_ep_id))
+        Calculates the contents of the to and from chains for the given
+        bucket (or the top-level chains if bucket is None), storing them
+        in the updates and dependencies dicts.
+        """
+        to_chain, from_chain = self._bucket_chain_names(bucket)
         to_upds = []
         from_upds = []
-        updates = {CHAIN_TO_ENDPOINT: to_upds,
-                   CHAIN_FROM_ENDPOINT: from_upds}
         to_deps = set()
         from_deps = set()
-        dependencies = {CHAIN_TO_ENDPOINT: to_deps,
-                        CHAIN_FROM_ENDPOINT: from_deps}
-        from calico.felix.endpoint import chain_names, interface_to_suffix
-        for iface in self.iface_to_ep_id:
-            # Add rule to global chain to direct traffic to the
-            # endpoint-specific one.  Note that we use --goto, which means
-            # that the endpoint-specific chain will return to our parent
-            # rather than to this chain.
-            ep_suffix = interface_to_suffix(self.config, iface)
-            to_chain_name, from_chain_name = chain_names(ep_suffix)
-            from_upds.append("--append %s --in-interface %s --goto %s" %
-                             (CHAIN_FROM_ENDPOINT, iface, from_chain_name))
-            from_deps.add(from_chain_name)
-            to_upds.append("--append %s --out-interface %s --goto %s" %
-                           (CHAIN_TO_ENDPOINT, iface, to_chain_name))
-            to_deps.add(to_chain_name)
+        for iface in sorted(self._ifaces_by_bucket.get(bucket, ())):
+            _, to_rule, from_rule, to_ep_chain, from_ep_chain = \
+                self._fragments_by_iface[iface]
+            to_upds.append(to_rule)
+            from_upds.append(from_rule)
+            to_deps.add(to_ep_chain)
+            from_deps.add(from_ep_chain)
+        if bucket is None:
+            # Top-level chains; add the rules to dispatch to the buckets.
+            for child in sorted(b for b in self._ifaces_by_bucket
+                                if b is not None):
+                iface_match = self.config.IFACE_PREFIX + child + "+"
+                to_child, from_child = self._bucket_chain_names(child)
+                to_upds.append("--append %s --out-interface %s --goto %s" %
+                               (to_chain, iface_match, to_child))
+                from_upds.append("--append %s --in-interface %s --goto %s" %
+                                 (from_chain, iface_match, from_child))
+                to_deps.add(to_child)
+                from_deps.add(from_child)
 
         # Both TO and FROM chains end with a DROP so that interfaces that
         # we don't know about yet can't bypass our rules.
-        to_upds.append("--append %s --jump DROP" % CHAIN_TO_ENDPOINT)
-        from_upds.append("--append %s --jump DROP" % CHAIN_FROM_ENDPOINT)
+        to_upds.append("--append %s --jump DROP" % to_chain)
+        from_upds.append("--append %s --jump DROP" % from_chain)
 
-        self.iptables_updater.rewrite_chains(updates, dependencies,
-                                             async=False)
+        updates[to_chain] = to_upds
+        updates[from_chain] = from_upds
+        dependencies[to_chain] = to_deps
+        dependencies[from_chain] = from_deps
 
     def __str__(self):
         return self.__class__.__name__ + "<ipv%s,entries=%s>" % \
-            (self.ip_version, len(self.iface_to_ep_id))
\ No newline at end of file
+            (self.ip_version, len(self.iface_to_ep_id))
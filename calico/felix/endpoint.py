@@ -19,17 +19,25 @@ felix.endpoint
 
 Endpoint management.
 """
+import functools
 import logging
+import socket
 from subprocess import CalledProcessError
+
+import gevent
+
 from calico.felix import devices, futils
 from calico.felix.actor import actor_message
+from calico.felix.fnetlink import NetlinkBatch, NetlinkError
 from calico.felix.futils import FailedSystemCall
 from calico.felix.futils import IPV4
-from calico.felix.refcount import ReferenceManager, RefCountedActor
+from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
 from calico.felix.dispatch import DispatchChains
 from calico.felix.profilerules import RulesManager
 from calico.felix.frules import (CHAIN_TO_PREFIX, profile_to_chain_name,
-                                 CHAIN_FROM_PREFIX, commented_drop_fragment)
+                                 CHAIN_FROM_PREFIX, commented_drop_fragment,
+                                 endpoint_to_chain_fragments,
+                                 net_set_ipset_key)
 
 _log = logging.getLogger(__name__)
 
@@ -38,7 +46,10 @@ class EndpointManager(ReferenceManager):
     def __init__(self, config, ip_type,
                  iptables_updater,
                  dispatch_chains,
-                 rules_manager):
+                 rules_manager,
+                 route_programmer=None,
+                 sysctl_cache=None,
+                 ipset_manager=None):
         super(EndpointManager, self).__init__(qualifier=ip_type)
 
         # Configuration and version to use
@@ -50,6 +61,14 @@ class EndpointManager(ReferenceManager):
         self.iptables_updater = iptables_updater
         self.dispatch_chains = dispatch_chains
         self.rules_mgr = rules_manager
+        # Shared netlink programmer for routes, or None to fork "ip".
+        self.route_programmer = route_programmer
+        # Shared record of the sysctls applied to each interface, or None
+        # to write them every time.
+        self.sysctl_cache = sysctl_cache
+        # IpsetManager for anti-spoof ipsets, or None to always use one
+        # anti-spoof rule per IP.
+        self.ipset_manager = ipset_manager
 
         # All endpoint dicts that we know about.
         self.endpoints_by_id = {}
@@ -59,6 +78,8 @@ class EndpointManager(ReferenceManager):
         # increffed.
         self.local_endpoint_ids = set()
 
+        self._route_reconcile_scheduled = False
+
     def _create(self, object_id):
         """
         Overrides ReferenceManager._create()
@@ -68,7 +89,10 @@ class EndpointManager(ReferenceManager):
                              self.ip_type,
                              self.iptables_updater,
                              self.dispatch_chains,
-                             self.rules_mgr)
+                             self.rules_mgr,
+                             route_programmer=self.route_programmer,
+                             sysctl_cache=self.sysctl_cache,
+                             ipset_manager=self.ipset_manager)
 
     def _on_object_started(self, endpoint_id, obj):
         """
@@ -99,6 +123,12 @@ class EndpointManager(ReferenceManager):
             self.on_endpoint_update(endpoint_id, None)
             self._maybe_yield()
 
+        if (self.route_programmer is not None and
+                self.config.ROUTE_REFRESH_INT_SEC > 0 and
+                not self._route_reconcile_scheduled):
+            self._schedule_route_reconcile()
+            self._route_reconcile_scheduled = True
+
     @actor_message()
     def on_endpoint_update(self, endpoint_id, endpoint):
         """
@@ -137,6 +167,86 @@ class EndpointManager(ReferenceManager):
                 self.local_endpoint_ids.add(endpoint_id)
                 self.get_and_incref(endpoint_id)
 
+    def _schedule_route_reconcile(self):
+        gevent.spawn_later(self.config.ROUTE_REFRESH_INT_SEC,
+                           functools.partial(self.reconcile_routes,
+                                             async=True))
+
+    @actor_message()
+    def reconcile_routes(self):
+        """
+        Reloads the route table from the kernel and then repairs the routes
+        to all our local interfaces in a single netlink batch.  This picks
+        up any drift, for example routes removed by hand or route
+        notifications that we missed.
+
+        Reschedules itself.
+        """
+        self._schedule_route_reconcile()
+        self._repair_routes()
+
+    @actor_message()
+    def reconcile(self):
+        """
+        Called periodically to repair drift in the dataplane.
+
+        :returns int: the number of route and neighbour updates that were
+            needed to repair our local endpoints' routes.
+        """
+        if self.route_programmer is None:
+            # Without netlink, we have no cheap way to read the routes.
+            return 0
+        return self._repair_routes()
+
+    def _repair_routes(self):
+        """
+        Repairs the routes to all our local interfaces, see
+        reconcile_routes().
+
+        :returns int: the number of netlink requests that were needed.
+        """
+        try:
+            self.route_programmer.refresh_route_table(ip_types=[self.ip_type])
+        except (socket.error, NetlinkError):
+            # Nobody waits for the result of the timer-driven
+            # reconcile_routes(), so an exception would kill Felix.
+            _log.exception("Failed to load route table, will retry next "
+                           "time.")
+            return 0
+        route_table = self.route_programmer.route_table
+        nets_key = "ipv4_nets" if self.ip_type == IPV4 else "ipv6_nets"
+        nl_batch = NetlinkBatch()
+        for endpoint_id in self.local_endpoint_ids:
+            endpoint = self.endpoints_by_id.get(endpoint_id)
+            if not (endpoint and self._is_starting_or_live(endpoint_id)):
+                continue
+            iface_name = endpoint["name"]
+            if not devices.interface_up(iface_name):
+                # The endpoint will program its routes when the interface
+                # comes up.
+                continue
+            ips = set(futils.net_to_ip(n) for n in endpoint.get(nets_key, []))
+            try:
+                devices.set_routes(self.ip_type, ips, iface_name,
+                                   endpoint["mac"], nl_batch=nl_batch,
+                                   route_table=route_table)
+            except IOError:
+                _log.debug("Interface %s went away during route reconcile",
+                           iface_name)
+
+        if nl_batch:
+            _log.warning("Route reconcile found drift; sending %s netlink "
+                         "requests", len(nl_batch))
+            try:
+                self.route_programmer.execute(nl_batch)
+            except NetlinkError:
+                # Endpoints whose interfaces are flapping can fail here.
+                # We'll try again next time.
+                _log.exception("Failed to repair routes")
+        else:
+            _log.info("Route reconcile found no drift")
+        return len(nl_batch)
+
     @actor_message()
     def on_interface_update(self, name):
         """
@@ -162,7 +272,8 @@ class EndpointManager(ReferenceManager):
 class LocalEndpoint(RefCountedActor):
 
     def __init__(self, config, endpoint_id, ip_type, iptables_updater,
-                 dispatch_chains, rules_manager):
+                 dispatch_chains, rules_manager, route_programmer=None,
+                 sysctl_cache=None, ipset_manager=None):
         super(LocalEndpoint, self).__init__(qualifier="%s(%s)" %
                                             (endpoint_id, ip_type))
         assert isinstance(dispatch_chains, DispatchChains)
@@ -176,12 +287,35 @@ class LocalEndpoint(RefCountedActor):
         self.iptables_updater = iptables_updater
         self.dispatch_chains = dispatch_chains
         self.rules_mgr = rules_manager
+        self.route_programmer = route_programmer
+        self._route_table = (route_programmer.route_table
+                             if route_programmer else None)
+        self.sysctl_cache = sysctl_cache
+
+        # Anti-spoof ipset of our source addresses, only used if we have
+        # more than ANTI_SPOOF_IPSET_THRESHOLD of them.
+        self.ipset_refs = None
+        if ipset_manager is not None:
+            self.ipset_refs = RefHelper(self, ipset_manager,
+                                        self._on_ipsets_ready)
+        self._pending_programming = {}
+        """
+        Map from programming generation to the anti-spoof ipset key and
+        the to-chain for the dispatch chains that it used.
+        """
 
         # Will be filled in as we learn about the OS interface and the
         # endpoint config.
         self.endpoint = None
         self._iface_name = None
         self._suffix = None
+        self._profile_chains = None
+        """
+        Map from direction to the profile chain that our chains go to, or
+        None if we don't know it yet.
+        """
+        self._on_profile_chains = functools.partial(
+            self.on_profile_chains_updated, async=True)
 
         # Track whether the last attempt to program the dataplane succeeded.
         # We'll force a reprogram next time we get a kick.
@@ -189,6 +323,16 @@ class LocalEndpoint(RefCountedActor):
         # And whether we've received an update since last time we programmed.
         self._dirty = False
 
+        # Work deferred to the end of the batch: whether we received an
+        # endpoint update and whether the interface needs (re)configuring.
+        self._endpoint_updated = False
+        self._iface_dirty = False
+        # Whether we were ready when we last programmed the dataplane.
+        self._was_ready = False
+        # Incremented each time we program or remove our chains so that we
+        # can ignore completion callbacks for superseded requests.
+        self._programming_gen = 0
+
     @actor_message()
     def on_endpoint_update(self, endpoint):
         """
@@ -202,19 +346,32 @@ class LocalEndpoint(RefCountedActor):
             self._iface_name = endpoint["name"]
             self._suffix = interface_to_suffix(self.config,
                                                self._iface_name)
-        was_ready = self._ready
 
         old_profile_id = self.endpoint and self.endpoint["profile_id"]
         new_profile_id = endpoint and endpoint["profile_id"]
         if old_profile_id != new_profile_id:
+            share_chains = self.config.SHARE_PROFILE_CHAINS
             if old_profile_id:
                 # Clean up the old profile.
                 _log.info("Profile changed, decreffing old profile %s",
                           old_profile_id)
+                if share_chains:
+                    self.rules_mgr.unwatch_profile_chains(
+                        old_profile_id, self._on_profile_chains, async=True)
                 self.rules_mgr.decref(old_profile_id, async=True)
+            self._profile_chains = None
             if new_profile_id is not None:
                 _log.info("Acquiring new profile %s", new_profile_id)
                 self.rules_mgr.get_and_incref(new_profile_id, async=True)
+                if share_chains:
+                    # We'll learn the shared chain names from the manager.
+                    self.rules_mgr.watch_profile_chains(
+                        new_profile_id, self._on_profile_chains, async=True)
+                else:
+                    self._profile_chains = dict(
+                        (direction, profile_to_chain_name(direction,
+                                                          new_profile_id))
+                        for direction in ("inbound", "outbound"))
 
         if endpoint != self.endpoint:
             self._dirty = True
@@ -222,15 +379,10 @@ class LocalEndpoint(RefCountedActor):
         # Store off the endpoint we were passed.
         self.endpoint = endpoint
 
-        if endpoint:
-            # Configure the network interface; may fail if not there yet (in
-            # which case we'll just do it when the interface comes up).
-            self._configure_interface()
-        else:
-            # Remove the network programming.
-            self._deconfigure_interface()
-
-        self._maybe_update(was_ready)
+        # Defer the interface and chain programming to the end of the batch
+        # so that we do it at most once per batch.
+        self._iface_dirty = True
+        self._endpoint_updated = True
         _log.debug("%s finished processing update", self)
 
     @actor_message()
@@ -239,16 +391,105 @@ class LocalEndpoint(RefCountedActor):
         Overrides RefCountedActor:on_unreferenced.
         """
         _log.info("%s now unreferenced, cleaning up", self)
+        # Our final update may be in this batch; send its work to the
+        # dataplane before we tell the manager that we're gone, or it could
+        # race with a new LocalEndpoint for the same ID.
+        self._apply_pending_changes()
         assert not self._ready, "Should be deleted before being unreffed."
+        if self.ipset_refs is not None:
+            # Normally released along with our chains but make sure, and
+            # break the reference cycle between us and our RefHelper.
+            self.ipset_refs.discard_all()
+            self.ipset_refs = None
         self._notify_cleanup_complete()
 
+    @actor_message()
+    def on_profile_chains_updated(self, profile_id, chains):
+        """
+        Called by the RulesManager, in shared-chain mode, with the names
+        of the shared chains that our profile's rules are in.
+        """
+        if not self.endpoint or self.endpoint["profile_id"] != profile_id:
+            _log.debug("%s: ignoring chains for old profile %s", self,
+                       profile_id)
+            return
+        if chains != self._profile_chains:
+            _log.info("%s: profile chains now %s", self, chains)
+            self._profile_chains = chains
+            self._dirty = True
+            self._endpoint_updated = True
+
     @actor_message()
     def on_interface_update(self):
         """
         Actor event to report that the interface is either up or changed.
         """
         _log.info("Endpoint %s received interface kick", self.endpoint_id)
-        self._configure_interface()
+        self._iface_dirty = True
+
+    def _on_ipsets_ready(self):
+        """
+        Callback from our RefHelper once our anti-spoof ipset exists.
+        """
+        # Reprogram at the end of the batch.
+        self._dirty = True
+        self._endpoint_updated = True
+
+    @actor_message()
+    def on_chains_programmed(self, gen, error):
+        """
+        Completion callback from the IptablesUpdater.
+
+        :param gen: value of _programming_gen when the chains were sent.
+        :param error: None on success, or the exception.
+        """
+        ipset_key, to_chain = self._pending_programming.pop(gen,
+                                                            (None, None))
+        if gen != self._programming_gen:
+            _log.debug("%s: ignoring result of superseded update", self)
+            return
+        if error is None:
+            if self.ipset_refs is not None:
+                # The old anti-spoof ipset (if any) is no longer in use.
+                for key in list(self.ipset_refs.required_refs):
+                    if key != ipset_key:
+                        self.ipset_refs.discard_ref(key)
+            # Our chains are in place, safe to send traffic to them.
+            kwargs = {}
+            if to_chain is not None:
+                kwargs["to_chain"] = to_chain
+            self.dispatch_chains.on_endpoint_added(
+                self._iface_name, self.endpoint_id, async=True, **kwargs)
+        else:
+            _log.error("Failed to program chains for %s: %r. Removing.",
+                       self, error)
+            self._failed = True
+            self.dispatch_chains.on_endpoint_removed(self._iface_name,
+                                                     async=True)
+            self._remove_chains()
+
+    def _finish_msg_batch(self, batch, results):
+        """
+        Overrides Actor._finish_msg_batch() to apply the work that we
+        deferred while processing the batch.
+        """
+        self._apply_pending_changes()
+
+    def _apply_pending_changes(self):
+        if self._iface_dirty:
+            self._iface_dirty = False
+            if self.endpoint:
+                # Configure the network interface; may fail if not there yet
+                # (in which case we'll just do it when the interface comes
+                # up).
+                self._configure_interface()
+            elif self._iface_name:
+                # Remove the network programming.
+                self._deconfigure_interface()
+        if self._endpoint_updated:
+            self._endpoint_updated = False
+            self._maybe_update(self._was_ready)
+            self._was_ready = self._ready
 
     @property
     def _missing_deps(self):
@@ -290,9 +531,8 @@ class LocalEndpoint(RefCountedActor):
                     _log.warn("Retrying programming after a failure")
                 self._failed = False  # Ready to try again...
                 _log.info("%s became ready to program.", self)
+                # Adds us to the dispatch chains once programming succeeds.
                 self._update_chains()
-                self.dispatch_chains.on_endpoint_added(
-                    self._iface_name, self.endpoint_id, async=True)
             else:
                 # We were active but now we're not, withdraw the dispatch rule
                 # and our chain.  We must do this to allow iptables to remove
@@ -306,39 +546,92 @@ class LocalEndpoint(RefCountedActor):
             self._dirty = False
 
     def _update_chains(self):
+        if self._profile_chains is None:
+            # We'll be called again once the RulesManager tells us the
+            # names; leave the old chains in place until then.
+            _log.info("%s waiting for profile chain names", self)
+            return
+        local_ips = self.endpoint.get("ipv%s_nets" % self.ip_version, [])
+        ipset_key = None
+        antispoof_ipset = None
+        threshold = self.config.ANTI_SPOOF_IPSET_THRESHOLD
+        if (self.ipset_refs is not None and threshold > 0 and
+                len(local_ips) > threshold):
+            ipset_key = net_set_ipset_key(
+                sorted(_ip_to_cidr(ip, self.ip_version) for ip in local_ips))
+            self.ipset_refs.acquire_ref(ipset_key)
+            if ipset_key not in self.ipset_refs.acquired_refs:
+                # We'll be called again once the ipset is ready; leave the
+                # old chains in place until then.
+                _log.info("%s waiting for anti-spoof ipset", self)
+                return
+            antispoof_ipset = self.ipset_refs.acquired_refs[ipset_key].name
         updates, deps = _get_endpoint_rules(
             self._suffix,
             self._iface_name,
             self.ip_version,
-            self.endpoint.get("ipv%s_nets" % self.ip_version, []),
+            local_ips,
             self.endpoint["mac"],
-            self.endpoint["profile_id"])
-        try:
-            self.iptables_updater.rewrite_chains(updates, deps, async=False)
-        except CalledProcessError:
-            _log.exception("Failed to program chains for %s. Removing.", self)
-            self._failed = True
-            self._remove_chains()
+            self.endpoint["profile_id"],
+            conntrack_fast_path=self.config.CONNTRACK_FAST_PATH,
+            antispoof_ipset=antispoof_ipset,
+            shared_to_chain=self.config.SHARE_TO_CHAINS,
+            profile_chains=self._profile_chains)
+        to_chain = None
+        if self.config.SHARE_TO_CHAINS:
+            to_chain = profile_to_chain_name("to",
+                                             self.endpoint["profile_id"])
+        self._programming_gen += 1
+        self._pending_programming[self._programming_gen] = (ipset_key,
+                                                            to_chain)
+        callback = functools.partial(self.on_chains_programmed,
+                                     self._programming_gen,
+                                     async=True)
+        self.iptables_updater.rewrite_chains(updates, deps, async=True,
+                                             callback=callback)
 
     def _remove_chains(self):
+        self._programming_gen += 1
+        chains = chain_names(self._suffix)
+        if self.config.SHARE_TO_CHAINS:
+            # We don't own a to-chain.
+            chains = chains[1:]
         try:
-            self.iptables_updater.delete_chains(chain_names(self._suffix),
-                                                async=True)
-        except CalledProcessError:
+            if self.ipset_refs is not None and self.ipset_refs.required_refs:
+                # Make sure that the chains are gone before we release the
+                # anti-spoof ipset, or it would be in use when it's deleted.
+                try:
+                    self.iptables_updater.delete_chains(chains, async=False)
+                finally:
+                    # Release it even if the delete failed rather than leak
+                    # it; we'll be removed either way.
+                    self.ipset_refs.discard_all()
+            else:
+                self.iptables_updater.delete_chains(chains, async=True)
+        except (CalledProcessError, FailedSystemCall):
             _log.exception("Failed to delete chains for %s", self)
             self._failed = True
 
     def _configure_interface(self):
         """
         Applies sysctls and routes to the interface.
+
+        If we have a route programmer, the proxy NDP entry, routes and ARP
+        entries are all sent to the kernel in a single netlink batch.
         """
+        nl_batch = NetlinkBatch() if self.route_programmer else None
         try:
             if self.ip_type == IPV4:
-                devices.configure_interface_ipv4(self._iface_name)
+                devices.configure_interface_ipv4(
+                    self._iface_name,
+                    sysctl_cache=self.sysctl_cache)
                 nets_key = "ipv4_nets"
             else:
                 ipv6_gw = self.endpoint.get("ipv6_gateway", None)
-                devices.configure_interface_ipv6(self._iface_name, ipv6_gw)
+                devices.configure_interface_ipv6(
+                    self._iface_name, ipv6_gw,
+                    nl_batch=nl_batch,
+                    sysctl_cache=self.sysctl_cache)
                 nets_key = "ipv6_nets"
 
             ips = set()
@@ -346,9 +639,17 @@ class LocalEndpoint(RefCountedActor):
                 ips.add(futils.net_to_ip(ip))
             devices.set_routes(self.ip_type, ips,
                                self._iface_name,
-                               self.endpoint["mac"])
-
-        except (IOError, FailedSystemCall, CalledProcessError):
+                               self.endpoint["mac"],
+                               nl_batch=nl_batch,
+                               route_table=self._route_table)
+            if nl_batch:
+                self.route_programmer.execute(nl_batch)
+
+        except (IOError, FailedSystemCall, CalledProcessError, NetlinkError):
+            if self.sysctl_cache is not None:
+                # We don't know how much of the configuration stuck, so
+                # write it all again next time.
+                self.sysctl_cache.invalidate(self._iface_name)
             if not devices.interface_exists(self._iface_name):
                 _log.info("Interface %s for %s does not exist yet",
                            self._iface_name, self.endpoint_id)
@@ -365,10 +666,15 @@ class LocalEndpoint(RefCountedActor):
         """
         Removes routes from the interface.
         """
+        nl_batch = NetlinkBatch() if self.route_programmer else None
         try:
-            devices.set_routes(self.ip_type, set(), self._iface_name, None)
+            devices.set_routes(self.ip_type, set(), self._iface_name, None,
+                               nl_batch=nl_batch,
+                               route_table=self._route_table)
+            if nl_batch:
+                self.route_programmer.execute(nl_batch)
 
-        except (IOError, FailedSystemCall, CalledProcessError):
+        except (IOError, FailedSystemCall, CalledProcessError, NetlinkError):
             if not devices.interface_exists(self._iface_name):
                 # Deleted under our feet - so the rules are gone.
                 _log.debug("Interface %s for %s deleted",
@@ -397,35 +703,42 @@ def chain_names(endpoint_suffix):
     return to_chain_name, from_chain_name
 
 
-def _get_endpoint_rules(suffix, iface, ip_version, local_ips, mac, profile_id):
+def _ip_to_cidr(ip, ip_version):
+    if "/" in ip:
+        return ip
+    return "%s/32" % ip if ip_version == 4 else "%s/128" % ip
+
+
+def _get_endpoint_rules(suffix, iface, ip_version, local_ips, mac, profile_id,
+                        conntrack_fast_path=False, antispoof_ipset=None,
+                        shared_to_chain=False, profile_chains=None):
+    """
+    :param conntrack_fast_path: True if the global chains already drop
+           INVALID packets and accept established flows (see
+           frules.conntrack_fast_path_fragments()), in which case we don't
+           repeat the checks here.
+    :param antispoof_ipset: name of a hash:net ipset containing local_ips
+           to use for the anti-spoof check in place of one rule per IP, or
+           None.
+    :param shared_to_chain: True if the dispatch chains send traffic to
+           the profile's shared to-chain, in which case we only return the
+           from-chain.
+    :param profile_chains: dict mapping "inbound"/"outbound" to the
+           profile's chains, if they aren't the per-profile chains (for
+           example, because they are shared between profiles).
+    """
     to_chain_name, from_chain_name = chain_names(suffix)
 
-    to_chain = ["--flush %s" % to_chain_name]
-    if ip_version == 6:
-        #  In ipv6 only, there are 6 rules that need to be created first.
-        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmptype 130
-        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmptype 131
-        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmptype 132
-        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmp router-advertisement
-        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmp neighbour-solicitation
-        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmp neighbour-advertisement
-        #
-        #  These rules are ICMP types 130, 131, 132, 134, 135 and 136, and can
-        #  be created on the command line with something like :
-        #     ip6tables -A plw -j RETURN --protocol ipv6-icmp --icmpv6-type 130
-        for icmp_type in ["130", "131", "132", "134", "135", "136"]:
-            to_chain.append("--append %s --jump RETURN "
-                            "--protocol ipv6-icmp "
-                            "--icmpv6-type %s" % (to_chain_name, icmp_type))
-    to_chain.append("--append %s --match conntrack --ctstate INVALID "
-                    "--jump DROP" % to_chain_name)
-    to_chain.append("--append %s --match conntrack "
-                    "--ctstate RELATED,ESTABLISHED --jump RETURN" %
-                    to_chain_name)
     assert profile_id, "Profile ID should be set, not %s" % profile_id
-    profile_in_chain = profile_to_chain_name("inbound", profile_id)
-    to_chain.append("--append %s --goto %s" %
-                    (to_chain_name, profile_in_chain))
+    if profile_chains is None:
+        profile_chains = dict(
+            (direction, profile_to_chain_name(direction, profile_id))
+            for direction in ("inbound", "outbound"))
+    profile_in_chain = profile_chains["inbound"]
+    to_chain = ["--flush %s" % to_chain_name]
+    to_chain.extend(endpoint_to_chain_fragments(to_chain_name, ip_version,
+                                                profile_in_chain,
+                                                conntrack_fast_path))
     to_deps = set([profile_in_chain])
 
     # Now the chain that manages packets from the interface...
@@ -435,11 +748,16 @@ def _get_endpoint_rules(suffix, iface, ip_version, local_ips, mac, profile_id):
         from_chain.append("--append %s --protocol ipv6-icmp" % from_chain_name)
 
     # Conntrack rules.
-    from_chain.append("--append %s --match conntrack --ctstate INVALID "
-                      "--jump DROP" % from_chain_name)
-    from_chain.append("--append %s --match conntrack "
-                      "--ctstate RELATED,ESTABLISHED --jump RETURN" %
-                      from_chain_name)
+    if not conntrack_fast_path:
+        from_chain.append("--append %s --match conntrack --ctstate INVALID "
+                          "--jump DROP" % from_chain_name)
+        from_chain.append("--append %s --match conntrack "
+                          "--ctstate RELATED,ESTABLISHED --jump RETURN" %
+                          from_chain_name)
+    elif ip_version == 6:
+        from_chain.append("--append %s --protocol ipv6-icmp "
+                          "--match conntrack --ctstate INVALID --jump DROP" %
+                          from_chain_name)
 
     if ip_version == 4:
         from_chain.append("--append %s --protocol udp --sport 68 --dport 67 "
@@ -451,13 +769,16 @@ def _get_endpoint_rules(suffix, iface, ip_version, local_ips, mac, profile_id):
 
     # Anti-spoofing rules.  Only allow traffic from known (IP, MAC) pairs to
     # get to the profile chain, drop other traffic.
-    profile_out_chain = profile_to_chain_name("outbound", profile_id)
+    profile_out_chain = profile_chains["outbound"]
     from_deps = set([profile_out_chain])
+    if antispoof_ipset is not None:
+        from_chain.append("--append %s --match set --match-set %s src "
+                          "--match mac --mac-source %s --goto %s" %
+                          (from_chain_name, antispoof_ipset, mac.upper(),
+                           profile_out_chain))
+        local_ips = []
     for ip in local_ips:
-        if "/" in ip:
-            cidr = ip
-        else:
-            cidr = "%s/32" % ip if ip_version == 4 else "%s/128" % ip
+        cidr = _ip_to_cidr(ip, ip_version)
         # Note use of --goto rather than --jump; this means that when the
         # profile chain returns, it will return the chain that called us, not
         # this chain.
@@ -467,6 +788,9 @@ def _get_endpoint_rules(suffix, iface, ip_version, local_ips, mac, profile_id):
     from_chain.append(commented_drop_fragment(from_chain_name,
                                               "Anti-spoof DROP:"))
 
+    if shared_to_chain:
+        # Dispatch goes straight to the profile's to-chain.
+        return {from_chain_name: from_chain}, {from_chain_name: from_deps}
     updates = {to_chain_name: to_chain, from_chain_name: from_chain}
     deps = {to_chain_name: to_deps, from_chain_name: from_deps}
     return updates, deps
@@ -21,7 +21,7 @@ The main logic for Felix.
 """
 
 # Monkey-patch before we do anything else...
-from calico.felix.devices import InterfaceWatcher
+from calico.felix.devices import InterfaceWatcher, SysctlCache
 from calico.felix.endpoint import EndpointManager
 from calico.felix.fetcd import EtcdWatcher
 from calico.felix.ipsets import IpsetManager
@@ -35,11 +35,15 @@ import gevent
 
 from calico import common
 from calico.felix.fiptables import IptablesUpdater
+from calico.felix.fnftables import (NftablesDispatchChains, NftablesUpdater,
+                                    NftSetManager)
+from calico.felix.fnetlink import NetlinkRouteProgrammer
 from calico.felix.dispatch import DispatchChains
 from calico.felix.profilerules import RulesManager
 from calico.felix.frules import install_global_rules
 from calico.felix.splitter import UpdateSplitter
 from calico.felix.config import Config
+from calico.felix.convergence import ConvergenceTracker
 from calico.felix.futils import IPV4, IPV6
 
 _log = logging.getLogger(__name__)
@@ -52,41 +56,72 @@ def _main_greenlet(config):
     """
     try:
         _log.info("Connecting to etcd to get our configuration.")
-        etcd_watcher = EtcdWatcher(config)
+        # Tracks how far through the etcd event stream the dataplane is.
+        convergence_tracker = ConvergenceTracker()
+        convergence_tracker.start()
+        etcd_watcher = EtcdWatcher(config, convergence_tracker)
         etcd_watcher.start()
         # Ask the EtcdWatcher to fill in the global config object before we
-        # proceed.  We don't yet support config updates.
+        # proceed.  The EtcdWatcher applies later changes to the config as
+        # it sees them.
         etcd_watcher.load_config(async=False)
 
         _log.info("Main greenlet: Configuration loaded, starting remaining "
                   "actors...")
-        v4_filter_updater = IptablesUpdater("filter", ip_version=4)
-        v4_nat_updater = IptablesUpdater("nat", ip_version=4)
-        v4_ipset_mgr = IpsetManager(IPV4)
-        v4_rules_manager = RulesManager(4, v4_filter_updater, v4_ipset_mgr)
-        v4_dispatch_chains = DispatchChains(config, 4, v4_filter_updater)
+        # Routes for both IP versions are programmed over one shared netlink
+        # socket.
+        route_programmer = NetlinkRouteProgrammer()
+        sysctl_cache = SysctlCache()
+
+        if config.DATAPLANE_DRIVER == "nftables":
+            _log.info("Using the nftables dataplane.")
+            updater_cls = NftablesUpdater
+            ipset_mgr_cls = NftSetManager
+            dispatch_cls = NftablesDispatchChains
+        else:
+            updater_cls = IptablesUpdater
+            ipset_mgr_cls = IpsetManager
+            dispatch_cls = DispatchChains
+
+        v4_filter_updater = updater_cls("filter", ip_version=4)
+        v4_nat_updater = updater_cls("nat", ip_version=4)
+        v4_ipset_mgr = ipset_mgr_cls(IPV4)
+        v4_rules_manager = RulesManager(config, 4, v4_filter_updater,
+                                        v4_ipset_mgr)
+        v4_dispatch_chains = dispatch_cls(config, 4, v4_filter_updater)
         v4_ep_manager = EndpointManager(config,
                                         IPV4,
                                         v4_filter_updater,
                                         v4_dispatch_chains,
-                                        v4_rules_manager)
-
-        v6_filter_updater = IptablesUpdater("filter", ip_version=6)
-        v6_ipset_mgr = IpsetManager(IPV6)
-        v6_rules_manager = RulesManager(6, v6_filter_updater, v6_ipset_mgr)
-        v6_dispatch_chains = DispatchChains(config, 6, v6_filter_updater)
+                                        v4_rules_manager,
+                                        route_programmer=route_programmer,
+                                        sysctl_cache=sysctl_cache,
+                                        ipset_manager=v4_ipset_mgr)
+
+        v6_filter_updater = updater_cls("filter", ip_version=6)
+        v6_ipset_mgr = ipset_mgr_cls(IPV6)
+        v6_rules_manager = RulesManager(config, 6, v6_filter_updater,
+                                        v6_ipset_mgr)
+        v6_dispatch_chains = dispatch_cls(config, 6, v6_filter_updater)
         v6_ep_manager = EndpointManager(config,
                                         IPV6,
                                         v6_filter_updater,
                                         v6_dispatch_chains,
-                                        v6_rules_manager)
+                                        v6_rules_manager,
+                                        route_programmer=route_programmer,
+                                        sysctl_cache=sysctl_cache,
+                                        ipset_manager=v6_ipset_mgr)
 
         update_splitter = UpdateSplitter(config,
                                          [v4_ipset_mgr, v6_ipset_mgr],
                                          [v4_rules_manager, v6_rules_manager],
                                          [v4_ep_manager, v6_ep_manager],
-                                         [v4_filter_updater, v6_filter_updater])
-        iface_watcher = InterfaceWatcher(update_splitter)
+                                         [v4_filter_updater, v6_filter_updater],
+                                         nat_updaters=[v4_nat_updater])
+        iface_watcher = InterfaceWatcher(
+            update_splitter,
+            route_programmer=route_programmer,
+            sysctl_cache=sysctl_cache)
 
         _log.info("Starting actors.")
         update_splitter.start()
@@ -124,7 +159,8 @@ def _main_greenlet(config):
             v6_ep_manager.greenlet,
 
             iface_watcher.greenlet,
-            etcd_watcher.greenlet
+            etcd_watcher.greenlet,
+            convergence_tracker.greenlet,
         ]
 
         # Install the global rules before we start polling for updates.
@@ -132,6 +168,11 @@ def _main_greenlet(config):
         install_global_rules(config, v4_filter_updater, v6_filter_updater,
                              v4_nat_updater)
 
+        # The interface watcher is already subscribed to route changes, so
+        # we can now safely load the route table that it will maintain.
+        _log.info("Loading route table.")
+        route_programmer.refresh_route_table()
+
         # Start polling for updates. These kicks make the actors poll
         # indefinitely.
         _log.info("Starting polling for interface and etcd updates.")
@@ -20,10 +20,13 @@ Etcd polling functions.
 """
 from etcd import EtcdException, EtcdClusterIdChanged, EtcdKeyNotFound
 import etcd
+import functools
 import itertools
 import json
 import logging
 import gevent
+from gevent.queue import Queue
+import time
 from types import StringTypes
 from urllib3 import Timeout
 from urllib3.exceptions import ReadTimeoutError
@@ -35,29 +38,83 @@ from calico.datamodel_v1 import (VERSION_DIR, READY_KEY, CONFIG_DIR,
                                  get_profile_id_for_profile_dir, dir_for_host,
                                  PROFILE_DIR, HOST_DIR)
 from calico.felix.actor import Actor, actor_message
+from calico.felix.config import ConfigException, RESTART_REQUIRED
+from calico.felix.futils import Backoff, LRUCache
 
 _log = logging.getLogger(__name__)
 
 
-RETRY_DELAY = 5
+# Exponential backoff, in seconds, for retrying after etcd errors.
+INITIAL_RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+
+# Maximum number of etcd events that we queue up for the UpdateSplitter.
+# Once the queue is full, we stop polling etcd until it has caught up.
+MAX_QUEUED_EVENTS = 1000
+
+# The subtrees that we watch, each with its own poller.  The hosts stream
+# includes this host's endpoints and per-host config; etcd can't exclude
+# them from a recursive watch of the host directory, so a separate stream
+# for them would only see every event twice.
+WATCHED_STREAMS = {
+    "ready": READY_KEY,
+    "config": CONFIG_DIR,
+    "profiles": PROFILE_DIR,
+    "hosts": HOST_DIR,
+}
+
+# Read timeout, in seconds, when checking whether an idle stream has any
+# updates up to the current etcd index.  etcd answers straight away from
+# its history if it does.
+IDLE_CHECK_TIMEOUT = 1
 
 # If we see an unhandled event (e.g. a directory deletion) for keys in any of
-# these prefixes, we'll abort our polling and resync.
+# these prefixes, we'll abort polling of that stream and resync it.
 PREFIXES_TO_RESYNC_ON_CHANGE = [
     READY_KEY,
     PROFILE_DIR,
     HOST_DIR,
 ]
 
+# Maximum number of decoded and validated etcd values to cache.  See
+# _decode_and_validate().
+VALIDATION_CACHE_SIZE = 10000
+_validation_cache = LRUCache(VALIDATION_CACHE_SIZE)
+
+# Config parameters that are applied by reconfiguring logging.
+LOGGING_CONFIG = frozenset(["LOGFILE", "LOGLEVFILE", "LOGLEVSYS",
+                            "LOGLEVSCR"])
+
+
 class ValidationFailed(Exception):
     pass
 
 
+class RestartRequired(Exception):
+    """
+    Raised from watch_etcd, so that Felix exits and gets restarted, when a
+    config parameter that can't be changed live changes.
+    """
+    pass
+
+
 class EtcdWatcher(Actor):
-    def __init__(self, config):
+    def __init__(self, config, convergence_tracker):
         super(EtcdWatcher, self).__init__()
         self.config = config
+        self.convergence_tracker = convergence_tracker
+        # We keep one client, and hence one pool of keep-alive connections,
+        # for as long as we can, only replacing it if we fail to connect.
         self.client = None
+        self._backoff = Backoff(INITIAL_RETRY_DELAY, MAX_RETRY_DELAY)
+        # Maps etcd key to (modifiedIndex, update type, ID) for each node
+        # that we've passed to the UpdateSplitter, so that we can resync
+        # by sending only the differences.  None until we've applied a
+        # snapshot.
+        self._known_nodes = None
+        self._full_resync_needed = False
+        # Poller greenlets by stream name.
+        self._pollers = {}
         self.my_config_dir = dir_for_per_host_config(self.config.HOSTNAME)
 
     @actor_message()
@@ -65,46 +122,112 @@ class EtcdWatcher(Actor):
         _log.info("Waiting for etcd to be ready and for config to be present.")
         configured = False
         while not configured:
-            self._reconnect()
+            self._ensure_client()
             self.wait_for_ready()
             try:
                 config_dict = self._load_config_dict()
-            except (EtcdKeyNotFound, EtcdException):
+            except (EtcdKeyNotFound, EtcdException) as e:
                 _log.exception("Failed to read config.  Will retry.")
-                gevent.sleep(RETRY_DELAY)
+                self._retry_after_error(e)
                 continue
+            self._backoff.reset()
 
             self.config.update_config(config_dict)
-            common.complete_logging(self.config.LOGFILE,
-                                    self.config.LOGLEVFILE,
-                                    self.config.LOGLEVSYS,
-                                    self.config.LOGLEVSCR)
+            self._configure_logging()
             configured = True
 
+    def _reload_config(self, update_splitter):
+        """
+        Re-reads the config from etcd after a change.  Applies changes to
+        the logging config directly and passes the other changes to the
+        UpdateSplitter.  If the new config is invalid, we log and carry on
+        with the old config.
+
+        :raises RestartRequired: if a parameter in RESTART_REQUIRED has
+            changed.
+        """
+        _log.info("Config changed in etcd, reloading it.")
+        while True:
+            try:
+                config_dict = self._load_config_dict()
+            except EtcdException as e:
+                _log.exception("Failed to reload config.  Will retry.")
+                self._retry_after_error(e)
+                continue
+            self._backoff.reset()
+            break
+        try:
+            changed = self.config.update_config(config_dict)
+        except ConfigException:
+            _log.exception("Updated config is invalid, continuing with the "
+                           "old config.")
+            return
+        if not changed:
+            _log.info("No config parameters changed.")
+            return
+        _log.info("Config parameters changed: %s", ", ".join(sorted(changed)))
+        if changed & RESTART_REQUIRED:
+            _log.critical("Config parameters %s can't be changed while "
+                          "Felix is running, restarting.",
+                          ", ".join(sorted(changed & RESTART_REQUIRED)))
+            raise RestartRequired()
+        if changed & LOGGING_CONFIG:
+            self._configure_logging()
+        update_splitter.on_config_update(changed, async=False)
+
+    def _configure_logging(self):
+        common.complete_logging(self.config.LOGFILE,
+                                self.config.LOGLEVFILE,
+                                self.config.LOGLEVSYS,
+                                self.config.LOGLEVSCR)
+
     @actor_message()
     def wait_for_ready(self):
+        """
+        Waits for etcd to be ready.
+
+        :returns: the etcd index at which we saw the ready flag set.
+        """
         _log.info("Waiting for etcd to be ready...")
-        ready = False
-        while not ready:
+        while True:
             try:
-                db_ready = self.client.read(READY_KEY,
-                                            timeout=10).value
+                result = self.client.read(READY_KEY, timeout=10)
+                db_ready = result.value
             except EtcdKeyNotFound:
                 _log.warn("Ready flag not present in etcd, waiting...")
                 db_ready = "false"
-            except EtcdException:
+            except EtcdException as e:
                 _log.exception("Failed to retrieve ready flag from etcd, "
                                "waiting...")
-                db_ready = "false"
+                self._retry_after_error(e)
+                continue
 
             if db_ready == "true":
                 _log.info("etcd is ready.")
-                ready = True
+                self._backoff.reset()
+                return result.etcd_index
             else:
                 _log.info("etcd not ready.  Will retry.")
-                gevent.sleep(RETRY_DELAY)
+                self._retry_after_error()
                 continue
 
+    def _retry_after_error(self, exc=None, backoff=None):
+        """
+        Sleeps before retrying after an error.  If the error was a
+        failure to connect to etcd, replaces our client.
+
+        :param backoff: Backoff to use, defaults to the watcher's own.
+        """
+        delay = (backoff or self._backoff).next_delay()
+        _log.info("Retrying in %.1fs", delay)
+        gevent.sleep(delay)
+        if exc is not None and _is_connection_failure(exc):
+            self._reconnect()
+
+    def _ensure_client(self):
+        if self.client is None:
+            self._reconnect()
+
     def _reconnect(self):
         _log.info("(Re)connecting to etcd...")
         etcd_addr = self.config.ETCD_ADDR
@@ -122,77 +245,298 @@ class EtcdWatcher(Actor):
         Loads the snapshot from etcd and then monitors etcd for changes.
         Posts events to the UpdateSplitter.
 
+        Each of the subtrees in WATCHED_STREAMS is polled by its own
+        greenlet, from its own etcd index.  If one of them falls behind,
+        or sees an unexpected event, we resync only that subtree.  We only
+        resync everything if the ready flag is cleared or the etcd cluster
+        changes.
+
         :returns: Does not return.
         """
+        # Events from all the pollers, in a bounded queue so that the
+        # pollers stop polling if we fall behind.
+        events = Queue(maxsize=MAX_QUEUED_EVENTS)
+        idle_checker = gevent.spawn(self._check_idle_streams)
+        try:
+            while True:
+                self._stop_pollers()
+                _log.info("Loading snapshot from etcd...")
+                self._ensure_client()
+                next_indexes = self._load_snapshot(update_splitter)
+                for stream, next_index in next_indexes.iteritems():
+                    self._start_poller(stream, next_index, events)
+
+                resync_all = False
+                while not resync_all:
+                    # Block for the first event then take as many as are
+                    # queued.
+                    batch = [events.get()]
+                    while not events.empty():
+                        batch.append(events.get_nowait())
+                    resync_streams = self._dispatch_events(batch,
+                                                           update_splitter)
+                    resync_all = (self._full_resync_needed or
+                                  "ready" in resync_streams)
+                    if resync_streams and not resync_all:
+                        for stream in resync_streams:
+                            self._resync_stream(stream, update_splitter,
+                                                events)
+        finally:
+            idle_checker.kill()
+            self._stop_pollers()
+
+    def _load_snapshot(self, update_splitter):
+        """
+        Loads all the subtrees that we watch from etcd and passes them to
+        the UpdateSplitter.  Sends a complete snapshot the first time, or
+        if the etcd cluster has changed; otherwise only the differences
+        from what we already know.
+
+        :returns dict[str,int]: the etcd index to start polling each
+            stream from.
+        """
+        # Start polling the ready flag from the index at which we saw it
+        # set; if it gets cleared after that then we'll resync again.
+        ready_index = self.wait_for_ready()
+        profiles_index, profile_nodes = self._read_subtree(PROFILE_DIR)
+        hosts_index, host_nodes = self._read_subtree(HOST_DIR)
+        config_index, _ = self._read_subtree(CONFIG_DIR)
+        nodes = profile_nodes + host_nodes
+        etcd_index = max(profiles_index, hosts_index)
+        if self._known_nodes is not None:
+            # We may have missed config changes while we weren't polling.
+            self._reload_config(update_splitter)
+        if self._known_nodes is None or self._full_resync_needed:
+            self._apply_snapshot(etcd_index, nodes, update_splitter)
+        else:
+            # We've already applied a snapshot, only send the changes.
+            self._apply_snapshot_delta(etcd_index, nodes,
+                                       ["profiles", "hosts"],
+                                       update_splitter)
+        # On first call, the etcd_index seems to be the high-water mark
+        # for the data returned whereas the modified index just tells us
+        # when the key was modified.
+        return {
+            "ready": ready_index + 1,
+            "config": config_index + 1,
+            "profiles": profiles_index + 1,
+            "hosts": hosts_index + 1,
+        }
+
+    def _resync_stream(self, stream, update_splitter, events):
+        """
+        Restarts polling of a single stream, after reloading its subtree
+        and sending the differences to the UpdateSplitter.
+        """
+        _log.warning("Resyncing %s from etcd", stream)
+        self._stop_pollers([stream])
+        etcd_index, nodes = self._read_subtree(WATCHED_STREAMS[stream])
+        if stream != "config":
+            self._apply_snapshot_delta(etcd_index, nodes, [stream],
+                                       update_splitter)
+        if stream in ("config", "hosts"):
+            # The hosts stream includes our per-host config.
+            self._reload_config(update_splitter)
+        self._start_poller(stream, etcd_index + 1, events)
+
+    def _read_subtree(self, prefix):
+        """
+        Reads a subtree from etcd, recursively.
+
+        :returns: tuple of the etcd index of the read and a list of the
+            leaf nodes, which is empty if the subtree doesn't exist.
+        """
+        try:
+            dump = self.client.read(prefix, recursive=True)
+        except EtcdKeyNotFound:
+            # Get the current index and then check that the subtree still
+            # doesn't exist, in case it was created before that index.
+            etcd_index = self.client.read(VERSION_DIR).etcd_index
+            try:
+                dump = self.client.read(prefix, recursive=True)
+            except EtcdKeyNotFound:
+                _log.info("%s doesn't exist in etcd yet", prefix)
+                return etcd_index, []
+        return dump.etcd_index, list(dump.children)
+
+    def _stream_for_key(self, key):
+        """
+        :returns: the name of the stream that delivers updates to the
+            given key.
+        """
+        for stream, prefix in WATCHED_STREAMS.iteritems():
+            if key.startswith(prefix):
+                return stream
+        return None
+
+    def _check_idle_streams(self):
+        """
+        Runs in its own greenlet.  The pollers only tell the
+        ConvergenceTracker how far they've read when they get an update,
+        so an idle stream would hold back the applied-through index.
+        While someone is waiting for an index that a stream hasn't been
+        read through, checks whether that stream has any updates up to the
+        current etcd index and, if not, tells the ConvergenceTracker.
+        """
         while True:
-            _log.info("Reconnecting and loading snapshot from etcd...")
-            self._reconnect()
-            self.wait_for_ready()
+            lagging = self.convergence_tracker.wait_for_lagging_streams()
+            if lagging:
+                try:
+                    etcd_index = self.client.read(VERSION_DIR).etcd_index
+                except EtcdException:
+                    # The pollers will report any real problem.
+                    _log.debug("Failed to read etcd index, will retry.")
+                else:
+                    gevent.joinall([
+                        gevent.spawn(self._check_stream_idle, stream,
+                                     read_through + 1, etcd_index)
+                        for stream, read_through in lagging.iteritems()
+                        if read_through < etcd_index
+                    ])
+            # Only check again once the tracker has had a chance to catch
+            # up.
+            gevent.sleep(IDLE_CHECK_TIMEOUT)
+
+    def _check_stream_idle(self, stream, wait_index, etcd_index):
+        """
+        Tells the ConvergenceTracker that the stream has been read through
+        etcd_index if it has no updates from wait_index to etcd_index.
+        Any such updates are already in etcd's history so a poll from
+        wait_index returns them straight away; if it times out, there are
+        none.
+        """
+        try:
+            self.client.read(WATCHED_STREAMS[stream],
+                             wait=True,
+                             waitIndex=wait_index,
+                             recursive=True,
+                             timeout=Timeout(connect=10,
+                                             read=IDLE_CHECK_TIMEOUT),
+                             check_cluster_id=True)
+        except ReadTimeoutError:
+            _log.debug("%s has no updates up to etcd index %s", stream,
+                       etcd_index)
+            self.convergence_tracker.on_streams_confirmed(
+                {stream: etcd_index}, async=True)
+        except EtcdException:
+            # The stream's poller deals with errors.
+            _log.debug("Failed to check whether %s is idle", stream)
+        else:
+            _log.debug("%s has an update on its way", stream)
 
-            # Load initial dump from etcd.  First just get all the endpoints
-            # and profiles by id.  The response contains a generation ID
-            # allowing us to then start polling for updates without missing
-            # any.
-            initial_dump = self.client.read(VERSION_DIR, recursive=True)
-            _log.info("Loaded snapshot, parsing it...")
-            rules_by_id = {}
-            tags_by_id = {}
-            endpoints_by_id = {}
-            still_ready = False
-            for child in initial_dump.children:
-                profile_id, rules = parse_if_rules(child)
-                if profile_id:
-                    rules_by_id[profile_id] = rules
-                    continue
-                profile_id, tags = parse_if_tags(child)
-                if profile_id:
-                    tags_by_id[profile_id] = tags
-                    continue
-                endpoint_id, endpoint = parse_if_endpoint(self.config, child)
-                if endpoint_id and endpoint:
-                    endpoints_by_id[endpoint_id] = endpoint
-                    continue
+    def _start_poller(self, stream, next_etcd_index, events):
+        # We've passed everything before next_etcd_index to the splitter.
+        self.convergence_tracker.on_streams_confirmed(
+            {stream: next_etcd_index - 1}, async=True)
+        self._pollers[stream] = gevent.spawn(self._poll_etcd, stream,
+                                             next_etcd_index, events)
 
-                # Double-check the flag hasn't changed since we read it before.
-                if child.key == READY_KEY:
-                    if child.value == "true":
-                        still_ready = True
-                    else:
-                        _log.warning("Aborting resync because ready flag was"
-                                     "unset since we read it.")
-                        continue
+    def _stop_pollers(self, streams=None):
+        """
+        Kills the pollers for the given streams, or for all streams.  Any
+        events that they've already queued are discarded when we see
+        them.
+        """
+        for stream in list(streams or self._pollers):
+            poller = self._pollers.pop(stream, None)
+            if poller is not None:
+                poller.kill()
 
-            if not still_ready:
-                _log.warn("Aborting resync; ready flag no longer present.")
+    def _apply_snapshot(self, etcd_index, nodes, update_splitter):
+        """
+        Passes a complete snapshot from etcd to the UpdateSplitter and
+        records the modifiedIndex of each node for _apply_snapshot_delta().
+        """
+        _log.info("Loaded snapshot, parsing it...")
+        rules_by_id = {}
+        tags_by_id = {}
+        endpoints_by_id = {}
+        known_nodes = {}
+        for child in nodes:
+            update = self._parse_node(child)
+            if update is None:
                 continue
-
-            # Actually apply the snapshot. This does not return anything, but
-            # just sends the relevant messages to the relevant threads to make
-            # all the processing occur.
-            _log.info("Snapshot parsed, passing to update splitter")
+            update_type, obj_id, value = update
+            known_nodes[child.key] = (child.modifiedIndex, update_type,
+                                      obj_id)
+            if update_type == "rules":
+                rules_by_id[obj_id] = value
+            elif update_type == "tags":
+                tags_by_id[obj_id] = value
+            elif value:
+                endpoints_by_id[obj_id] = value
+
+        # Actually apply the snapshot. This does not return anything, but
+        # just sends the relevant messages to the relevant threads to make
+        # all the processing occur.
+        _log.info("Snapshot parsed, passing to update splitter")
+        with self.convergence_tracker.track_indexes([etcd_index],
+                                                    "snapshot"):
             update_splitter.apply_snapshot(rules_by_id,
                                            tags_by_id,
                                            endpoints_by_id,
                                            async=False)
+        self._known_nodes = known_nodes
+        self._full_resync_needed = False
 
-            # These read only objects are no longer required, so tidy them up.
-            del rules_by_id
-            del tags_by_id
-            del endpoints_by_id
-
-            # On first call, the etcd_index seems to be the high-water mark
-            # for the data returned whereas the modified index just tells us
-            # when the key was modified.
-            _log.info("Starting polling for updates from etcd.  Initial etcd "
-                      "index: %s.", initial_dump.etcd_index)
-            next_etcd_index = initial_dump.etcd_index + 1
-            del initial_dump
-            continue_polling = True
-            while continue_polling:
+    def _apply_snapshot_delta(self, etcd_index, nodes, streams,
+                              update_splitter):
+        """
+        Compares a snapshot of the given streams from etcd against the
+        nodes that we know about.  Passes only the nodes that have been
+        created, changed or deleted to the UpdateSplitter, as normal
+        updates.  Nodes whose modifiedIndex hasn't changed aren't even
+        parsed.
+        """
+        _log.info("Loaded snapshot of %s, comparing it with our state...",
+                  ", ".join(streams))
+        seen_keys = set()
+        updates = []
+        for child in nodes:
+            if self._stream_for_key(child.key) not in streams:
+                continue
+            seen_keys.add(child.key)
+            known = self._known_nodes.get(child.key)
+            if known is not None and known[0] == child.modifiedIndex:
+                continue
+            update = self._parse_node(child)
+            if update is None:
+                continue
+            update_type, obj_id, _ = update
+            self._known_nodes[child.key] = (child.modifiedIndex,
+                                            update_type, obj_id)
+            updates.append(update)
+
+        num_changed = len(updates)
+        for key, (_, update_type, obj_id) in self._known_nodes.items():
+            if (key not in seen_keys and
+                    self._stream_for_key(key) in streams):
+                del self._known_nodes[key]
+                updates.append((update_type, obj_id, None))
+        _log.info("Resync found %s created/changed and %s deleted items",
+                  num_changed, len(updates) - num_changed)
+        with self.convergence_tracker.track_indexes([etcd_index],
+                                                    "resync"):
+            if updates:
+                update_splitter.on_updates(updates, async=False)
+
+    def _poll_etcd(self, stream, next_etcd_index, events):
+        """
+        Runs in its own greenlet.  Polls etcd for updates to the given
+        stream, starting at the given index, and puts
+        (stream, poller, time received, response) tuples onto the events
+        queue.  If the stream needs a resync, puts an event with response
+        None onto the queue and returns.
+        """
+        prefix = WATCHED_STREAMS[stream]
+        poller = gevent.getcurrent()
+        backoff = Backoff(INITIAL_RETRY_DELAY, MAX_RETRY_DELAY)
+        try:
+            while True:
                 try:
-                    _log.debug("About to wait for etcd update %s",
-                               next_etcd_index)
-                    response = self.client.read(VERSION_DIR,
+                    _log.debug("About to wait for etcd update %s to %s",
+                               next_etcd_index, prefix)
+                    response = self.client.read(prefix,
                                                 wait=True,
                                                 waitIndex=next_etcd_index,
                                                 recursive=True,
@@ -202,24 +546,29 @@ class EtcdWatcher(Actor):
                     _log.debug("etcd response: %r", response)
                 except ReadTimeoutError:
                     # This is expected when we're doing a poll and nothing
-                    # happened.
+                    # happened.  The client's connection pool will open a
+                    # new connection for the next poll.
                     _log.debug("Read from etcd timed out, retrying.")
-                    self._reconnect()
                     continue
                 except EtcdClusterIdChanged:
                     _log.error("Etcd cluster ID changed, reconnecting for "
                                "full resync...")
-                    continue_polling = False
-                    continue
+                    # The client remembers the old cluster ID.
+                    self._reconnect()
+                    # The modifiedIndexes that we know are from the old
+                    # cluster so we can't compare them with the new ones.
+                    self._full_resync_needed = True
+                    break
                 except EtcdException as e:
                     # Sadly, python-etcd doesn't have a clean exception
                     # hierarchy; look at the message.  We only log the stack
                     # trace for errors we're not expecting to avoid copious
                     # log spam.
                     msg = (e.message or "unknown").lower()
-                    if "no more machines" in msg:
+                    resync = False
+                    if _is_connection_failure(e):
                         # This error comes from python-etcd when it can't
-                        # connect to any servers.  When we retry, it should
+                        # connect to any servers.  When we retry, we
                         # reconnect.
                         # TODO: We should probably limit retries here and die
                         # That'd recover from errors caused by resource
@@ -227,83 +576,159 @@ class EtcdWatcher(Actor):
                         _log.error("Connection to etcd failed, will retry.")
                     elif "requested index is outdated" in msg:
                         # Error from etcd itself, this is fatal for our event
-                        # poll, we have to do a full resync.
-                        _log.error("Fell too far behind current etcd index, "
-                                   "triggering a full resync.")
-                        continue_polling = False
+                        # poll, we have to resync this stream.
+                        _log.error("Fell too far behind current etcd index "
+                                   "for %s, triggering a resync.", stream)
+                        resync = True
                     else:
                         # Assume any other errors are fatal.
                         _log.exception("Unknown etcd error %r; doing resync.",
                                        e.message)
-                        continue_polling = False
-                    # TODO: should we do a backoff here?
-                    gevent.sleep(1)
-                    self._reconnect()
+                        resync = True
+                    self._retry_after_error(e, backoff)
+                    if resync:
+                        break
                     continue
+                backoff.reset()
 
                 # Since we're polling on a subtree, we can't just increment
                 # the index, we have to look at the modifiedIndex to spot if
                 # we've skipped a lot of updates.
                 next_etcd_index = max(next_etcd_index,
                                       response.modifiedIndex) + 1
+                # Blocks if the queue is full, until we've caught up.
+                events.put((stream, poller, time.time(), response))
+        except Exception:
+            _log.exception("Unexpected failure polling etcd; doing resync.")
+        events.put((stream, poller, time.time(), None))
 
-                if response.action == "delete":
-                    # Handle expected directory deletions by faking events for
-                    # child nodes.
-                    profile_id = get_profile_id_for_profile_dir(response.key)
-                    if profile_id:
-                        _log.info("Delete for whole profile %s", profile_id)
-                        update_splitter.on_rules_update(profile_id, None,
-                                                        async=False)
-                        update_splitter.on_tags_update(profile_id, None,
-                                                       async=False)
-                        continue
-                    # TODO: Do we need to handle workload deletions?
-
-                profile_id, rules = parse_if_rules(response)
-                if profile_id:
-                    _log.info("Scheduling profile update %s", profile_id)
-                    update_splitter.on_rules_update(profile_id, rules,
-                                                    async=False)
-                    continue
-                profile_id, tags = parse_if_tags(response)
-                if profile_id:
-                    _log.info("Scheduling tags update %s", profile_id)
-                    update_splitter.on_tags_update(profile_id, tags,
-                                                   async=False)
-                    continue
-                endpoint_id, endpoint = parse_if_endpoint(self.config,
-                                                          response)
-                if endpoint_id:
-                    _log.info("Scheduling endpoint update %s", endpoint_id)
-                    update_splitter.on_endpoint_update(endpoint_id, endpoint,
-                                                       async=False)
-                    continue
+    def _dispatch_events(self, batch, update_splitter):
+        """
+        Passes a batch of events from the poller greenlets to the
+        UpdateSplitter as a single message.
 
-                if response.key == READY_KEY:
-                    if response.value != "true":
-                        _log.warning("DB became unready, triggering a resync")
-                        continue_polling = False
-                    continue
+        :returns set[str]: the streams that need a resync.
+        """
+        updates = []
+        etcd_indexes = []
+        # Map from stream to the etcd index that we've now read it
+        # through.
+        read_through = {}
+        resync_streams = set()
+        start_time = None
+        config_changed = False
+        for stream, poller, recv_time, response in batch:
+            if self._pollers.get(stream) is not poller:
+                # Queued before we restarted the stream, its resync will
+                # have picked up the change.
+                continue
+            if stream in resync_streams:
+                continue
+            if response is None:
+                # The poller has stopped.
+                resync_streams.add(stream)
+                continue
+            if start_time is None:
+                start_time = recv_time
+            etcd_indexes.append(response.modifiedIndex)
+            if (response.key.startswith(CONFIG_DIR) or
+                    response.key.startswith(self.my_config_dir)):
+                # Reload the config once, after the rest of the batch.
+                config_changed = True
+            elif not self._parse_update(response, updates):
+                resync_streams.add(stream)
+                continue
+            read_through[stream] = max(read_through.get(stream),
+                                       response.modifiedIndex)
+        if etcd_indexes:
+            # Latency is measured from when we received the oldest event in
+            # the batch.  Track the work that the updates trigger so that we
+            # can tell when they're live in the dataplane.
+            with self.convergence_tracker.track_indexes(sorted(etcd_indexes),
+                                                        "update",
+                                                        start_time):
+                if updates:
+                    update_splitter.on_updates(updates, async=False)
+                if config_changed:
+                    self._reload_config(update_splitter)
+        if read_through:
+            # After track_indexes() so that the tracker knows about the
+            # updates before it counts them as read.
+            self.convergence_tracker.on_streams_confirmed(read_through,
+                                                          async=True)
+        return resync_streams
+
+    def _parse_update(self, response, updates):
+        """
+        Parses an update from etcd, appending the resulting
+        (update type, ID, value) tuples to updates.
 
-                _log.debug("Response action: %s, key: %s",
-                           response.action, response.key)
-                if (response.action not in ("set", "create") and
-                        any((response.key.startswith(pfx) for pfx in
-                             PREFIXES_TO_RESYNC_ON_CHANGE))):
-                    # It's purpose is to catch deletions of whole directories
-                    # or other operations that we're not expecting.
-                    _log.warning("Unexpected event: %s; triggering resync.",
-                                 response)
-                    continue_polling = False
-                if response.key.startswith(CONFIG_DIR):
-                    _log.warning("Global config changed but we don't "
-                                 "yet support dynamic config: %s",
-                                 response)
-                if response.key.startswith(self.my_config_dir):
-                    _log.warning("Config for this felix changed but we don't "
-                                 "yet support dynamic config: %s",
-                                 response)
+        :returns: False if the update means that we need to resync.
+        """
+        if response.action == "delete":
+            # Handle expected directory deletions by faking events for
+            # child nodes.
+            profile_id = get_profile_id_for_profile_dir(response.key)
+            if profile_id:
+                _log.info("Delete for whole profile %s", profile_id)
+                updates.append(("rules", profile_id, None))
+                updates.append(("tags", profile_id, None))
+                prefix = response.key.rstrip("/") + "/"
+                for key in [k for k in self._known_nodes
+                            if k.startswith(prefix)]:
+                    del self._known_nodes[key]
+                return True
+            # TODO: Do we need to handle workload deletions?
+
+        update = self._parse_node(response)
+        if update is not None:
+            update_type, obj_id, _ = update
+            _log.info("Scheduling %s update %s", update_type, obj_id)
+            updates.append(update)
+            # Keep our record of the nodes up to date for the next resync.
+            if response.action == "delete":
+                self._known_nodes.pop(response.key, None)
+            else:
+                self._known_nodes[response.key] = (response.modifiedIndex,
+                                                   update_type, obj_id)
+            return True
+
+        if response.key == READY_KEY:
+            if response.value != "true":
+                _log.warning("DB became unready, triggering a resync")
+                return False
+            return True
+
+        _log.debug("Response action: %s, key: %s",
+                   response.action, response.key)
+        resync = False
+        if (response.action not in ("set", "create") and
+                any((response.key.startswith(pfx) for pfx in
+                     PREFIXES_TO_RESYNC_ON_CHANGE))):
+            # It's purpose is to catch deletions of whole directories
+            # or other operations that we're not expecting.
+            _log.warning("Unexpected event: %s; triggering resync.",
+                         response)
+            resync = True
+        return not resync
+
+    def _parse_node(self, node):
+        """
+        :returns: (update type, ID, value) tuple for an etcd node that
+            holds the rules or tags of a profile or an endpoint, or None
+            for any other node.  The value is None if the node was deleted
+            or failed validation.
+        """
+        profile_id, rules = parse_if_rules(node)
+        if profile_id:
+            return "rules", profile_id, rules
+        profile_id, tags = parse_if_tags(node)
+        if profile_id:
+            return "tags", profile_id, tags
+        endpoint_id, endpoint = parse_if_endpoint(self.config, node)
+        if endpoint_id:
+            return "endpoint", endpoint_id, endpoint
+        return None
 
     def _load_config_dict(self):
         """
@@ -334,12 +759,58 @@ class EtcdWatcher(Actor):
 
         return config_dict
 
+def _is_connection_failure(exc):
+    """
+    :returns: True if the EtcdException is python-etcd's report that it
+        couldn't connect to any etcd server.
+    """
+    return "no more machines" in (exc.message or "").lower()
+
+
 # Intern JSON keys as we load them to reduce occupancy.
 def intern_dict(d):
     return dict((intern(str(k)), v) for k, v in d.iteritems())
 json_decoder = json.JSONDecoder(object_hook=intern_dict)
 
 
+def _decode_and_validate(kind, raw_value, validate):
+    """
+    Decodes a JSON value from etcd and validates it with validate().
+
+    Resyncs see the same values again and many profiles share identical
+    rules, so the results, including failures, are cached by the raw
+    value.  Repeated values skip decoding and validation entirely.
+
+    :param kind: hashable description of the type of value and anything
+        else that affects its validation.
+    :returns: the decoded value.  It may be shared with other callers so
+        it must not be modified.
+    :raises ValidationFailed: if the value is invalid.
+    """
+    cache_key = (kind, raw_value)
+    result = _validation_cache.get(cache_key)
+    if result is None:
+        value = json_decoder.decode(raw_value)
+        try:
+            validate(value)
+        except ValidationFailed as e:
+            result = (None, e)
+        else:
+            result = (value, None)
+        _validation_cache.put(cache_key, result)
+    value, error = result
+    if error is not None:
+        raise error
+    return value
+
+
+def validation_cache_stats():
+    """
+    :returns: dict of hit/miss/eviction statistics for the validation cache.
+    """
+    return _validation_cache.stats()
+
+
 def parse_if_endpoint(config, etcd_node):
     m = ENDPOINT_KEY_RE.match(etcd_node.key)
     if m:
@@ -350,13 +821,17 @@ def parse_if_endpoint(config, etcd_node):
             _log.debug("Found deleted endpoint %s", endpoint_id)
         else:
             hostname = m.group("hostname")
-            endpoint = json_decoder.decode(etcd_node.value)
             try:
-                validate_endpoint(config, endpoint)
+                endpoint = _decode_and_validate(
+                    ("endpoint", config.IFACE_PREFIX), etcd_node.value,
+                    functools.partial(validate_endpoint, config))
             except ValidationFailed as e:
                 _log.warning("Validation failed for endpoint %s, treating as "
                              "missing: %s", endpoint_id, e.message)
                 return endpoint_id, None
+            # Copy before adding the per-key fields; the cached value may be
+            # shared.
+            endpoint = dict(endpoint)
             endpoint["host"] = hostname
             endpoint["id"] = endpoint_id
             _log.debug("Found endpoint : %s", endpoint)
@@ -429,14 +904,17 @@ def parse_if_rules(etcd_node):
         if etcd_node.action == "delete":
             rules = None
         else:
-            rules = json_decoder.decode(etcd_node.value)
-            rules["id"] = profile_id
             try:
-                validate_rules(rules)
+                rules = _decode_and_validate("rules", etcd_node.value,
+                                             validate_rules)
             except ValidationFailed:
                 _log.exception("Validation failed for profile %s rules: %s",
-                               profile_id, rules)
+                               profile_id, etcd_node.value)
                 return profile_id, None
+            # Copy before adding the ID; profiles often have identical
+            # rules so the cached value may be shared.
+            rules = dict(rules)
+            rules["id"] = profile_id
 
         _log.debug("Found rules for profile %s : %s", profile_id, rules)
 
@@ -565,12 +1043,12 @@ def parse_if_tags(etcd_node):
         if etcd_node.action == "delete":
             tags = None
         else:
-            tags = json_decoder.decode(etcd_node.value)
             try:
-                validate_tags(tags)
+                tags = _decode_and_validate("tags", etcd_node.value,
+                                            validate_tags)
             except ValidationFailed:
                 _log.exception("Validation failed for profile %s tags : %s",
-                               profile_id, tags)
+                               profile_id, etcd_node.value)
                 return profile_id, None
 
         _log.debug("Found tags for profile %s : %s", profile_id, tags)
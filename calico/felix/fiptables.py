@@ -20,6 +20,7 @@ IP tables management functions.
 """
 from collections import defaultdict
 import copy
+import hashlib
 import logging
 import random
 from subprocess import CalledProcessError
@@ -42,6 +43,7 @@ _log = logging.getLogger(__name__)
 _correlators = ("ipt-%s" % ii for ii in itertools.count())
 MAX_IPT_RETRIES = 10
 MAX_IPT_BACKOFF = 0.2
+DIGEST_COMMENT_PREFIX = "felix-hash:"
 
 
 class IptablesUpdater(Actor):
@@ -92,6 +94,20 @@ class IptablesUpdater(Actor):
     * If a required chain is deleted, it is rewritten as a stub chain.
       It is then cleaned up when it is no longer required.
 
+    Skipping unchanged chains
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    We record a digest of the contents of each chain that we write, both
+    in memory and in a comment on the first rule of the chain.  Chains
+    whose digest matches the programmed one are not rewritten.  At start
+    of day, the digests are loaded from the dataplane so that, after a
+    restart, the first snapshot only rewrites the chains that really
+    changed.
+
+    We also keep the contents of the chains that we've programmed so that
+    reconcile() can repair any chains that have been modified by another
+    tool.
+
     """
 
     queue_size = 1000
@@ -102,10 +118,12 @@ class IptablesUpdater(Actor):
         self.table = table
         if ip_version == 4:
             self.restore_cmd = "iptables-restore"
+            self.save_cmd = "iptables-save"
             self.iptables_cmd = "iptables"
         else:
             assert ip_version == 6
             self.restore_cmd = "ip6tables-restore"
+            self.save_cmd = "ip6tables-save"
             self.iptables_cmd = "ip6tables"
 
         self.explicitly_prog_chains = set()
@@ -116,6 +134,20 @@ class IptablesUpdater(Actor):
         self.requiring_chains = defaultdict(set)
         """Map from chain to the set of chains that depend on it.
         Inverse of self.required_chains."""
+        self.programmed_digests = None
+        """Map from chain name to the digest of its contents in the
+        dataplane.  None until the start of the first batch."""
+        self._existing_chain_state = None
+        """Map from chain name to (digest, number of rules) for the chains
+        that we found in the dataplane at start of day, for example, from
+        a previous run of Felix, and haven't written since."""
+        self.programmed_updates = {}
+        """Map from chain name to the update lines that we last wrote to
+        it.  Used to repair the chain if it drifts."""
+        self.inserted_rules = set()
+        """Set of rule fragments that we've inserted into the kernel's
+        chains with ensure_rule_inserted().  Used to reinsert them if
+        they're removed."""
 
         # State tracking for the current batch.
         self._batch = None
@@ -123,6 +155,11 @@ class IptablesUpdater(Actor):
         batch."""
         self._completion_callbacks = None
         """List of callbacks to issue once the current batch completes."""
+        self._batch_digests = None
+        """Map from chain name to digest for the chains in this batch."""
+        self._batch_updates = None
+        """Map from chain name to update lines for the chains in this
+        batch."""
 
         self._reset_batched_work()  # Avoid duplicating init logic.
 
@@ -132,15 +169,105 @@ class IptablesUpdater(Actor):
                                   self.required_chains,
                                   self.requiring_chains)
         self._completion_callbacks = []
+        self._batch_digests = {}
+        self._batch_updates = {}
 
-    def _load_unreferenced_chains(self):
+    def _load_chain_graph(self):
+        """
+        :returns dict[str,set[str]]: map from the name of each chain
+            currently in the dataplane to the set of targets that it
+            jumps to.
         """
-        :returns list[str]: list of chains currently in the dataplane that
-            are not referenced by other chains.
+        raw_save_output = subprocess.check_output(
+            [self.save_cmd, "--table", self.table])
+        return extract_chain_graph(raw_save_output)
+
+    def _load_existing_chain_state(self):
         """
-        raw_ipt_output = subprocess.check_output(
-            [self.iptables_cmd, "--wait", "--list", "--table", self.table])
-        return extract_unreffed_chains(raw_ipt_output)
+        Loads the state of the chains that are already in the dataplane,
+        for example from a previous run of Felix.  Chains whose state
+        doesn't match what we want will be rewritten in full.
+
+        :returns dict[str,tuple[str,int]]: map from chain name to (digest,
+            number of rules).
+        """
+        try:
+            state = self._load_chain_state()
+        except CalledProcessError:
+            _log.exception("Failed to load existing %s chains, will rewrite "
+                           "all chains.", self.table)
+            return {}
+        _log.info("Found %s existing chains in %s table", len(state),
+                  self.table)
+        return state
+
+    def _load_chain_state(self):
+        """
+        :returns dict[str,tuple[str,int]]: map from chain name to (digest,
+            number of rules) for the chains currently in the dataplane.
+        """
+        raw_save_output = subprocess.check_output(
+            [self.save_cmd, "--table", self.table])
+        return extract_chain_state(raw_save_output)
+
+    @actor_message()
+    def read_rule_counters(self, chain_prefixes):
+        """
+        Reads the per-rule packet counters for all the chains with the
+        given prefixes in one pass.  Since we're an actor, this can't race
+        with our own updates.
+
+        :param tuple[str] chain_prefixes: prefixes of the chains to read.
+        :returns dict[str,list[int]]: map from chain name to the packet
+            count for each rule in the chain, in order.
+        """
+        raw_save_output = subprocess.check_output(
+            [self.save_cmd, "--counters", "--table", self.table])
+        return extract_rule_counters(raw_save_output, chain_prefixes)
+
+    # Writes directly to the table, forbid batching with other messages.
+    @actor_message(needs_own_batch=True)
+    def reconcile(self):
+        """
+        Compares the chains that we've programmed against a single dump
+        of the table and rewrites any that have drifted, for example,
+        because another tool has flushed or modified them.
+
+        Then checks that the rules that we've inserted into the kernel's
+        chains, without which our chains are unreachable, are still
+        present and reinserts any that aren't.
+
+        :returns int: the number of chains that were rewritten plus the
+            number of rules that were reinserted.
+        """
+        dataplane_state = self._load_chain_state()
+        drifted = {}
+        for chain, updates in self.programmed_updates.iteritems():
+            expected = _chain_state(self.programmed_digests[chain], updates)
+            if dataplane_state.get(chain) != expected:
+                drifted[chain] = updates
+        if drifted:
+            _log.warning("Chains in %s table have drifted, rewriting: %s",
+                         self.table, sorted(drifted.keys()))
+            self._execute_iptables(self._calculate_rewrite_input(drifted))
+
+        missing = []
+        if self.inserted_rules:
+            graph = self._load_chain_graph()
+            for rule_fragment in sorted(self.inserted_rules):
+                chain = rule_fragment.split()[0]
+                target = re.search(r'--(?:jump|goto) (\S+)',
+                                   rule_fragment).group(1)
+                if target not in graph.get(chain, ()):
+                    missing.append(rule_fragment)
+        for rule_fragment in missing:
+            _log.warning("Rule %r missing from %s table, reinserting.",
+                         rule_fragment, self.table)
+            self._insert_rule(rule_fragment)
+
+        if not drifted and not missing:
+            _log.info("No drift found in %s table", self.table)
+        return len(drifted) + len(missing)
 
     @actor_message()
     def rewrite_chains(self, update_calls_by_chain,
@@ -181,7 +308,14 @@ class IptablesUpdater(Actor):
         insert a rule into the pre-existing kernel chains.  Most code
         should use the more robust approach of rewriting the whole chain
         using rewrite_chains().
+
+        The rule is remembered so that reconcile() can reinsert it if it
+        is removed.  It must contain a --jump or --goto.
         """
+        self._insert_rule(rule_fragment)
+        self.inserted_rules.add(rule_fragment)
+
+    def _insert_rule(self, rule_fragment):
         try:
             # Make an atomic delete + insert of the rule.  If the rule already
             # exists then this will have no effect.
@@ -216,30 +350,32 @@ class IptablesUpdater(Actor):
         are no longer required.
         """
         _log.info("Cleaning up left-over iptables state.")
-        chains_we_tried_to_delete = set()
-        finished = False
-        while not finished:
-            # Try to delete all the unreferenced chains, we use a loop to
-            # ensure that we then clean up any chains that become unreferenced
-            # when we delete the previous lot.
-            unreferenced_chains = self._load_unreferenced_chains()
-            orphans = (unreferenced_chains -
-                       self.explicitly_prog_chains -
-                       set(self.requiring_chains.keys()))
-            our_orphans = [c for c in orphans if c.startswith(FELIX_PREFIX)]
-            if not chains_we_tried_to_delete.issuperset(our_orphans):
-                _log.info("Cleanup found these unreferenced chains to "
-                          "delete: %s", our_orphans)
-                chains_we_tried_to_delete.update(our_orphans)
-                self._delete_best_effort(our_orphans)
-            else:
-                # We've already tried to delete all the chains we found,
-                # give up.
-                _log.info("Cleanup finished, deleted %s chains, failed to "
-                          "delete these chains: %s",
-                          len(chains_we_tried_to_delete) - len(our_orphans),
-                          our_orphans)
-                finished = True
+        start = time.time()
+        graph = self._load_chain_graph()
+        # Our chains are only in use if they can be reached from a chain
+        # that we don't own or from a chain that we still need.  This
+        # catches chains that are only referenced by other orphans, which
+        # may themselves be referenced by orphans, and so on.
+        chains_we_need = ((self.explicitly_prog_chains |
+                           set(self.requiring_chains.keys())) &
+                          set(graph.keys()))
+        roots = set(c for c in graph if not c.startswith(FELIX_PREFIX))
+        reachable = _reachable_chains(graph, roots | chains_we_need)
+        orphans = set(graph.keys()) - reachable
+        if not orphans:
+            _log.info("Cleanup found no chains to delete")
+            return
+        _log.info("Cleanup found these unreachable chains to delete: %s",
+                  sorted(orphans))
+        try:
+            self._attempt_delete(orphans)
+        except (CalledProcessError, IOError, FailedSystemCall):
+            # Maybe a chain has been referenced since we read the table,
+            # narrow down which chains we can delete.
+            _log.warning("Failed to delete all unreachable chains at once, "
+                         "retrying in smaller batches.")
+            self._delete_best_effort(orphans)
+        _log.info("Cleanup finished in %.2fs", time.time() - start)
 
     def _start_msg_batch(self, batch):
         self._reset_batched_work()
@@ -326,6 +462,11 @@ class IptablesUpdater(Actor):
     def _attempt_delete(self, chains):
         input_lines = self._calculate_ipt_delete_input(chains)
         self._execute_iptables(input_lines)
+        for chain in chains:
+            self.programmed_updates.pop(chain, None)
+            if self.programmed_digests is not None:
+                self.programmed_digests.pop(chain, None)
+                self._existing_chain_state.pop(chain, None)
 
     def _update_indexes(self):
         """
@@ -335,6 +476,39 @@ class IptablesUpdater(Actor):
         self.explicitly_prog_chains = self._batch.expl_prog_chains
         self.required_chains = self._batch.required_chns
         self.requiring_chains = self._batch.requiring_chns
+        self.programmed_digests.update(self._batch_digests)
+        self.programmed_updates.update(self._batch_updates)
+
+    def _calculate_chain_writes(self):
+        """
+        Calculates the contents of the chains that need to be written in
+        this batch, skipping chains whose contents are already programmed.
+
+        :returns dict[str,list[str]]: map from chain name to the update
+            lines for that chain.
+        """
+        if self.programmed_digests is None:
+            self.programmed_digests = {}
+            self._existing_chain_state = self._load_existing_chain_state()
+        writes = {}
+        for chain_name in (self._batch.chains_to_stub_out |
+                           self._batch.chains_to_delete):
+            writes[chain_name] = _stub_drop_rules(chain_name)
+        writes.update(self._batch.updates)
+        assert set(writes.keys()) == self._batch.affected_chains
+        for chain_name, chain_updates in writes.items():
+            digest = chain_digest(chain_updates)
+            self._batch_digests[chain_name] = digest
+            self._batch_updates[chain_name] = chain_updates
+            # Only trust the state that we found at start of day the first
+            # time that we write each chain.  Like reconcile(), check the
+            # rule count as well as the digest on the first rule.
+            existing = self._existing_chain_state.pop(chain_name, None)
+            if (self.programmed_digests.get(chain_name) == digest or
+                    existing == _chain_state(digest, chain_updates)):
+                _log.debug("Chain %s is already programmed", chain_name)
+                del writes[chain_name]
+        return writes
 
     def _calculate_ipt_modify_input(self):
         """
@@ -351,18 +525,23 @@ class IptablesUpdater(Actor):
         # COMMIT
         #
         # The chains are created if they don't exist.
+        writes = self._calculate_chain_writes()
+        if not writes:
+            raise NothingToDo
+        return self._calculate_rewrite_input(writes)
+
+    def _calculate_rewrite_input(self, writes):
+        """
+        :param dict[str,list[str]] writes: map from chain name to the
+            update lines for that chain.
+        :returns list[str]: input to rewrite the given chains.
+        """
         input_lines = []
-        affected_chains = self._batch.affected_chains
-        for chain in affected_chains:
+        for chain in writes:
             input_lines.append(":%s -" % chain)
-        for chain_name in (self._batch.chains_to_stub_out |
-                           self._batch.chains_to_delete):
-            assert chain_name in affected_chains
-            input_lines.extend(_stub_drop_rules(chain_name))
-        for chain_name, chain_updates in self._batch.updates.iteritems():
-            input_lines.extend(chain_updates)
-        if not input_lines:
-            raise NothingToDo
+        for chain_name, chain_updates in writes.iteritems():
+            digest = chain_digest(chain_updates)
+            input_lines.extend(_add_digest_comment(chain_updates, digest))
         return ["*%s" % self.table] + input_lines + ["COMMIT"]
 
     def _calculate_ipt_delete_input(self, chains):
@@ -370,19 +549,18 @@ class IptablesUpdater(Actor):
         Calculate the input for phase 2 of a batch, where we actually
         try to delete chains.
         """
-        input_lines = []
-        found_delete = False
-        input_lines.append("*%s" % self.table)
+        if not chains:
+            raise NothingToDo()
+        input_lines = ["*%s" % self.table]
+        # Flush all the chains first (in --noflush mode, declaring a chain
+        # flushes it), that removes any references between them so that we
+        # can then delete them in any order.
         for chain_name in chains:
-            # Delete the chain
             input_lines.append(":%s -" % chain_name)
+        for chain_name in chains:
             input_lines.append("--delete-chain %s" % chain_name)
-            found_delete = True
         input_lines.append("COMMIT")
-        if found_delete:
-            return input_lines
-        else:
-            raise NothingToDo()
+        return input_lines
 
     def _execute_iptables(self, input_lines):
         """
@@ -512,6 +690,16 @@ class UpdateBatch(object):
         self.expl_prog_chains.add(chain)
         self._invalidate_cache()
 
+    def store_deps(self, requirer, dependencies):
+        """
+        Records the chains that something other than a chain, such as a
+        verdict map element, needs to exist.  The requirer is never
+        treated as a chain itself.
+        """
+        _log.debug("Storing dependencies of %s", requirer)
+        self._update_deps(requirer, set(dependencies))
+        self._invalidate_cache()
+
     def _update_deps(self, chain, new_deps):
         """
         Updates the forward/backward dependency indexes for the given
@@ -604,30 +792,148 @@ def _stub_drop_rules(chain):
                                            'WARNING Missing chain DROP:')]
 
 
-def extract_unreffed_chains(raw_save_output):
+def chain_digest(chain_updates):
+    """
+    :returns str: digest of the given list of update lines for a chain.
+    """
+    return hashlib.sha256("\n".join(chain_updates)).hexdigest()[:16]
+
+
+def _rule_count(chain_updates):
+    """
+    :returns int: the number of rules in the given chain update lines.
+    """
+    return len([l for l in chain_updates if not l.startswith("--flush ")])
+
+
+def _chain_state(digest, chain_updates):
+    """
+    :returns tuple[str,int]: the (digest, number of rules) that
+        extract_chain_state() should find for a chain that we've written
+        with the given update lines.  Empty chains have no digest.
+    """
+    rule_count = _rule_count(chain_updates)
+    return (digest if rule_count else None), rule_count
+
+
+def _add_digest_comment(chain_updates, digest):
     """
-    Parses the output from iptables-save to extract the set of
-    unreferenced chains, which should be safe to delete.
+    :returns list[str]: copy of the update lines with the digest added as
+        a comment on the first rule.  Empty chains have nowhere to put it
+        so they are always rewritten after a restart.
+    """
+    chain_updates = list(chain_updates)
+    for ii, line in enumerate(chain_updates):
+        m = re.match(r'^(--append|-A) \S+', line)
+        if m:
+            chain_updates[ii] = '%s -m comment --comment "%s%s"%s' % (
+                m.group(0), DIGEST_COMMENT_PREFIX, digest, line[m.end():])
+            break
+    return chain_updates
+
+
+def extract_chain_digests(raw_save_output):
+    """
+    Parses the output from iptables-save to extract the digest comments
+    that we put on the first rule of each chain.
+
+    :returns dict[str,str]: map from chain name to digest.
+    """
+    return dict((chain, digest) for chain, (digest, _) in
+                extract_chain_state(raw_save_output).iteritems() if digest)
+
+
+def extract_chain_state(raw_save_output):
+    """
+    Parses the output from iptables-save to extract the digest comment
+    from the first rule of each chain and the number of rules in each
+    chain.
+
+    :returns dict[str,tuple[str,int]]: map from chain name to (digest,
+        number of rules).  The digest is None if the chain's first rule
+        doesn't have one.
+    """
+    state = {}
+    for line in raw_save_output.splitlines():
+        # Chains are declared like this:
+        # :felix-p-abcd-i - [0:0]
+        m = re.match(r'^:(\S+) ', line)
+        if m:
+            state[m.group(1)] = (None, 0)
+            continue
+        # The first rule of a chain looks like this:
+        # -A felix-p-abcd-i -m comment --comment "felix-hash:0123..." -j DROP
+        m = re.match(r'^-A (\S+) ', line)
+        if not m:
+            continue
+        digest, rule_count = state.get(m.group(1), (None, 0))
+        if rule_count == 0:
+            d = re.search(r'--comment "?%s([0-9a-f]+)' %
+                          DIGEST_COMMENT_PREFIX, line)
+            if d:
+                digest = d.group(1)
+        state[m.group(1)] = (digest, rule_count + 1)
+    return state
+
+
+def extract_chain_graph(raw_save_output):
+    """
+    Parses the output from iptables-save to extract the graph of
+    references between chains.
+
+    :returns dict[str,set[str]]: map from chain name to the set of
+        targets that the chain jumps to or goes to.  The targets may
+        include built-in targets, such as ACCEPT.
+    """
+    graph = {}
+    for line in raw_save_output.splitlines():
+        # Chains are declared like this:
+        # :felix-FORWARD - [0:0]
+        m = re.match(r'^:(\S+) ', line)
+        if m:
+            graph.setdefault(m.group(1), set())
+            continue
+        # And rules look like this:
+        # -A felix-FORWARD -i tap+ -j felix-FROM-ENDPOINT
+        m = re.match(r'^-A (\S+) ', line)
+        if m:
+            targets = re.findall(r'\s-[jg] (\S+)', line)
+            graph.setdefault(m.group(1), set()).update(targets)
+    return graph
+
+
+def _reachable_chains(graph, roots):
+    """
+    :returns set[str]: the chains in the graph that can be reached from
+        the given root chains, including the roots.
+    """
+    reachable = set()
+    to_visit = list(roots)
+    while to_visit:
+        chain = to_visit.pop()
+        if chain in reachable or chain not in graph:
+            continue
+        reachable.add(chain)
+        to_visit.extend(graph[chain])
+    return reachable
+
+
+def extract_rule_counters(raw_save_output, chain_prefixes):
+    """
+    Parses the output from iptables-save --counters to extract the packet
+    counts for the rules in the chains with the given prefixes.
+
+    :returns dict[str,list[int]]: map from chain name to the packet
+        count for each rule in the chain, in order.
     """
-    chains = set()
-    last_line = None
+    counters = defaultdict(list)
     for line in raw_save_output.splitlines():
-        # Look for lines that look like this after a blank line.
-        # Chain ufw-user-output (1 references)
-        if ((not last_line or not last_line.strip()) and
-                line.startswith("Chain")):
-            if "policy" in line:
-                _log.debug("Skipping root-level chain")
-                continue
-            m = re.match(r'^Chain ([^ ]+) \((\d+).+\)', line)
-            assert m, "Regex failed to match Chain line %r" % line
-            chain_name = m.group(1)
-            ref_count = int(m.group(2))
-            _log.debug("Found chain %s, ref count %s", chain_name, ref_count)
-            if ref_count == 0:
-                chains.add(chain_name)
-        last_line = line
-    return chains
+        # Rules look like this:
+        # [1234:56789] -A felix-p-abcd-i -p tcp -j RETURN
+        m = re.match(r'^\[(\d+):\d+\] -A (\S+) ', line)
+        if m and m.group(2).startswith(chain_prefixes):
+            counters[m.group(2)].append(int(m.group(1)))
+    return dict(counters)
 
 
 class NothingToDo(Exception):
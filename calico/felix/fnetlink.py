@@ -0,0 +1,631 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.fnetlink
+~~~~~~~~~~~~~~
+
+Minimal rtnetlink client for programming routes and neighbour entries
+without forking "ip" and "arp" for each change.
+"""
+import collections
+import errno
+import itertools
+import logging
+import os
+import socket
+import struct
+
+from gevent.lock import Semaphore
+
+from calico.felix import futils
+from calico.felix.futils import IPV4, IPV6
+
+_log = logging.getLogger(__name__)
+
+# These constants map to constants in the Linux kernel.  As for the ones in
+# devices.py, the kernel can never change them.
+NLMSG_NOOP = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_CREATE = 0x400
+
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_ROUTE = 0x400
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_TABLE = 15
+
+IFLA_IFNAME = 3
+IFF_UP = 0x1
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_PERMANENT = 0x80
+NTF_PROXY = 0x08
+
+NLMSG_HDR_FORMAT = "=LHHLL"
+NLMSG_HDR_LEN = struct.calcsize(NLMSG_HDR_FORMAT)
+RTMSG_FORMAT = "=BBBBBBBBI"
+NDMSG_FORMAT = "=BBHiHBB"
+IFINFOMSG_FORMAT = "=BBHiII"
+IFINFOMSG_LEN = struct.calcsize(IFINFOMSG_FORMAT)
+RTMSG_LEN = struct.calcsize(RTMSG_FORMAT)
+RTA_HDR_FORMAT = "=HH"
+RTA_HDR_LEN = struct.calcsize(RTA_HDR_FORMAT)
+
+# Errors that we ignore when deleting; the entry was already gone.
+DELETE_IGNORED_ERRNOS = frozenset([errno.ENOENT, errno.ESRCH])
+
+
+class NetlinkError(Exception):
+    """
+    Raised when one or more requests in a batch are rejected by the kernel.
+    """
+    def __init__(self, failures):
+        """
+        :param list[tuple[str,int]] failures: list of pairs of
+            (request description, errno).
+        """
+        super(NetlinkError, self).__init__(
+            "Netlink requests failed: %s" %
+            ", ".join("%s (%s)" % (desc, os.strerror(err))
+                      for desc, err in failures))
+        self.failures = failures
+
+
+def _align(length):
+    """Rounds length up to the netlink alignment of 4 bytes."""
+    return (length + 3) & ~3
+
+
+def _pack_attr(attr_type, data):
+    """
+    :returns: the given data packed as a routing attribute, including
+        padding.
+    """
+    length = RTA_HDR_LEN + len(data)
+    return (struct.pack(RTA_HDR_FORMAT, length, attr_type) + data +
+            "\0" * (_align(length) - length))
+
+
+def _pack_addr(ip_type, ip):
+    family = socket.AF_INET if ip_type == futils.IPV4 else socket.AF_INET6
+    return family, socket.inet_pton(family, ip)
+
+
+def _pack_mac(mac):
+    return "".join(chr(int(b, 16)) for b in mac.split(":"))
+
+
+def parse_messages(data):
+    """
+    Splits a datagram received from the kernel into netlink messages.
+
+    :returns: iterator over (msg_type, flags, seq, payload) tuples.
+    """
+    while len(data) >= NLMSG_HDR_LEN:
+        msg_len, msg_type, flags, seq, _ = struct.unpack(
+            NLMSG_HDR_FORMAT, data[:NLMSG_HDR_LEN])
+        if msg_len < NLMSG_HDR_LEN:
+            break
+        yield msg_type, flags, seq, data[NLMSG_HDR_LEN:msg_len]
+        data = data[_align(msg_len):]
+
+
+def parse_attrs(data):
+    """
+    :returns: dict mapping attribute type to the (unpadded) data of each
+        routing attribute in data.
+    """
+    attrs = {}
+    while len(data) >= RTA_HDR_LEN:
+        rta_len, rta_type = struct.unpack(RTA_HDR_FORMAT, data[:RTA_HDR_LEN])
+        if rta_len < RTA_HDR_LEN:
+            # Equivalent of RTA_OK() failing.
+            break
+        attrs[rta_type] = data[RTA_HDR_LEN:rta_len]
+        data = data[_align(rta_len):]
+    return attrs
+
+
+def parse_link(payload):
+    """
+    Parses the payload of an RTM_NEWLINK/RTM_DELLINK message.
+
+    :returns: tuple of (ifindex, interface name or None, flags).
+    """
+    _, _, _, ifindex, flags, _ = struct.unpack(IFINFOMSG_FORMAT,
+                                               payload[:IFINFOMSG_LEN])
+    name = parse_attrs(payload[IFINFOMSG_LEN:]).get(IFLA_IFNAME)
+    if name is not None:
+        name = name.rstrip("\0")
+    return ifindex, name, flags
+
+
+def parse_route(payload):
+    """
+    Parses the payload of an RTM_NEWROUTE/RTM_DELROUTE message.
+
+    :returns: tuple of (ip_type, ip, ifindex) if this is a host route in
+        the main table (the only sort of route that we program), else None.
+    """
+    (family, dst_len, _, _, table, _, _,
+     route_type, _) = struct.unpack(RTMSG_FORMAT, payload[:RTMSG_LEN])
+    if family == socket.AF_INET:
+        ip_type = IPV4
+        host_len = 32
+    elif family == socket.AF_INET6:
+        ip_type = IPV6
+        host_len = 128
+    else:
+        return None
+    if dst_len != host_len or route_type != RTN_UNICAST:
+        return None
+    attrs = parse_attrs(payload[RTMSG_LEN:])
+    if RTA_TABLE in attrs:
+        table, = struct.unpack("=I", attrs[RTA_TABLE])
+    if (table != RT_TABLE_MAIN or RTA_DST not in attrs or
+            RTA_OIF not in attrs):
+        return None
+    ifindex, = struct.unpack("=i", attrs[RTA_OIF])
+    return ip_type, socket.inet_ntop(family, attrs[RTA_DST]), ifindex
+
+
+def interface_index(interface):
+    """
+    :returns: the kernel's index for the given interface.
+    :raises IOError: if the interface does not exist.
+    """
+    with open("/sys/class/net/%s/ifindex" % interface, "r") as f:
+        return int(f.read().strip())
+
+
+class NetlinkBatch(object):
+    """
+    Batch of rtnetlink requests, built up by the caller and then sent in
+    one go by a NetlinkRouteProgrammer.
+
+    The add_route/del_route methods mirror devices.add_route/del_route;
+    for IPv4, routes are usually paired with a static ARP entry.
+    """
+    def __init__(self):
+        # List of (msg_type, flags, payload, description, is_delete, route)
+        # where route is (ip_type, ip, ifindex, interface) for route
+        # requests, else None.
+        self.requests = []
+        self._ifindexes = {}
+
+    def __len__(self):
+        return len(self.requests)
+
+    def _ifindex(self, interface):
+        if interface not in self._ifindexes:
+            self._ifindexes[interface] = interface_index(interface)
+        return self._ifindexes[interface]
+
+    def add_route(self, ip_type, ip, interface):
+        """
+        Queues the equivalent of "ip route replace <ip> dev <interface>".
+        """
+        self._queue_route(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_REPLACE,
+                          ip_type, ip, interface,
+                          "add route %s dev %s" % (ip, interface))
+
+    def del_route(self, ip_type, ip, interface):
+        """
+        Queues the equivalent of "ip route del <ip> dev <interface>".
+        """
+        self._queue_route(RTM_DELROUTE, 0, ip_type, ip, interface,
+                          "delete route %s dev %s" % (ip, interface))
+
+    def _queue_route(self, msg_type, flags, ip_type, ip, interface, desc):
+        family, dst = _pack_addr(ip_type, ip)
+        ifindex = self._ifindex(interface)
+        if msg_type == RTM_DELROUTE:
+            # Match the route whatever its scope.
+            scope = RT_SCOPE_NOWHERE
+        elif family == socket.AF_INET:
+            scope = RT_SCOPE_LINK
+        else:
+            scope = RT_SCOPE_UNIVERSE
+        payload = struct.pack(RTMSG_FORMAT,
+                              family,
+                              len(dst) * 8,  # Prefix length.
+                              0,  # Source prefix length.
+                              0,  # TOS.
+                              RT_TABLE_MAIN,
+                              RTPROT_BOOT,
+                              scope,
+                              RTN_UNICAST,
+                              0)  # Flags.
+        payload += _pack_attr(RTA_DST, dst)
+        payload += _pack_attr(RTA_OIF, struct.pack("=i", ifindex))
+        self.requests.append((msg_type, flags, payload, desc,
+                              msg_type == RTM_DELROUTE,
+                              (ip_type, ip, ifindex, interface)))
+
+    def add_neighbour(self, ip_type, ip, mac, interface):
+        """
+        Queues a permanent neighbour entry, the equivalent of
+        "arp -s <ip> <mac> -i <interface>".
+        """
+        family, dst = _pack_addr(ip_type, ip)
+        payload = struct.pack(NDMSG_FORMAT, family, 0, 0,
+                              self._ifindex(interface), NUD_PERMANENT, 0, 0)
+        payload += _pack_attr(NDA_DST, dst)
+        payload += _pack_attr(NDA_LLADDR, _pack_mac(mac))
+        self.requests.append((RTM_NEWNEIGH, NLM_F_CREATE | NLM_F_REPLACE,
+                              payload, "add neighbour %s lladdr %s dev %s" %
+                              (ip, mac, interface), False, None))
+
+    def del_neighbour(self, ip_type, ip, interface):
+        """
+        Queues the removal of a neighbour entry, the equivalent of
+        "arp -d <ip> -i <interface>".
+        """
+        family, dst = _pack_addr(ip_type, ip)
+        payload = struct.pack(NDMSG_FORMAT, family, 0, 0,
+                              self._ifindex(interface), 0, 0, 0)
+        payload += _pack_attr(NDA_DST, dst)
+        self.requests.append((RTM_DELNEIGH, 0, payload,
+                              "delete neighbour %s dev %s" % (ip, interface),
+                              True, None))
+
+    def add_proxy_neighbour(self, ip_type, ip, interface):
+        """
+        Queues a proxy neighbour entry, the equivalent of
+        "ip -6 neigh add proxy <ip> dev <interface>".
+        """
+        family, dst = _pack_addr(ip_type, ip)
+        payload = struct.pack(NDMSG_FORMAT, family, 0, 0,
+                              self._ifindex(interface), NUD_PERMANENT,
+                              NTF_PROXY, 0)
+        payload += _pack_attr(NDA_DST, dst)
+        self.requests.append((RTM_NEWNEIGH, NLM_F_CREATE | NLM_F_REPLACE,
+                              payload, "add proxy neighbour %s dev %s" %
+                              (ip, interface), False, None))
+
+
+class NetlinkRouteProgrammer(object):
+    """
+    Sends batches of rtnetlink requests to the kernel over a single
+    NETLINK_ROUTE socket.
+
+    Each batch is sent with one sendto() per chunk of max_batch_size
+    requests; every request asks for an ACK so that failures can be
+    matched back to the request that caused them.  Routes that are
+    successfully programmed are recorded in route_table straight away,
+    rather than waiting for the kernel's notification.
+
+    Safe to share between greenlets: batches are serialised by a lock so
+    that ACKs can't be interleaved.
+    """
+
+    max_batch_size = 256
+    """Maximum number of requests to send in one datagram."""
+
+    def __init__(self):
+        self._sock = None
+        self._seq = itertools.count(1)
+        self._lock = Semaphore()
+        self.route_table = RouteTable()
+
+    def _socket(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                       socket.NETLINK_ROUTE)
+            self._sock.bind((0, 0))
+        return self._sock
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+
+    def _next_seq(self):
+        return next(self._seq) & 0xffffffff
+
+    def execute(self, batch):
+        """
+        Sends all the requests in the batch and waits for them to be
+        acknowledged.
+
+        :raises NetlinkError: if any of the requests failed.  The remaining
+            requests are still applied.
+        :raises socket.error: if we fail to talk to the kernel at all.
+        """
+        if not batch.requests:
+            return
+        failures = []
+        with self._lock:
+            try:
+                for ii in xrange(0, len(batch.requests), self.max_batch_size):
+                    chunk = batch.requests[ii:ii + self.max_batch_size]
+                    failures.extend(self._execute_chunk(chunk))
+            except socket.error:
+                _log.exception("Netlink socket failed, will reopen.")
+                self._close()
+                raise
+        if failures:
+            raise NetlinkError(failures)
+
+    def _execute_chunk(self, requests):
+        """
+        Sends one datagram containing the requests and collects the ACKs.
+
+        :returns list: list of (description, errno) for failed requests.
+        """
+        sock = self._socket()
+        requests_by_seq = {}
+        data = []
+        for msg_type, flags, payload, desc, is_delete, route in requests:
+            seq = self._next_seq()
+            requests_by_seq[seq] = (desc, is_delete, route)
+            data.append(struct.pack(NLMSG_HDR_FORMAT,
+                                    NLMSG_HDR_LEN + len(payload),
+                                    msg_type,
+                                    NLM_F_REQUEST | NLM_F_ACK | flags,
+                                    seq,
+                                    0))
+            data.append(payload)
+        _log.debug("Sending %s netlink requests", len(requests))
+        sock.sendto("".join(data), (0, 0))
+
+        failures = []
+        while requests_by_seq:
+            for seq, err in parse_acks(sock.recv(65536)):
+                if seq not in requests_by_seq:
+                    _log.debug("Ignoring ACK for unknown sequence %s", seq)
+                    continue
+                desc, is_delete, route = requests_by_seq.pop(seq)
+                if err != 0 and not (is_delete and
+                                     err in DELETE_IGNORED_ERRNOS):
+                    _log.error("Failed to %s: %s", desc, os.strerror(err))
+                    failures.append((desc, err))
+                    continue
+                if err != 0:
+                    _log.debug("Ignoring failure to %s: already gone", desc)
+                if route is not None:
+                    self.route_table.on_route_programmed(*route,
+                                                         present=not is_delete)
+        return failures
+
+    def dump(self, msg_type, payload):
+        """
+        Sends a dump request and collects the responses.
+
+        :param msg_type: the RTM_GET* request type.
+        :param payload: the request's header, for example an rtmsg
+            specifying the address family.
+        :returns: list of (msg_type, payload) for the dumped objects.
+        :raises NetlinkError: if the kernel rejects the request.
+        :raises socket.error: if we fail to talk to the kernel at all.
+        """
+        with self._lock:
+            try:
+                sock = self._socket()
+                seq = self._next_seq()
+                sock.sendto(struct.pack(NLMSG_HDR_FORMAT,
+                                        NLMSG_HDR_LEN + len(payload),
+                                        msg_type,
+                                        NLM_F_REQUEST | NLM_F_DUMP,
+                                        seq,
+                                        0) + payload, (0, 0))
+                results = []
+                while True:
+                    for (resp_type, _, resp_seq,
+                         resp_payload) in parse_messages(sock.recv(65536)):
+                        if resp_seq != seq:
+                            continue
+                        if resp_type == NLMSG_DONE:
+                            return results
+                        if resp_type == NLMSG_ERROR:
+                            err, = struct.unpack("=i", resp_payload[:4])
+                            raise NetlinkError([("dump %s" % msg_type, -err)])
+                        results.append((resp_type, resp_payload))
+            except socket.error:
+                _log.exception("Netlink socket failed, will reopen.")
+                self._close()
+                raise
+
+    def refresh_route_table(self, ip_types=(IPV4, IPV6)):
+        """
+        Reloads the route table for the given IP versions from a dump of
+        the kernel's links and routes.
+        """
+        links = self.dump(RTM_GETLINK,
+                          struct.pack(IFINFOMSG_FORMAT, socket.AF_UNSPEC,
+                                      0, 0, 0, 0, 0))
+        routes = []
+        for ip_type in ip_types:
+            family = socket.AF_INET if ip_type == IPV4 else socket.AF_INET6
+            routes.extend(self.dump(RTM_GETROUTE,
+                                    struct.pack(RTMSG_FORMAT, family,
+                                                0, 0, 0, 0, 0, 0, 0, 0)))
+        self.route_table.load(links, routes, ip_types)
+
+
+class RouteTable(object):
+    """
+    In-memory copy of the host routes (/32s and /128s) in the main routing
+    table, indexed by interface.
+
+    Loaded from a dump by NetlinkRouteProgrammer.refresh_route_table() and
+    then kept up to date by feeding it the link and route notifications
+    received by the InterfaceWatcher (see handle_message()), and the
+    routes that we program ourselves.
+
+    Routes on an interface are discarded when the interface goes down or
+    is deleted, since the kernel removes them without notifying us.
+    """
+    def __init__(self):
+        self._index_by_name = {}
+        self._name_by_index = {}
+        self._ips_by_index = {
+            IPV4: collections.defaultdict(set),
+            IPV6: collections.defaultdict(set),
+        }
+
+    def load(self, links, routes, ip_types):
+        """
+        Replaces the contents of the table for the given IP versions.
+
+        :param links: list of (msg_type, payload) from a link dump.
+        :param routes: list of (msg_type, payload) from a route dump.
+        """
+        self._index_by_name = {}
+        self._name_by_index = {}
+        for msg_type, payload in links:
+            self.handle_message(msg_type, payload)
+        for ip_type in ip_types:
+            self._ips_by_index[ip_type] = collections.defaultdict(set)
+        num_routes = 0
+        for _, payload in routes:
+            route = parse_route(payload)
+            if route is not None and route[0] in ip_types:
+                ip_type, ip, ifindex = route
+                self._ips_by_index[ip_type][ifindex].add(ip)
+                num_routes += 1
+        _log.info("Loaded %s host routes on %s interfaces", num_routes,
+                  len(self._name_by_index))
+
+    def handle_message(self, msg_type, payload):
+        """
+        Updates the table from a link or route message received from the
+        kernel.  Other message types are ignored.
+        """
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            ifindex, name, flags = parse_link(payload)
+            old_name = self._name_by_index.pop(ifindex, None)
+            if old_name is not None:
+                self._index_by_name.pop(old_name, None)
+            if msg_type == RTM_NEWLINK and name is not None:
+                self._name_by_index[ifindex] = name
+                self._index_by_name[name] = ifindex
+            if msg_type == RTM_DELLINK or not flags & IFF_UP:
+                self._discard_routes(ifindex)
+        elif msg_type in (RTM_NEWROUTE, RTM_DELROUTE):
+            route = parse_route(payload)
+            if route is not None:
+                ip_type, ip, ifindex = route
+                ips = self._ips_by_index[ip_type]
+                if msg_type == RTM_NEWROUTE:
+                    ips[ifindex].add(ip)
+                elif ifindex in ips:
+                    ips[ifindex].discard(ip)
+                    if not ips[ifindex]:
+                        del ips[ifindex]
+
+    def interfaces(self):
+        """
+        :returns: list of (name, index) for all the interfaces that we know
+            about.
+        """
+        return self._index_by_name.items()
+
+    def _discard_routes(self, ifindex):
+        for ips in self._ips_by_index.values():
+            ips.pop(ifindex, None)
+
+    def _index(self, interface):
+        """
+        :returns: the index of the interface, or None if it doesn't exist.
+        """
+        ifindex = self._index_by_name.get(interface)
+        if ifindex is None:
+            # Haven't heard about the interface yet; ask the kernel.
+            try:
+                ifindex = interface_index(interface)
+            except IOError:
+                return None
+            self._index_by_name[interface] = ifindex
+            self._name_by_index[ifindex] = interface
+        return ifindex
+
+    def on_route_programmed(self, ip_type, ip, ifindex, interface,
+                            present=True):
+        """
+        Records a route that we have just added or removed.
+        """
+        old_index = self._index_by_name.get(interface)
+        if old_index != ifindex:
+            if old_index is not None:
+                # The interface has been recreated since we last heard about
+                # it, taking its old routes with it.
+                self._discard_routes(old_index)
+                self._name_by_index.pop(old_index, None)
+            self._index_by_name[interface] = ifindex
+            self._name_by_index[ifindex] = interface
+        ips = self._ips_by_index[ip_type]
+        if present:
+            ips[ifindex].add(ip)
+        elif ifindex in ips:
+            ips[ifindex].discard(ip)
+
+    def interface_ips(self, ip_type, interface):
+        """
+        :returns: set of IPs that have host routes to the interface.
+        """
+        ifindex = self._index(interface)
+        if ifindex is None or ifindex not in self._ips_by_index[ip_type]:
+            return set()
+        return set(self._ips_by_index[ip_type][ifindex])
+
+    def diff(self, ip_type, interface, ips):
+        """
+        Compares the routes to an interface with the desired set.
+
+        :returns: tuple of (set of IPs to remove, set of IPs to add).
+        """
+        current_ips = self.interface_ips(ip_type, interface)
+        return current_ips - ips, ips - current_ips
+
+
+def parse_acks(data):
+    """
+    Parses the ACK/error messages in a datagram received from the kernel.
+
+    :returns: iterator over (sequence number, errno) pairs; errno is 0 for
+        a successful request.
+    """
+    for msg_type, _, seq, payload in parse_messages(data):
+        if msg_type == NLMSG_ERROR:
+            err, = struct.unpack("=i", payload[:4])
+            yield seq, -err
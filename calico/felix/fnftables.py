@@ -0,0 +1,927 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.fnftables
+~~~~~~~~~~~~~~~
+
+nftables dataplane, used in place of iptables and ipsets if the
+DataplaneDriver config parameter is "nftables".
+
+The actors here are drop-in replacements for the IptablesUpdater,
+DispatchChains and IpsetManager.  The rest of Felix still renders its
+rules as iptables-style fragments; we translate them into nft rules and
+apply each batch as a single "nft -f" transaction.  On top of that:
+
+* dispatch to the endpoint chains uses a pair of verdict maps, keyed on
+  interface name, rather than a linear list of rules;
+* ipsets are replaced with native nftables sets, which are updated
+  incrementally.
+"""
+from collections import defaultdict
+import hashlib
+import logging
+import os
+import re
+import shlex
+from subprocess import CalledProcessError
+import tempfile
+
+from gevent import subprocess
+
+from calico.felix import futils
+from calico.felix.actor import actor_message
+from calico.felix.dispatch import DispatchChains
+from calico.felix.fiptables import IptablesUpdater, NothingToDo
+from calico.felix.frules import (CHAIN_FROM_ENDPOINT, CHAIN_TO_ENDPOINT,
+                                 FELIX_PREFIX)
+from calico.felix.futils import IPV4, IPV6, FailedSystemCall
+from calico.felix.ipsets import (IpsetManager, FELIX_PFX, IPSET_PREFIX,
+                                 tag_to_ipset_name)
+from calico.felix.refcount import RefCountedActor
+
+_log = logging.getLogger(__name__)
+
+NFT_CMD = "nft"
+
+# Verdict maps used by the NftablesDispatchChains.
+TO_ENDPOINT_MAP = FELIX_PREFIX + "to-endpoint"
+FROM_ENDPOINT_MAP = FELIX_PREFIX + "from-endpoint"
+
+# Our tables have their own base chains, named after the kernel chains that
+# the iptables backend inserts its rules into.
+BASE_CHAIN_TYPES = {
+    ("filter", "INPUT"): "type filter hook input priority 0;",
+    ("filter", "FORWARD"): "type filter hook forward priority 0;",
+    ("filter", "OUTPUT"): "type filter hook output priority 0;",
+    ("nat", "PREROUTING"): "type nat hook prerouting priority -100;",
+    ("nat", "OUTPUT"): "type nat hook output priority -100;",
+    ("nat", "POSTROUTING"): "type nat hook postrouting priority 100;",
+}
+
+# Map from the iptables target to the equivalent nft verdict.
+NFT_VERDICTS = {
+    "ACCEPT": "accept",
+    "DROP": "drop",
+    "RETURN": "return",
+}
+
+# iptables options that can't be negated with "!".
+NFT_NON_NEGATABLE = set(["--match", "-m", "--comment", "--jump", "-j",
+                         "--goto", "-g", "--to-destination"])
+
+# Characters that nft allows in an unquoted set name.
+NFT_NAME_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_/.\-]*$')
+
+# Prefix of the names of our sets of ports.  iptables uses the same
+# "--match set" match for sets of addresses and sets of ports but nft needs
+# to know which one it's matching against, so we tell them apart by name.
+# The names of the other sets all start with IPSET_PREFIX.
+NFT_PORT_SET_PREFIX = {IPV4: FELIX_PFX + "v4p-", IPV6: FELIX_PFX + "v6p-"}
+
+
+def nft_table_spec(table, ip_version):
+    """
+    :returns: the family and name of our nftables table that stands in for
+        the given iptables table, for example "ip felix-filter".
+    """
+    family = "ip" if ip_version == 4 else "ip6"
+    return "%s %s%s" % (family, FELIX_PREFIX, table)
+
+
+def nft_set_name(ip_type, tag, set_type="hash:ip"):
+    """
+    :returns: the name of the nftables set for the given (shortened) tag.
+        Like the ipset name but hashed if the tag contains characters that
+        nft doesn't allow, such as those in the network and port sets
+        that the rules optimiser creates.  Sets of ports get their own
+        prefix, see NFT_PORT_SET_PREFIX.
+    """
+    if set_type == "bitmap:port":
+        return (NFT_PORT_SET_PREFIX[ip_type] +
+                hashlib.sha256(tag).hexdigest()[:16])
+    name = tag_to_ipset_name(ip_type, tag)
+    if not NFT_NAME_RE.match(name):
+        name = IPSET_PREFIX[ip_type] + hashlib.sha256(tag).hexdigest()[:16]
+    return name
+
+
+class NftablesUpdater(IptablesUpdater):
+    """
+    Actor that owns our nftables table that stands in for a particular
+    iptables table.
+
+    Accepts the same iptables-style updates as the IptablesUpdater and
+    uses the same batching and dependency tracking.  The batch is
+    translated to nft commands (see iptables_to_nft_rule()) and applied
+    in a single, atomic, "nft -f" transaction.  Since the table is ours
+    alone, there's no need to retry due to concurrent updates.
+
+    In addition, rewrite_chains() can update verdict maps in the same
+    transaction as the chains that their elements refer to, and rewrite
+    lines that don't start with "--" are taken as native nft rules.
+    """
+
+    def __init__(self, table, ip_version=4):
+        self._map_updates = None
+        """Map from verdict map name to the element updates in this
+        batch."""
+        super(NftablesUpdater, self).__init__(table, ip_version=ip_version)
+        self.ip_version = ip_version
+        self.table_spec = nft_table_spec(table, ip_version)
+        self.restore_cmd = NFT_CMD
+
+        self.programmed_map_elements = {}
+        """Map from verdict map name to the elements that we've programmed
+        into it, as a dict from key to verdict."""
+        self.base_chain_rules = defaultdict(list)
+        """Map from base chain name to the rules that we've inserted in
+        it, in order."""
+
+    def _reset_batched_work(self):
+        super(NftablesUpdater, self)._reset_batched_work()
+        self._map_updates = defaultdict(dict)
+
+    @actor_message()
+    def rewrite_chains(self, update_calls_by_chain,
+                       dependent_chains, callback=None,
+                       verdict_map_updates=None):
+        """
+        Atomically apply a set of updates to the table.
+
+        :param update_calls_by_chain: as for IptablesUpdater.
+        :param dependent_chains: as for IptablesUpdater.
+        :param verdict_map_updates: map from verdict map name to a dict
+               mapping key to the new verdict, such as "goto <chain>", or
+               None to remove the key from the map.  The chains that the
+               elements refer to are tracked as dependencies of the
+               elements themselves, so the caller needn't list them.
+        """
+        _log.info("nftables update: %s", update_calls_by_chain)
+        _log.info("nftables deps: %s", dependent_chains)
+        for chain, updates in update_calls_by_chain.iteritems():
+            updates = ["--flush %s" % chain] + updates
+            deps = dependent_chains.get(chain, set())
+            self._batch.store_rewrite_chain(chain, updates, deps)
+        for map_name, elements in (verdict_map_updates or {}).iteritems():
+            for key, verdict in elements.iteritems():
+                self._batch.store_deps(_map_element_id(map_name, key),
+                                       _verdict_deps(verdict))
+            self._map_updates[map_name].update(elements)
+        if callback:
+            self._completion_callbacks.append(callback)
+
+    @actor_message(needs_own_batch=True)
+    def ensure_rule_inserted(self, rule_fragment):
+        """
+        Ensures that the given rule, such as "FORWARD --jump
+        felix-FORWARD", is at the start of the named base chain.
+
+        Since we own the base chains, we simply rewrite the chain with
+        the rules that we've been asked to insert.
+        """
+        chain = rule_fragment.split()[0]
+        rules = self.base_chain_rules[chain]
+        if rule_fragment in rules:
+            rules.remove(rule_fragment)
+        rules.insert(0, rule_fragment)
+        self.inserted_rules.add(rule_fragment)
+        self._insert_rule(rule_fragment)
+
+    def _insert_rule(self, rule_fragment):
+        # Rewrite the whole base chain, which also repairs it for
+        # reconcile().
+        chain = rule_fragment.split()[0]
+        rules = self.base_chain_rules[chain]
+        input_lines = [
+            "add table %s" % self.table_spec,
+            "add chain %s %s { %s policy accept; }" % (
+                self.table_spec, chain,
+                BASE_CHAIN_TYPES[(self.table, chain)]),
+            "flush chain %s %s" % (self.table_spec, chain),
+        ]
+        input_lines.extend(self._to_nft_commands(
+            chain, ["--append %s" % r for r in rules]))
+        self._execute_iptables(input_lines)
+
+    @actor_message()
+    def read_rule_counters(self, chain_prefixes):
+        raw_list_output = subprocess.check_output(
+            [NFT_CMD, "list", "table"] + self.table_spec.split())
+        return extract_nft_rule_counters(raw_list_output, chain_prefixes)
+
+    def _load_chain_graph(self):
+        raw_list_output = subprocess.check_output(
+            [NFT_CMD, "list", "table"] + self.table_spec.split())
+        return extract_nft_chain_graph(raw_list_output)
+
+    def _load_chain_state(self):
+        raw_list_output = subprocess.check_output(
+            [NFT_CMD, "list", "table"] + self.table_spec.split())
+        # Without digests, we can only check that the chains exist and
+        # have the right number of rules.  nft has nowhere to carry our
+        # digests through a restart (we use the rule comments for our own
+        # purposes) so, at start of day, only empty chains match and we
+        # rewrite the rest on the first pass.
+        digests = self.programmed_digests or {}
+        state = {}
+        rule_counts = extract_nft_chain_rule_counts(raw_list_output)
+        for chain, rule_count in rule_counts.iteritems():
+            digest = digests.get(chain) if rule_count else None
+            state[chain] = (digest, rule_count)
+        return state
+
+    def _update_indexes(self):
+        super(NftablesUpdater, self)._update_indexes()
+        for map_name, elements in self._map_updates.iteritems():
+            programmed = self.programmed_map_elements.setdefault(map_name,
+                                                                 {})
+            for key, verdict in elements.iteritems():
+                if verdict is None:
+                    programmed.pop(key, None)
+                else:
+                    programmed[key] = verdict
+
+    def _calculate_ipt_modify_input(self):
+        """
+        Calculate the nft commands for phase 1 of a batch, where we only
+        modify and create chains and update the verdict maps.
+        """
+        writes = self._calculate_chain_writes()
+        map_input = self._calculate_map_input()
+        if not writes and not map_input:
+            raise NothingToDo
+        try:
+            return self._calculate_rewrite_input(writes, map_input)
+        except ValueError:
+            # Report it like any other failure so that the batch gets split
+            # to find the culprit.
+            _log.exception("Failed to translate rules to nft")
+            raise CalledProcessError(cmd=NFT_CMD, returncode=1)
+
+    def _calculate_rewrite_input(self, writes, map_input=()):
+        """
+        :param dict[str,list[str]] writes: map from chain name to the
+            update lines for that chain.
+        :param list[str] map_input: nft commands to update the verdict
+            maps, which may refer to the chains.
+        :returns list[str]: nft commands to rewrite the given chains.
+        :raises ValueError: if a rule can't be translated.
+        """
+        input_lines = ["add table %s" % self.table_spec]
+        for chain in writes:
+            input_lines.append("add chain %s %s" % (self.table_spec, chain))
+        # The map elements may refer to the chains that we just created.
+        input_lines.extend(map_input)
+        for chain_name, chain_updates in writes.iteritems():
+            input_lines.extend(self._to_nft_commands(chain_name,
+                                                     chain_updates))
+        return input_lines
+
+    def _calculate_map_input(self):
+        """
+        :returns: nft commands to create the verdict maps that are updated
+            in this batch and bring their elements up to date.
+        """
+        input_lines = []
+        for map_name, elements in sorted(self._map_updates.iteritems()):
+            input_lines.append("add map %s %s { type ifname : verdict; }" %
+                               (self.table_spec, map_name))
+            programmed = self.programmed_map_elements.get(map_name)
+            if programmed is None:
+                # First time we've touched the map, it may contain stale
+                # elements from a previous run.
+                input_lines.append("flush map %s %s" %
+                                   (self.table_spec, map_name))
+                programmed = {}
+            to_remove = [k for k, v in elements.iteritems()
+                         if k in programmed and programmed[k] != v]
+            to_add = [(k, v) for k, v in elements.iteritems()
+                      if v is not None and programmed.get(k) != v]
+            if to_remove:
+                input_lines.append("delete element %s %s { %s }" % (
+                    self.table_spec, map_name,
+                    ", ".join('"%s"' % k for k in sorted(to_remove))))
+            if to_add:
+                input_lines.append("add element %s %s { %s }" % (
+                    self.table_spec, map_name,
+                    ", ".join('"%s" : %s' % kv for kv in sorted(to_add))))
+        return input_lines
+
+    def _calculate_ipt_delete_input(self, chains):
+        """
+        Calculate the nft commands for phase 2 of a batch, where we
+        actually try to delete chains.
+        """
+        if not chains:
+            raise NothingToDo()
+        input_lines = []
+        # Flush all the chains first to remove any references between them.
+        for chain_name in chains:
+            input_lines.append("flush chain %s %s" % (self.table_spec,
+                                                      chain_name))
+        for chain_name in chains:
+            input_lines.append("delete chain %s %s" % (self.table_spec,
+                                                       chain_name))
+        return input_lines
+
+    def _to_nft_commands(self, chain_name, update_lines):
+        """
+        :returns: list of nft commands equivalent to the given rewrite
+            lines for the chain.
+        :raises ValueError: if a line uses an iptables feature that we
+            don't support.
+        """
+        commands = []
+        for line in update_lines:
+            if line.startswith("--flush "):
+                commands.append("flush chain %s %s" % (self.table_spec,
+                                                       chain_name))
+            elif line.startswith("-"):
+                chain, rule = iptables_to_nft_rule(line, self.ip_version)
+                commands.append("add rule %s %s %s" % (self.table_spec,
+                                                       chain, rule))
+            else:
+                # Native nft rule.
+                commands.append("add rule %s %s %s" % (self.table_spec,
+                                                       chain_name, line))
+        return commands
+
+    def _execute_iptables(self, input_lines):
+        """
+        Runs "nft -f" with the given commands, which it applies as a
+        single transaction.
+
+        :raises CalledProcessError: if the command fails.
+        """
+        input_str = "\n".join(input_lines) + "\n"
+        _log.debug("%s input:\n%s", NFT_CMD, input_str)
+        cmd = [NFT_CMD, "-f", "-"]
+        nft_proc = subprocess.Popen(cmd,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        out, err = nft_proc.communicate(input_str)
+        rc = nft_proc.wait()
+        _log.debug("%s completed with RC=%s", NFT_CMD, rc)
+        if rc != 0:
+            _log.error("Failed to run %s.\nOutput:\n%s\n"
+                       "Error:\n%s\nInput was:\n%s",
+                       NFT_CMD, out, err, input_str)
+            raise CalledProcessError(cmd=cmd, returncode=rc)
+
+
+def _map_element_id(map_name, key):
+    """
+    :returns: the name under which we track the dependencies of a verdict
+        map element.  Can't clash with a chain name.
+    """
+    return "%s[%s]" % (map_name, key)
+
+
+def _verdict_deps(verdict):
+    """
+    :returns: set containing the chain that the given verdict, such as
+        "goto <chain>", jumps to; empty for other verdicts or None.
+    """
+    words = (verdict or "").split()
+    if len(words) == 2 and words[0] in ("goto", "jump"):
+        return set([words[1]])
+    return set()
+
+
+def iptables_to_nft_rule(fragment, ip_version):
+    """
+    Translates an iptables "--append <chain> ..." fragment, of the sort
+    that Felix generates, to an nft rule.  Every rule gets a counter, so
+    that read_rule_counters() works as it does for iptables.
+
+    :returns: tuple of the chain name and the nft rule.
+    :raises ValueError: if the fragment uses an option that we don't
+        support.
+    """
+    tokens = shlex.split(fragment)
+    if len(tokens) < 2 or tokens[0] not in ("--append", "-A"):
+        raise ValueError("Expected --append in %r" % fragment)
+    chain = tokens[1]
+    tokens = tokens[2:]
+    ip = "ip" if ip_version == 4 else "ip6"
+
+    matches = []
+    verdict = None
+    comment = None
+    dnat_to = None
+    negate = False
+    while tokens:
+        opt = tokens.pop(0)
+        if opt == "!":
+            negate = True
+            continue
+        op = "!= " if negate else ""
+        negate = False
+        if op and opt in NFT_NON_NEGATABLE:
+            raise ValueError("Can't negate %s in %r" % (opt, fragment))
+        if opt in ("--match", "-m"):
+            # The match modules are implied by the nft expressions.
+            tokens.pop(0)
+        elif opt in ("--protocol", "-p"):
+            proto = tokens.pop(0)
+            if proto == "icmpv6":
+                proto = "ipv6-icmp"
+            matches.append("meta l4proto %s%s" % (op, proto))
+        elif opt in ("--source", "--src", "-s"):
+            matches.append("%s saddr %s%s" % (ip, op, tokens.pop(0)))
+        elif opt in ("--destination", "--dst", "-d"):
+            matches.append("%s daddr %s%s" % (ip, op, tokens.pop(0)))
+        elif opt in ("--in-interface", "-i"):
+            matches.append('iifname %s"%s"' % (op, _iface(tokens.pop(0))))
+        elif opt in ("--out-interface", "-o"):
+            matches.append('oifname %s"%s"' % (op, _iface(tokens.pop(0))))
+        elif opt == "--match-set":
+            set_name = tokens.pop(0)
+            addr = tokens.pop(0)[0]
+            port_set_prefix = NFT_PORT_SET_PREFIX[IPV4 if ip_version == 4
+                                                  else IPV6]
+            if set_name.startswith(port_set_prefix):
+                matches.append("th %sport %s@%s" % (addr, op, set_name))
+            else:
+                matches.append("%s %saddr %s@%s" % (ip, addr, op, set_name))
+        elif opt in ("--source-ports", "--sports", "--sport"):
+            matches.append("th sport %s%s" % (op, _ports(tokens.pop(0))))
+        elif opt in ("--destination-ports", "--dports", "--dport"):
+            matches.append("th dport %s%s" % (op, _ports(tokens.pop(0))))
+        elif opt in ("--ctstate", "--state"):
+            matches.append("ct state %s%s" % (op, tokens.pop(0).lower()))
+        elif opt == "--mac-source":
+            matches.append("ether saddr %s%s" % (op, tokens.pop(0).lower()))
+        elif opt == "--icmp-type":
+            matches.append("icmp type %s%s" % (op, tokens.pop(0)))
+        elif opt == "--icmpv6-type":
+            matches.append("icmpv6 type %s%s" % (op, tokens.pop(0)))
+        elif opt == "--comment":
+            comment = tokens.pop(0)
+        elif opt in ("--jump", "-j"):
+            target = tokens.pop(0)
+            if target in NFT_VERDICTS:
+                verdict = NFT_VERDICTS[target]
+            elif target == "DNAT":
+                verdict = "dnat"
+            else:
+                verdict = "jump %s" % target
+        elif opt in ("--goto", "-g"):
+            verdict = "goto %s" % tokens.pop(0)
+        elif opt == "--to-destination":
+            dnat_to = tokens.pop(0)
+        else:
+            raise ValueError("Unsupported option %s in %r" % (opt, fragment))
+
+    rule = matches + ["counter"]
+    if verdict == "dnat":
+        if dnat_to is None:
+            raise ValueError("DNAT without --to-destination in %r" %
+                             fragment)
+        rule.append("dnat to %s" % dnat_to)
+    elif verdict is not None:
+        rule.append(verdict)
+    if comment is not None:
+        rule.append('comment "%s"' % comment)
+    return chain, " ".join(rule)
+
+
+def _iface(iface_match):
+    """
+    :returns: nft interface name match for the iptables one; the iptables
+        wildcard, "+", becomes "*".
+    """
+    if iface_match.endswith("+"):
+        return iface_match[:-1] + "*"
+    return iface_match
+
+
+def _ports(ports):
+    """
+    :returns: nft match value for an iptables comma-separated list of
+        ports and port ranges.
+    """
+    values = ports.replace(":", "-").split(",")
+    if len(values) == 1:
+        return values[0]
+    return "{ %s }" % ", ".join(values)
+
+
+class NftablesDispatchChains(DispatchChains):
+    """
+    DispatchChains that uses a pair of verdict maps, keyed on interface
+    name, to dispatch to the endpoint chains.  Each packet takes one map
+    lookup, no matter how many endpoints there are, and adding or
+    removing an endpoint only adds or removes a map element.
+
+    Requires an NftablesUpdater.
+    """
+
+    def __init__(self, config, ip_version, iptables_updater):
+        super(NftablesDispatchChains, self).__init__(config, ip_version,
+                                                     iptables_updater)
+        # Map from interface name to the verdict that we've programmed into
+        # the to/from-endpoint maps.
+        self._programmed_to = {}
+        self._programmed_from = {}
+        # Interfaces whose map elements may need updating.
+        self._dirty_ifaces = set()
+        # The top-level chains only change on a resync.  The NftablesUpdater
+        # tracks the endpoint chains that the map elements depend on.
+        self._root_dirty = True
+
+    def _bucket_for_iface(self, iface_name):
+        # The maps replace the bucket chains.
+        return None
+
+    def _mark_iface_dirty(self, iface_name):
+        self._dirty_ifaces.add(iface_name)
+
+    def _finish_msg_batch(self, batch, results):
+        if self._dirty_ifaces or self._root_dirty:
+            _log.debug("Interface mapping changed, updating maps.")
+            self._reprogram_chains()
+
+    def _reprogram_chains(self):
+        """
+        Calculates the changes to the maps for the dirty interfaces and
+        writes them, along with the top-level chains if needed.
+
+        Synchronous, doesn't return until the maps are in place.
+        """
+        _log.info("%s Updating dispatch maps, num entries: %s, "
+                  "dirty interfaces: %s", self, len(self.iface_to_ep_id),
+                  len(self._dirty_ifaces))
+        to_updates = {}
+        from_updates = {}
+        for iface in self._dirty_ifaces:
+            fragments = self._fragments_by_iface.get(iface)
+            if fragments is not None:
+                _, _, _, to_ep_chain, from_ep_chain = fragments
+                to_verdict = "goto %s" % to_ep_chain
+                from_verdict = "goto %s" % from_ep_chain
+            else:
+                to_verdict = from_verdict = None
+            if self._programmed_to.get(iface) != to_verdict:
+                to_updates[iface] = to_verdict
+            if self._programmed_from.get(iface) != from_verdict:
+                from_updates[iface] = from_verdict
+        updates = {}
+        if self._root_dirty:
+            updates = {
+                CHAIN_TO_ENDPOINT: [
+                    "oifname vmap @%s" % TO_ENDPOINT_MAP,
+                    "--append %s --jump DROP" % CHAIN_TO_ENDPOINT,
+                ],
+                CHAIN_FROM_ENDPOINT: [
+                    "iifname vmap @%s" % FROM_ENDPOINT_MAP,
+                    "--append %s --jump DROP" % CHAIN_FROM_ENDPOINT,
+                ],
+            }
+        map_updates = {}
+        if to_updates:
+            map_updates[TO_ENDPOINT_MAP] = to_updates
+        if from_updates:
+            map_updates[FROM_ENDPOINT_MAP] = from_updates
+        if updates or map_updates:
+            self.iptables_updater.rewrite_chains(
+                updates, {}, verdict_map_updates=map_updates, async=False
+            )
+        _apply_map_delta(self._programmed_to, to_updates)
+        _apply_map_delta(self._programmed_from, from_updates)
+        self._dirty_ifaces.clear()
+        self._dirty_buckets.clear()
+        self._root_dirty = False
+
+
+def _apply_map_delta(elements, delta):
+    """
+    Updates elements in place with a delta, as passed to
+    NftablesUpdater.rewrite_chains(), where None removes the key.
+    """
+    for key, value in delta.iteritems():
+        if value is None:
+            elements.pop(key, None)
+        else:
+            elements[key] = value
+
+
+class NftSetManager(IpsetManager):
+    """
+    IpsetManager that manages nftables sets instead of ipsets.
+    """
+
+    def _new_ipset(self, tag, set_type="hash:ip"):
+        return NftSet(tag, self.ip_type, set_type=set_type)
+
+    @actor_message()
+    def reconcile(self):
+        """
+        Checks that the sets that we've programmed still exist and has
+        any that are missing recreate themselves.  Unlike ipsets, we don't
+        check the members of each set.
+
+        :returns int: the number of sets that were recreated.
+        """
+        table_spec = NftSet.table_spec_for(self.ip_type)
+        try:
+            raw_list_output = futils.check_call(
+                [NFT_CMD, "list", "table"] + table_spec.split()).stdout
+        except FailedSystemCall:
+            _log.warning("nftables table %s is missing", table_spec)
+            raw_list_output = ""
+        set_names = set(extract_nft_set_names(raw_list_output))
+        results = []
+        for tag_id, nft_set in self.objects_by_id.iteritems():
+            if not self._is_starting_or_live(tag_id):
+                continue
+            exists = bool(nft_set.owned_ipset_names() & set_names)
+            results.append((tag_id, nft_set.reconcile(exists, async=True)))
+        num_repaired = 0
+        for tag_id, result in results:
+            # As for the IpsetManager, collect every result.
+            try:
+                if result.get():
+                    num_repaired += 1
+            except Exception:
+                _log.exception("Failed to reconcile nftables set for %s, "
+                               "will retry next time.", tag_id)
+        return num_repaired
+
+    @actor_message()
+    def cleanup(self):
+        """
+        Clean up left-over sets that existed at start-of-day.
+        """
+        _log.info("Cleaning up left-over nftables sets.")
+        table_spec = NftSet.table_spec_for(self.ip_type)
+        try:
+            raw_list_output = futils.check_call(
+                [NFT_CMD, "list", "table"] + table_spec.split()).stdout
+        except FailedSystemCall:
+            _log.info("No nftables table yet, nothing to clean up.")
+            return
+        prefixes = (IPSET_PREFIX[self.ip_type],
+                    NFT_PORT_SET_PREFIX[self.ip_type])
+        felix_sets = set(n for n in extract_nft_set_names(raw_list_output)
+                         if n.startswith(prefixes))
+        whitelist = set()
+        for nft_set in self.objects_by_id.values():
+            whitelist.update(nft_set.owned_ipset_names())
+        for set_name in felix_sets - whitelist:
+            try:
+                futils.check_call([NFT_CMD, "delete", "set"] +
+                                  table_spec.split() + [set_name])
+            except FailedSystemCall:
+                _log.exception("Failed to clean up dead set %s, will "
+                               "retry on next cleanup.", set_name)
+
+
+class NftSet(RefCountedActor):
+
+    def __init__(self, tag, ip_type, set_type="hash:ip"):
+        """
+        Actor managing a single nftables set.  Like an ActiveIpset, but
+        the set lives in our filter table and we apply changes to its
+        members incrementally.
+
+        :param str tag: Name of tag that this set represents.
+        :param ip_type: IPV4 or IPV6
+        :param str set_type: ipset-style type, "hash:ip", "hash:net" or
+            "bitmap:port".
+        """
+        super(NftSet, self).__init__(qualifier=tag)
+
+        self.tag = tag
+        self.ip_type = ip_type
+        self.name = nft_set_name(ip_type, tag, set_type)
+        self.set_type = set_type
+        self.table_spec = self.table_spec_for(ip_type)
+
+        # Members - which entries should be in the set.
+        self.members = set()
+
+        # Members which really are in the set, None if we haven't created
+        # the set yet.
+        self.programmed_members = None
+
+        # Notified ready?
+        self.notified_ready = False
+
+    @staticmethod
+    def table_spec_for(ip_type):
+        return nft_table_spec("filter", 4 if ip_type == IPV4 else 6)
+
+    def owned_ipset_names(self):
+        """
+        This method is safe to call from another greenlet; it only accesses
+        immutable state.
+
+        :return: set of names of the sets that this Actor owns and manages.
+        """
+        return set([self.name])
+
+    @actor_message()
+    def replace_members(self, members):
+        _log.info("Replacing members of set %s", self.name)
+        assert isinstance(members, set), "Expected members to be a set"
+        self.members = members
+
+    @actor_message()
+    def add_member(self, member):
+        _log.info("Adding member %s to set %s", member, self.name)
+        self.members.add(member)
+
+    @actor_message()
+    def remove_member(self, member):
+        _log.info("Removing member %s from set %s", member, self.name)
+        try:
+            self.members.remove(member)
+        except KeyError:
+            _log.info("%s was not in set %s", member, self.name)
+
+    @actor_message()
+    def reconcile(self, exists):
+        """
+        :param bool exists: whether our set exists in the dataplane.
+        :returns bool: True if we had programmed the set but it is
+            missing, in which case we recreate it at the end of the batch.
+        """
+        if exists or self.programmed_members is None:
+            return False
+        _log.warning("Set %s is missing, recreating it", self.name)
+        self.programmed_members = None
+        return True
+
+    @actor_message()
+    def on_unreferenced(self):
+        try:
+            if self.programmed_members is not None:
+                _run_nft(["delete set %s %s" % (self.table_spec, self.name)])
+        finally:
+            self._notify_cleanup_complete()
+
+    def _finish_msg_batch(self, batch, results):
+        if self.members != self.programmed_members:
+            self._sync_to_set()
+
+        if not self.notified_ready:
+            # We have created the set, so we are now ready.
+            self.notified_ready = True
+            self._notify_ready()
+
+    def _sync_to_set(self):
+        input_lines = []
+        if self.programmed_members is None:
+            input_lines.append("add table %s" % self.table_spec)
+            input_lines.append("add set %s %s { %s }" % (
+                self.table_spec, self.name, self._set_spec()))
+            # The set may be left over from a previous run.
+            input_lines.append("flush set %s %s" % (self.table_spec,
+                                                    self.name))
+            to_remove = set()
+            to_add = self.members
+        else:
+            to_remove = self.programmed_members - self.members
+            to_add = self.members - self.programmed_members
+        _log.debug("Updating set %s: removing %s, adding %s", self.name,
+                   to_remove, to_add)
+        for verb, members in [("delete", to_remove), ("add", to_add)]:
+            if members:
+                input_lines.append("%s element %s %s { %s }" % (
+                    verb, self.table_spec, self.name,
+                    ", ".join(sorted(members))))
+        if input_lines:
+            _run_nft(input_lines)
+        self.programmed_members = self.members.copy()
+
+    def _set_spec(self):
+        """
+        :returns: the nft type and flags for our set.
+        """
+        if self.set_type == "bitmap:port":
+            return "type inet_service; flags interval; auto-merge;"
+        addr_type = "ipv4_addr" if self.ip_type == IPV4 else "ipv6_addr"
+        if self.set_type == "hash:net":
+            return "type %s; flags interval; auto-merge;" % addr_type
+        assert self.set_type == "hash:ip", "Unknown type %s" % self.set_type
+        return "type %s;" % addr_type
+
+
+def _run_nft(input_lines):
+    """
+    Runs "nft -f" with the given commands.
+
+    :raises FailedSystemCall: if the command fails.
+    """
+    fd, filename = tempfile.mkstemp(text=True)
+    f = os.fdopen(fd, "w")
+    f.write("\n".join(input_lines) + "\n")
+    f.close()
+    try:
+        futils.check_call([NFT_CMD, "-f", filename])
+    finally:
+        os.remove(filename)
+
+
+def extract_nft_chain_graph(raw_list_output):
+    """
+    Parses the output from "nft list table" to extract the graph of
+    references between chains.  Verdict maps appear in the graph as
+    "@<map name>", referencing the chains in their elements.
+
+    :returns dict[str,set[str]]: map from chain name to the set of
+        chains that it jumps to or goes to.
+    """
+    graph = {}
+    node = None
+    for line in raw_list_output.splitlines():
+        m = re.match(r'^\s*(chain|map|set) (\S+) \{', line)
+        if m:
+            kind, name = m.groups()
+            if kind == "chain":
+                node = name
+            elif kind == "map":
+                node = "@" + name
+            else:
+                node = None
+            if node is not None:
+                graph[node] = set()
+            continue
+        if line.strip() == "}":
+            node = None
+        elif node is not None:
+            graph[node].update(re.findall(r'\b(?:jump|goto) ([^\s,;}]+)',
+                                          line))
+    return graph
+
+
+def extract_nft_chain_rule_counts(raw_list_output):
+    """
+    Parses the output from "nft list table" to extract the number of
+    rules in each chain.
+
+    :returns dict[str,int]: map from chain name to number of rules.
+    """
+    rule_counts = {}
+    chain = None
+    for line in raw_list_output.splitlines():
+        m = re.match(r'^\s*chain (\S+) \{', line)
+        if m:
+            chain = m.group(1)
+            rule_counts[chain] = 0
+            continue
+        line = line.strip()
+        if line == "}":
+            chain = None
+        elif (chain is not None and line and
+                not re.match(r'^type \S+ hook ', line)):
+            rule_counts[chain] += 1
+    return rule_counts
+
+
+def extract_nft_rule_counters(raw_list_output, chain_prefixes):
+    """
+    Parses the output from "nft list table" to extract the packet counts
+    for the rules in the chains with the given prefixes.
+
+    :returns dict[str,list[int]]: map from chain name to the packet
+        count for each rule in the chain, in order.
+    """
+    counters = defaultdict(list)
+    chain = None
+    for line in raw_list_output.splitlines():
+        m = re.match(r'^\s*chain (\S+) \{', line)
+        if m:
+            chain = m.group(1)
+            if not chain.startswith(chain_prefixes):
+                chain = None
+            continue
+        if line.strip() == "}":
+            chain = None
+        elif chain is not None:
+            m = re.search(r'\bcounter packets (\d+)', line)
+            if m:
+                counters[chain].append(int(m.group(1)))
+    return dict(counters)
+
+
+def extract_nft_set_names(raw_list_output):
+    """
+    Parses the output from "nft list table" to extract the names of the
+    sets in the table.
+    """
+    return re.findall(r'^\s*set (\S+) \{', raw_list_output, re.MULTILINE)
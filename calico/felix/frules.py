@@ -18,9 +18,12 @@ felix.frules
 
 Felix rule management, including iptables and ipsets.
 """
+import hashlib
+import json
 import logging
 from subprocess import CalledProcessError
 import itertools
+import netaddr
 from calico.felix import futils
 import re
 
@@ -30,6 +33,15 @@ _log = logging.getLogger(__name__)
 # 2 entries.
 MAX_MULTIPORT_ENTRIES = 15
 
+# Maximum number of rendered rules to cache.  See rule_to_iptables_fragments().
+RULE_CACHE_SIZE = 10000
+_rule_cache = futils.LRUCache(RULE_CACHE_SIZE)
+
+# Minimum number of otherwise-identical rules that optimise_rules() will
+# collapse into a single rule that matches on a hash:net ipset.  For shorter
+# runs, the ipset isn't worth the overhead.
+NET_SET_MIN_SIZE = 4
+
 # Chain names
 FELIX_PREFIX = "felix-"
 CHAIN_PREROUTING = FELIX_PREFIX + "PREROUTING"
@@ -37,9 +49,12 @@ CHAIN_INPUT = FELIX_PREFIX + "INPUT"
 CHAIN_FORWARD = FELIX_PREFIX + "FORWARD"
 CHAIN_TO_ENDPOINT = FELIX_PREFIX + "TO-ENDPOINT"
 CHAIN_FROM_ENDPOINT = FELIX_PREFIX + "FROM-ENDPOINT"
+CHAIN_TO_IFACE_BUCKET_PREFIX = FELIX_PREFIX + "TO-EP-PFX-"
+CHAIN_FROM_IFACE_BUCKET_PREFIX = FELIX_PREFIX + "FROM-EP-PFX-"
 CHAIN_TO_PREFIX = FELIX_PREFIX + "to-"
 CHAIN_FROM_PREFIX = FELIX_PREFIX + "from-"
 CHAIN_PROFILE_PREFIX = FELIX_PREFIX + "p-"
+CHAIN_SHARED_PROFILE_PREFIX = FELIX_PREFIX + "ps-"
 
 
 # Valid keys for a rule JSON dict.
@@ -56,6 +71,15 @@ KNOWN_RULE_KEYS = set([
     "ip_version",
 ])
 
+# Keys that optimise_rules() may add to a rule.  They hold a tuple of CIDRs
+# or ports, which are matched via an ipset; see rule_ipset_keys().
+OPTIMISED_RULE_KEYS = set([
+    "src_net_set",
+    "dst_net_set",
+    "src_port_set",
+    "dst_port_set",
+])
+
 
 def profile_to_chain_name(inbound_or_outbound, profile_id):
     """
@@ -64,12 +88,55 @@ def profile_to_chain_name(inbound_or_outbound, profile_id):
     it is dangerous (for example, in OpenStack the profile is the ID of each
     security group in use, joined with underscores). Hence we make a unique
     string out of it and use that.
+
+    :param inbound_or_outbound: "inbound", "outbound" or, for the profile's
+        shared endpoint to-chain, "to".
     """
     profile_string = futils.uniquely_shorten(profile_id, 16)
     return CHAIN_PROFILE_PREFIX + "%s-%s" % (profile_string,
                                              inbound_or_outbound[:1])
 
 
+def rules_to_shared_chain(inbound_or_outbound, rules, ip_version,
+                          tag_to_ipset, on_allow="ACCEPT", on_deny="DROP"):
+    """
+    Renders a list of rules into a chain that is named after a hash of its
+    contents, so that profiles with identical rules can share the chain.
+
+    :returns: tuple of (chain name, list of rewrite lines).
+    """
+    # Render with a placeholder name, which can't clash with a real chain
+    # name, then substitute in the name once we know the hash.
+    placeholder = "<%s>" % CHAIN_SHARED_PROFILE_PREFIX
+    lines = rules_to_chain_rewrite_lines(placeholder, rules, ip_version,
+                                         tag_to_ipset, on_allow=on_allow,
+                                         on_deny=on_deny)
+    digest = hashlib.sha256("\n".join(lines)).hexdigest()
+    chain_name = CHAIN_SHARED_PROFILE_PREFIX + "%s-%s" % (
+        digest[:16], inbound_or_outbound[:1])
+    return chain_name, [l.replace(placeholder, chain_name, 1) for l in lines]
+
+
+def install_metadata_rules(config, v4_nat_updater):
+    """
+    (Re)writes the felix-PREROUTING chain in the IPv4 nat table, which
+    exposes the metadata server, if there is one.  Called again if the
+    metadata config changes.
+    """
+    nat_pr = []
+    if config.METADATA_IP is not None:
+        # Need to expose the metadata server on a link-local.
+        #  DNAT tcp -- any any anywhere 169.254.169.254
+        #              tcp dpt:http to:127.0.0.1:9697
+        nat_pr.append("--append " + CHAIN_PREROUTING + " "
+                      "--protocol tcp "
+                      "--dport 80 "
+                      "--destination 169.254.169.254/32 "
+                      "--jump DNAT --to-destination %s:%s" %
+                      (config.METADATA_IP, config.METADATA_PORT))
+    v4_nat_updater.rewrite_chains({CHAIN_PREROUTING: nat_pr}, {}, async=False)
+
+
 def install_global_rules(config, v4_filter_updater, v6_filter_updater,
                          v4_nat_updater):
     """
@@ -88,43 +155,46 @@ def install_global_rules(config, v4_filter_updater, v6_filter_updater,
     iface_match = config.IFACE_PREFIX + "+"
 
     # The IPV4 nat table first. This must have a felix-PREROUTING chain.
-    nat_pr = []
-    if config.METADATA_IP is not None:
-        # Need to expose the metadata server on a link-local.
-        #  DNAT tcp -- any any anywhere 169.254.169.254
-        #              tcp dpt:http to:127.0.0.1:9697
-        nat_pr.append("--append " + CHAIN_PREROUTING + " "
-                      "--protocol tcp "
-                      "--dport 80 "
-                      "--destination 169.254.169.254/32 "
-                      "--jump DNAT --to-destination %s:%s" %
-                      (config.METADATA_IP, config.METADATA_PORT))
-    v4_nat_updater.rewrite_chains({CHAIN_PREROUTING: nat_pr}, {}, async=False)
+    install_metadata_rules(config, v4_nat_updater)
     v4_nat_updater.ensure_rule_inserted(
         "PREROUTING --jump %s" % CHAIN_PREROUTING, async=False)
 
     # Now the filter table. This needs to have calico-filter-FORWARD and
     # calico-filter-INPUT chains, which we must create before adding any
     # rules that send to them.
-    for iptables_updater in [v4_filter_updater, v6_filter_updater]:
+    for ip_version, iptables_updater in [(4, v4_filter_updater),
+                                         (6, v6_filter_updater)]:
+        forward_rules = []
+        input_rules = []
+        if config.CONNTRACK_FAST_PATH:
+            # Accept established flows before the (linear) dispatch chains,
+            # rather than in every endpoint chain.
+            forward_rules.extend(conntrack_fast_path_fragments(
+                CHAIN_FORWARD, ip_version, "--in-interface %s" % iface_match))
+            forward_rules.extend(conntrack_fast_path_fragments(
+                CHAIN_FORWARD, ip_version, "--out-interface %s" % iface_match))
+            input_rules.extend(conntrack_fast_path_fragments(
+                CHAIN_INPUT, ip_version, "--in-interface %s" % iface_match))
+        forward_rules.extend([
+            "--append %s --jump %s --in-interface %s" %
+                (CHAIN_FORWARD, CHAIN_FROM_ENDPOINT, iface_match),
+            "--append %s --jump %s --out-interface %s" %
+                (CHAIN_FORWARD, CHAIN_TO_ENDPOINT, iface_match),
+            "--append %s --jump ACCEPT --in-interface %s" %
+                (CHAIN_FORWARD, iface_match),
+            "--append %s --jump ACCEPT --out-interface %s" %
+                (CHAIN_FORWARD, iface_match),
+        ])
+        input_rules.extend([
+            "--append %s --jump %s --in-interface %s" %
+                (CHAIN_INPUT, CHAIN_FROM_ENDPOINT, iface_match),
+            "--append %s --jump ACCEPT --in-interface %s" %
+                (CHAIN_INPUT, iface_match),
+        ])
         iptables_updater.rewrite_chains(
             {
-                CHAIN_FORWARD: [
-                    "--append %s --jump %s --in-interface %s" %
-                        (CHAIN_FORWARD, CHAIN_FROM_ENDPOINT, iface_match),
-                    "--append %s --jump %s --out-interface %s" %
-                        (CHAIN_FORWARD, CHAIN_TO_ENDPOINT, iface_match),
-                    "--append %s --jump ACCEPT --in-interface %s" %
-                        (CHAIN_FORWARD, iface_match),
-                    "--append %s --jump ACCEPT --out-interface %s" %
-                        (CHAIN_FORWARD, iface_match),
-                ],
-                CHAIN_INPUT: [
-                    "--append %s --jump %s --in-interface %s" %
-                        (CHAIN_INPUT, CHAIN_FROM_ENDPOINT, iface_match),
-                    "--append %s --jump ACCEPT --in-interface %s" %
-                        (CHAIN_INPUT, iface_match),
-                ]
+                CHAIN_FORWARD: forward_rules,
+                CHAIN_INPUT: input_rules,
             },
             {
                 CHAIN_FORWARD: set([CHAIN_FROM_ENDPOINT, CHAIN_TO_ENDPOINT]),
@@ -139,6 +209,63 @@ def install_global_rules(config, v4_filter_updater, v6_filter_updater,
             async=False)
 
 
+def conntrack_fast_path_fragments(chain_name, ip_version, iface_match):
+    """
+    :returns: the rules that drop INVALID packets and accept established
+        flows that match the given interface match, ahead of the endpoint
+        chains.  In IPv6, the endpoint chains let some INVALID ICMPv6
+        through, so they keep their own INVALID check for ICMPv6.
+    """
+    not_icmpv6 = "! --protocol ipv6-icmp " if ip_version == 6 else ""
+    return [
+        "--append %s %s%s --match conntrack --ctstate INVALID --jump DROP" %
+            (chain_name, not_icmpv6, iface_match),
+        "--append %s %s --match conntrack --ctstate RELATED,ESTABLISHED "
+        "--jump ACCEPT" % (chain_name, iface_match),
+    ]
+
+
+def endpoint_to_chain_fragments(chain_name, ip_version, profile_in_chain,
+                                conntrack_fast_path=False):
+    """
+    :returns: the rules for a chain that polices traffic to an endpoint
+        with the given profile.  The chain doesn't depend on anything else
+        about the endpoint so, if ShareProfileToChains is configured, it is
+        shared by all the endpoints with the same profile.
+    """
+    to_chain = []
+    if ip_version == 6:
+        #  In ipv6 only, there are 6 rules that need to be created first.
+        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmptype 130
+        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmptype 131
+        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmptype 132
+        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmp router-advertisement
+        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmp neighbour-solicitation
+        #  RETURN ipv6-icmp anywhere anywhere ipv6-icmp neighbour-advertisement
+        #
+        #  These rules are ICMP types 130, 131, 132, 134, 135 and 136, and can
+        #  be created on the command line with something like :
+        #     ip6tables -A plw -j RETURN --protocol ipv6-icmp --icmpv6-type 130
+        for icmp_type in ["130", "131", "132", "134", "135", "136"]:
+            to_chain.append("--append %s --jump RETURN "
+                            "--protocol ipv6-icmp "
+                            "--icmpv6-type %s" % (chain_name, icmp_type))
+    if not conntrack_fast_path:
+        to_chain.append("--append %s --match conntrack --ctstate INVALID "
+                        "--jump DROP" % chain_name)
+        to_chain.append("--append %s --match conntrack "
+                        "--ctstate RELATED,ESTABLISHED --jump RETURN" %
+                        chain_name)
+    elif ip_version == 6:
+        # The global INVALID check skips ICMPv6 so that the rules above
+        # can see it.
+        to_chain.append("--append %s --protocol ipv6-icmp "
+                        "--match conntrack --ctstate INVALID --jump DROP" %
+                        chain_name)
+    to_chain.append("--append %s --goto %s" % (chain_name, profile_in_chain))
+    return to_chain
+
+
 def rules_to_chain_rewrite_lines(chain_name, rules, ip_version, tag_to_ipset,
                                  on_allow="ACCEPT", on_deny="DROP"):
     try:
@@ -161,6 +288,279 @@ def rules_to_chain_rewrite_lines(chain_name, rules, ip_version, tag_to_ipset,
                                         "ERROR failed to parse rules DROP:")]
 
 
+def net_set_ipset_key(nets):
+    """
+    :returns: the key that the IpsetManager uses for the hash:net ipset
+        that matches the given src_net_set/dst_net_set.
+    """
+    return "nets", tuple(nets)
+
+
+def port_set_ipset_key(ports):
+    """
+    :returns: the key that the IpsetManager uses for the bitmap:port ipset
+        that matches the given src_port_set/dst_port_set.
+    """
+    return "ports", tuple(ports)
+
+
+def rule_ipset_keys(rule):
+    """
+    :returns: dict mapping the keys added to the rule by optimise_rules()
+        to the key of the ipset that the IpsetManager uses for them.
+    """
+    keys = {}
+    for dirn in ("src", "dst"):
+        if rule.get(dirn + "_net_set"):
+            keys[dirn + "_net_set"] = net_set_ipset_key(
+                rule[dirn + "_net_set"])
+        if rule.get(dirn + "_port_set"):
+            keys[dirn + "_port_set"] = port_set_ipset_key(
+                rule[dirn + "_port_set"])
+    return keys
+
+
+def optimise_rules(rules, ip_version):
+    """
+    Rewrites a list of rules into an equivalent, and hopefully shorter,
+    list.  Rules are matched in order and the first match wins; the
+    output preserves that.  The rewrites are:
+
+    - rules for the other IP version are dropped and networks of the other
+      family are removed from rules (the renderer would ignore them anyway)
+    - rules that are shadowed by an earlier rule (including exact
+      duplicates) are dropped
+    - adjacent rules that differ only in their port lists are merged
+    - runs of at least NET_SET_MIN_SIZE adjacent rules that differ only in
+      src_net (or dst_net) are collapsed into one rule with a src_net_set
+      (or dst_net_set), which is matched using a hash:net ipset
+    - port lists that are too long for a single multiport match are
+      moved into a src_port_set (or dst_port_set), which is matched using
+      a bitmap:port ipset, rather than rendering the cross product of
+      multiport chunks.
+
+    If the rules can't be parsed, they are returned unaltered so that the
+    renderer can report the problem.
+
+    :param list[dict] rules: list of rule dicts.
+    :param ip_version: 4 or 6.
+    :returns list[dict]: optimised list of rule dicts.
+    """
+    try:
+        normalised = []
+        for rule in rules:
+            rule = _normalise_rule(rule, ip_version)
+            if rule is not None:
+                normalised.append(rule)
+        optimised = []
+        for rule in normalised:
+            if any(_rule_covers(r, rule) for r in optimised):
+                _log.debug("Dropping shadowed rule %s", rule)
+            else:
+                optimised.append(rule)
+        optimised = _merge_port_lists(optimised)
+        for dirn in ("src", "dst"):
+            optimised = _collapse_nets(optimised, dirn, ip_version)
+        optimised = _merge_port_lists(optimised)
+        return [_use_port_sets(r) for r in optimised]
+    except Exception:
+        _log.exception("Failed to optimise rules %s, using them as-is.",
+                       rules)
+        return rules
+
+
+def rule_key(rule):
+    """
+    :returns: a hashable, canonical representation of the rule.
+    """
+    return json.dumps(rule, sort_keys=True, separators=(",", ":"))
+
+
+def reorder_rules(rules, weights):
+    """
+    Sorts each maximal run of adjacent rules that share the same action
+    so that the rules with the highest weights come first.  Within such a
+    run, the order doesn't affect which action we take so this can't
+    change the semantics of the chain.
+
+    :param list[dict] rules: list of rule dicts.
+    :param dict weights: map from rule_key() to weight, for example the
+        number of packets that the rule matched.  Missing rules count as
+        zero.
+    :returns list[dict]: the reordered rules.  The sort is stable so
+        rules with equal weights keep their relative order.
+    """
+    reordered = []
+    run = []
+    sort_key = lambda r: -weights.get(rule_key(r), 0)
+    for rule in rules:
+        if run and _is_allow(rule) != _is_allow(run[0]):
+            reordered.extend(sorted(run, key=sort_key))
+            run = []
+        run.append(rule)
+    reordered.extend(sorted(run, key=sort_key))
+    return reordered
+
+
+def rules_traversed(rules, weights):
+    """
+    :returns: the mean number of rules that a packet that matches one of
+        the rules has to traverse, assuming packets match rules in
+        proportion to their weights.
+    """
+    total_weight = 0
+    total_traversed = 0
+    for position, rule in enumerate(rules, 1):
+        weight = weights.get(rule_key(rule), 0)
+        total_weight += weight
+        total_traversed += weight * position
+    if not total_weight:
+        return 0.0
+    return float(total_traversed) / total_weight
+
+
+def _is_allow(rule):
+    return rule.get("action", "allow") == "allow"
+
+
+def _normalise_rule(rule, ip_version):
+    """
+    :returns: a copy of the rule with no-op matches removed and the action
+        filled in, or None if the rule doesn't apply to this IP version.
+    """
+    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS
+    assert not unknown_keys, "Unknown keys: %s" % ", ".join(unknown_keys)
+    if rule.get("ip_version") not in (None, ip_version):
+        return None
+    rule = dict((k, v) for (k, v) in rule.iteritems()
+                if v is not None and v != [] and k != "ip_version")
+    for key in ("src_net", "dst_net"):
+        if key in rule and (":" in rule[key]) != (ip_version == 6):
+            del rule[key]
+    for key in ("src_ports", "dst_ports"):
+        if key in rule:
+            # Check the ports parse.
+            _port_ranges(rule[key])
+    rule["action"] = ("allow" if rule.get("action", "allow") == "allow"
+                      else "deny")
+    return rule
+
+
+def _rule_covers(rule, other):
+    """
+    :returns: True if every packet that matches other also matches rule.
+    """
+    for key in ("protocol", "src_tag", "dst_tag", "icmp_type"):
+        if key in rule and rule[key] != other.get(key):
+            return False
+    for key in ("src_net", "dst_net"):
+        if key in rule and (key not in other or
+                            netaddr.IPNetwork(other[key]) not in
+                            netaddr.IPNetwork(rule[key])):
+            return False
+    for key in ("src_ports", "dst_ports"):
+        if key in rule and (key not in other or
+                            not _ports_cover(rule[key], other[key])):
+            return False
+    return True
+
+
+def _port_ranges(ports):
+    """
+    :returns list[tuple]: list of (first, last) port ranges.
+    """
+    ranges = []
+    for port_or_range in ports:
+        parts = str(port_or_range).split(":")
+        assert len(parts) <= 2, "Invalid port range %s" % port_or_range
+        ranges.append((int(parts[0]), int(parts[-1])))
+    return ranges
+
+
+def _ports_cover(ports, other_ports):
+    """
+    :returns: True if every port in other_ports is in ports.
+    """
+    ranges = _port_ranges(ports)
+    for first, last in _port_ranges(other_ports):
+        if not any(f <= first and last <= l for (f, l) in ranges):
+            return False
+    return True
+
+
+def _without(rule, *keys):
+    return dict((k, v) for (k, v) in rule.iteritems() if k not in keys)
+
+
+def _merge_port_lists(rules):
+    """
+    Merges adjacent rules that differ only in one of their port lists.
+    Adjacent rules with the same action can be merged without affecting
+    first-match semantics.
+    """
+    merged = []
+    for rule in rules:
+        prev = merged[-1] if merged else None
+        for key in ("src_ports", "dst_ports"):
+            if (prev is not None and key in prev and key in rule and
+                    _without(prev, key) == _without(rule, key)):
+                ports = list(prev[key])
+                ports.extend(p for p in rule[key] if p not in ports)
+                prev[key] = ports
+                break
+        else:
+            merged.append(rule)
+    return merged
+
+
+def _collapse_nets(rules, dirn, ip_version):
+    """
+    Collapses runs of adjacent rules that differ only in their src_net or
+    dst_net into single rules that match on a set of networks.
+    """
+    net_key = dirn + "_net"
+    collapsed = []
+    run = []
+
+    def flush_run():
+        if len(run) >= NET_SET_MIN_SIZE:
+            rule = _without(run[0], net_key)
+            nets = sorted(set(r[net_key] for r in run))
+            rule[dirn + "_net_set"] = tuple(nets)
+            collapsed.append(rule)
+        else:
+            collapsed.extend(run)
+        del run[:]
+
+    for rule in rules:
+        # hash:net ipsets can't hold a /0, but such a rule would shadow the
+        # rest of the run anyway.
+        if (net_key not in rule or
+                netaddr.IPNetwork(rule[net_key]).prefixlen == 0):
+            flush_run()
+            collapsed.append(rule)
+        elif run and _without(run[0], net_key) != _without(rule, net_key):
+            flush_run()
+            run.append(rule)
+        else:
+            run.append(rule)
+    flush_run()
+    return collapsed
+
+
+def _use_port_sets(rule):
+    """
+    Moves port lists that don't fit in one multiport match into port sets.
+    """
+    for dirn in ("src", "dst"):
+        ports_key = dirn + "_ports"
+        if ports_key in rule and len(_split_port_lists(rule[ports_key])) > 1:
+            ranges = sorted(set(_port_ranges(rule.pop(ports_key))))
+            rule[dirn + "_port_set"] = tuple(
+                str(f) if f == l else "%s:%s" % (f, l) for (f, l) in ranges)
+    return rule
+
+
 def commented_drop_fragment(chain_name, comment):
     assert re.match(r'[\w: ]{,256}', comment), "Invalid comment %r" % comment
     return ('--append %s --jump DROP -m comment --comment "%s"' %
@@ -175,6 +575,10 @@ def rule_to_iptables_fragments(chain_name, rule, ip_version, tag_to_ipset,
 
     Most rules result in result list containing one item.
 
+    Rendered rules are cached without their chain name, so identical rules
+    in different profiles (and re-renders of the same profile) only need to
+    be converted once.
+
     :param str chain_name: Name of the chain this rule belongs to (used in the
            --append)
     :param dict[str,str|list|int] rule: Rule dict.
@@ -184,9 +588,46 @@ def rule_to_iptables_fragments(chain_name, rule, ip_version, tag_to_ipset,
            For example: "DROP".
     :return list[str]: iptables --append fragments.
     """
+    cache_key = _rule_cache_key(rule, ip_version, tag_to_ipset, on_allow,
+                                on_deny)
+    tails = _rule_cache.get(cache_key)
+    if tails is None:
+        tails = tuple(_rule_to_iptables_tails(rule, ip_version, tag_to_ipset,
+                                              on_allow, on_deny))
+        _rule_cache.put(cache_key, tails)
+    return ["--append %s %s" % (chain_name, tail) for tail in tails]
+
+
+def rule_cache_stats():
+    """
+    :returns: dict of hit/miss/eviction statistics for the rule cache.
+    """
+    return _rule_cache.stats()
+
+
+def _rule_cache_key(rule, ip_version, tag_to_ipset, on_allow, on_deny):
+    """
+    :returns: a hashable key that captures everything that affects the
+        rendering of the rule, apart from the chain name.
+    """
+    ipset_names = tuple(tag_to_ipset.get(rule.get(key))
+                        for key in ("src_tag", "dst_tag"))
+    ipset_names += tuple(sorted((key, tag_to_ipset.get(ipset_key))
+                                for key, ipset_key in
+                                rule_ipset_keys(rule).iteritems()))
+    return (rule_key(rule), ip_version, on_allow, on_deny, ipset_names)
+
+
+def _rule_to_iptables_tails(rule, ip_version, tag_to_ipset, on_allow,
+                            on_deny):
+    """
+    Does the work for rule_to_iptables_fragments().
 
+    :return list[str]: iptables fragments, without the leading
+           "--append <chain>".
+    """
     # Check we've not got any unknown fields.
-    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS
+    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS - OPTIMISED_RULE_KEYS
     assert not unknown_keys, "Unknown keys: %s" % ", ".join(unknown_keys)
 
     # Ports are special, we have a limit on the number of ports that can go in
@@ -199,16 +640,15 @@ def rule_to_iptables_fragments(chain_name, rule, ip_version, tag_to_ipset,
     src_port_chunks = _split_port_lists(src_ports)
     dst_port_chunks = _split_port_lists(dst_ports)
     rule_copy = dict(rule)  # Only need a shallow copy so we can replace ports.
-    fragments = []
+    tails = []
     for src_ports, dst_ports in itertools.product(src_port_chunks,
                                                   dst_port_chunks):
         rule_copy["src_ports"] = src_ports
         rule_copy["dst_ports"] = dst_ports
-        frag = _rule_to_iptables_fragment(chain_name, rule_copy, ip_version,
-                                          tag_to_ipset,  on_allow=on_allow,
-                                          on_deny=on_deny)
-        fragments.append(frag)
-    return fragments
+        tail = _rule_to_iptables_tail(rule_copy, ip_version, tag_to_ipset,
+                                      on_allow=on_allow, on_deny=on_deny)
+        tails.append(tail)
+    return tails
 
 
 def _split_port_lists(ports):
@@ -240,28 +680,26 @@ def _split_port_lists(ports):
     return chunks
 
 
-def _rule_to_iptables_fragment(chain_name, rule, ip_version, tag_to_ipset,
-                               on_allow="ACCEPT", on_deny="DROP"):
+def _rule_to_iptables_tail(rule, ip_version, tag_to_ipset,
+                           on_allow="ACCEPT", on_deny="DROP"):
     """
-    Convert a rule dict to an iptables fragment suitable to use with
-    iptables-restore.
+    Convert a rule dict to the part of an iptables fragment that follows
+    "--append <chain>".
 
-    :param str chain_name: Name of the chain this rule belongs to (used in the
-           --append)
     :param dict[str,str|list|int] rule: Rule dict.
     :param str on_allow: iptables action to use when the rule allows traffic.
            For example: "ACCEPT" or "RETURN".
     :param str on_deny: iptables action to use when the rule denies traffic.
            For example: "DROP".
-    :returns list[str]: list of iptables --append fragments.
+    :returns str: iptables fragment.
     """
 
     # Check we've not got any unknown fields.
-    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS
+    unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS - OPTIMISED_RULE_KEYS
     assert not unknown_keys, "Unknown keys: %s" % ", ".join(unknown_keys)
 
     # Build up the update in chunks and join them below.
-    update_fragments = ["--append", chain_name]
+    update_fragments = []
     append = lambda *args: update_fragments.extend(args)
 
     proto = None
@@ -287,6 +725,22 @@ def _rule_to_iptables_fragment(chain_name, rule, ip_version, tag_to_ipset,
             ipset_name = tag_to_ipset[rule[tag_key]]
             append("--match set", "--match-set", ipset_name, dirn)
 
+        # Set of networks, added by optimise_rules(), also an ipset.
+        net_set_key = dirn + "_net_set"
+        if rule.get(net_set_key):
+            ipset_name = tag_to_ipset[net_set_ipset_key(rule[net_set_key])]
+            append("--match set", "--match-set", ipset_name, dirn)
+
+        # Set of ports, added by optimise_rules() in place of a port list
+        # that is too long for multiport.
+        port_set_key = dirn + "_port_set"
+        if rule.get(port_set_key):
+            assert proto in ["tcp", "udp"], "Protocol %s not supported with " \
+                                            "%s (%s)" % (proto, port_set_key,
+                                                         rule)
+            ipset_name = tag_to_ipset[port_set_ipset_key(rule[port_set_key])]
+            append("--match set", "--match-set", ipset_name, dirn)
+
         # Port lists/ranges, which we map to multiport. Ignore not just "None"
         # but also an empty list.
         ports_key = dirn + "_ports"
@@ -25,6 +25,7 @@ import functools
 import hashlib
 import logging
 import os
+import random
 from gevent import subprocess
 import tempfile
 import time
@@ -168,3 +169,134 @@ def logging_exceptions(fn):
             log.exception("Exception in wrapped function %s", fn)
             raise
     return wrapped
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that evicts its least-recently-used entry when it is
+    full.  Counts hits, misses and evictions so that callers can report
+    on the cache's effectiveness.
+
+    Implemented with a dict and a circular doubly-linked list, since
+    OrderedDict isn't available on Python 2.6.
+    """
+    # Indexes into the linked list entries.
+    _PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+    def __init__(self, max_size):
+        assert max_size > 0
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        """
+        Removes all entries.  Doesn't reset the statistics.
+        """
+        self._entries = {}
+        # Sentinel for the linked list; root[_NEXT] is the least-recently
+        # used entry, root[_PREV] the most-recently used.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        :returns: the value for key, marking it as recently used, or default
+            if it isn't present.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(entry)
+        self._append(entry)
+        return entry[self._VALUE]
+
+    def put(self, key, value):
+        """
+        Stores value, evicting the least-recently used entry if the cache
+        is full.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._unlink(entry)
+            entry[self._VALUE] = value
+        else:
+            if len(self._entries) >= self.max_size:
+                oldest = self._root[self._NEXT]
+                self._unlink(oldest)
+                del self._entries[oldest[self._KEY]]
+                self.evictions += 1
+            entry = [None, None, key, value]
+            self._entries[key] = entry
+        self._append(entry)
+
+    def stats(self):
+        """
+        :returns: dict of statistics about the cache.
+        """
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _unlink(self, entry):
+        prev_entry, next_entry = entry[self._PREV], entry[self._NEXT]
+        prev_entry[self._NEXT] = next_entry
+        next_entry[self._PREV] = prev_entry
+
+    def _append(self, entry):
+        last = self._root[self._PREV]
+        entry[self._PREV] = last
+        entry[self._NEXT] = self._root
+        last[self._NEXT] = entry
+        self._root[self._PREV] = entry
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter, for retrying after errors.  Each
+    call to next_delay() doubles the delay, up to max_delay.  The delay
+    returned is randomised so that a fleet of hosts that hit the same
+    error don't all retry in step.
+    """
+    def __init__(self, initial_delay, max_delay, jitter=0.5):
+        """
+        :param initial_delay: delay, in seconds, before the first retry.
+        :param max_delay: maximum delay, in seconds.
+        :param jitter: fraction of the delay to randomise by, the delay
+            returned is between (1 - jitter) and (1 + jitter) times the
+            nominal delay.
+        """
+        assert 0 < initial_delay <= max_delay
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the delay to its initial value, call after a success.
+        """
+        self._delay = self.initial_delay
+
+    def next_delay(self):
+        """
+        :returns: the delay, in seconds, before the next retry.
+        """
+        delay = self._delay * random.uniform(1 - self.jitter,
+                                             1 + self.jitter)
+        self._delay = min(self._delay * 2, self.max_delay)
+        return delay
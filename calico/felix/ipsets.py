@@ -67,13 +67,34 @@ class IpsetManager(ReferenceManager):
         self.endpoint_ids_by_tag = defaultdict(set)
         self.endpoint_ids_by_profile_id = defaultdict(set)
 
+        # Map from ipset name to (type, members) for the ipsets that were
+        # in the dataplane at start of day, less any that we've since
+        # adopted or destroyed.  Loaded when we create our first ipset.
+        self._dataplane_ipsets = None
+
     def _create(self, tag_id):
+        if isinstance(tag_id, tuple):
+            # Set of networks or ports from the rules optimiser, see
+            # frules.rule_ipset_keys().  Its members are fixed.
+            kind, values = tag_id
+            name = futils.uniquely_shorten("%s:%s" % (kind, ",".join(values)),
+                                           16)
+            if kind == "nets":
+                active_ipset = self._new_ipset(name, set_type="hash:net")
+                members = set(values)
+            else:
+                assert kind == "ports", "Unknown ipset kind %s" % kind
+                active_ipset = self._new_ipset(name, set_type="bitmap:port")
+                # ipset uses "-" for port ranges, rather than ":".
+                members = set(v.replace(":", "-") for v in values)
+            active_ipset.replace_members(members, async=True)
+            return active_ipset
+
         # Create the ActiveIpset, and put a message on the queue that will
         # trigger it to update the ipset as soon as it starts. Note that we do
         # this now so that it is sure to be processed with the first batch even
         # if other messages are arriving.
-        active_ipset = ActiveIpset(futils.uniquely_shorten(tag_id, 16),
-                                   self.ip_type)
+        active_ipset = self._new_ipset(futils.uniquely_shorten(tag_id, 16))
 
         members = set()
         for ep_id in self.endpoint_ids_by_tag.get(tag_id, set()):
@@ -84,6 +105,22 @@ class IpsetManager(ReferenceManager):
         active_ipset.replace_members(members, async=True)
         return active_ipset
 
+    def _new_ipset(self, tag, set_type="hash:ip"):
+        """
+        :returns: a new, unstarted, actor to manage the set with the given
+            (shortened) tag and type.
+        """
+        if self._dataplane_ipsets is None:
+            self._dataplane_ipsets = load_ipset_state(
+                (IPSET_PREFIX[self.ip_type], IPSET_TMP_PREFIX[self.ip_type]))
+        dataplane_state = {}
+        for name in (tag_to_ipset_name(self.ip_type, tag),
+                     tag_to_ipset_name(self.ip_type, tag, tmp=True)):
+            if name in self._dataplane_ipsets:
+                dataplane_state[name] = self._dataplane_ipsets.pop(name)
+        return ActiveIpset(tag, self.ip_type, set_type=set_type,
+                           dataplane_state=dataplane_state or None)
+
     def _on_object_started(self, tag_id, ipset):
         _log.debug("ActiveIpset actor for %s started", tag_id)
 
@@ -143,10 +180,44 @@ class IpsetManager(ReferenceManager):
         for ipset_name in ipsets_to_delete:
             try:
                 futils.check_call(["ipset", "destroy", ipset_name])
+                if self._dataplane_ipsets is not None:
+                    self._dataplane_ipsets.pop(ipset_name, None)
             except FailedSystemCall:
                 _log.exception("Failed to clean up dead ipset %s, will "
                                "retry on next cleanup.", ipset_name)
 
+    @actor_message()
+    def reconcile(self):
+        """
+        Compares the ipsets that we've programmed against a single
+        "ipset save" and has any that have drifted reprogram themselves.
+
+        :returns int: the number of ipsets that were reprogrammed.
+        """
+        prefixes = (IPSET_PREFIX[self.ip_type], IPSET_TMP_PREFIX[self.ip_type])
+        data = futils.check_call(["ipset", "save"]).stdout
+        dataplane_ipsets = extract_ipset_state(data, prefixes)
+        results = []
+        for tag_id, ipset in self.objects_by_id.iteritems():
+            if not self._is_starting_or_live(tag_id):
+                continue
+            dataplane_state = dict((n, dataplane_ipsets[n])
+                                   for n in ipset.owned_ipset_names()
+                                   if n in dataplane_ipsets)
+            results.append((tag_id,
+                            ipset.reconcile(dataplane_state, async=True)))
+        num_repaired = 0
+        for tag_id, result in results:
+            # Wait for every result, even after a failure, or the failures
+            # that we didn't collect would be reported as leaked.
+            try:
+                if result.get():
+                    num_repaired += 1
+            except Exception:
+                _log.exception("Failed to reconcile ipset for %s, will "
+                               "retry next time.", tag_id)
+        return num_repaired
+
     @actor_message()
     def on_tags_update(self, profile_id, tags):
         """
@@ -268,12 +339,18 @@ class IpsetManager(ReferenceManager):
 
 class ActiveIpset(RefCountedActor):
 
-    def __init__(self, tag, ip_type):
+    def __init__(self, tag, ip_type, set_type="hash:ip",
+                 dataplane_state=None):
         """
         Actor managing a single ipset.
 
         :param str tag: Name of tag that this ipset represents.
         :param ip_type: IPV4 or IPV6
+        :param str set_type: ipset type, "hash:ip", "hash:net" or
+            "bitmap:port".
+        :param dict dataplane_state: map from ipset name to (type, members)
+            for this actor's ipsets that are already in the dataplane, as
+            returned by load_ipset_state(), or None to look them up.
         """
         super(ActiveIpset, self).__init__(qualifier=tag)
 
@@ -282,6 +359,7 @@ class ActiveIpset(RefCountedActor):
         self.name = tag_to_ipset_name(ip_type, tag)
         self.tmpname = tag_to_ipset_name(ip_type, tag, tmp=True)
         self.family = "inet" if ip_type == IPV4 else "inet6"
+        self.set_type = set_type
 
         # Members - which entries should be in the ipset.
         self.members = set()
@@ -289,13 +367,58 @@ class ActiveIpset(RefCountedActor):
         # Members which really are in the ipset.
         self.programmed_members = None
 
+        # Members that were in the ipset in the dataplane when we loaded
+        # it, in the form that "ipset save" reports them, if we've yet to
+        # check them against self.members.
+        self._dataplane_members = None
+
         # Do the sets exist?
-        self.set_exists = ipset_exists(self.name)
-        self.tmpset_exists = ipset_exists(self.tmpname)
+        if dataplane_state is None:
+            self.set_exists = ipset_exists(self.name)
+            self.tmpset_exists = ipset_exists(self.tmpname)
+        else:
+            self._load_dataplane_state(dataplane_state)
 
         # Notified ready?
         self.notified_ready = False
 
+    def _load_dataplane_state(self, dataplane_state):
+        """
+        Loads the given state of our ipsets in the dataplane so that we
+        only reprogram the ipset if its members are wrong.
+
+        :param dict dataplane_state: map from ipset name to (type, members)
+            for this actor's ipsets that are in the dataplane.
+        """
+        self.set_exists = self.name in dataplane_state
+        self.tmpset_exists = self.tmpname in dataplane_state
+        self.programmed_members = None
+        existing_type, existing_members = dataplane_state.get(self.name,
+                                                              (None, None))
+        if existing_type == self.set_type:
+            self._dataplane_members = self._canonical_members(
+                existing_members)
+        else:
+            self._dataplane_members = None
+
+    def _canonical_members(self, members):
+        """
+        :returns set[str]: the given members in the form that "ipset save"
+            reports them, for comparison with its output.
+        """
+        if self.set_type == "bitmap:port":
+            ports = set()
+            for member in members:
+                start, _, end = member.partition("-")
+                ports.update(str(p) for p in
+                             xrange(int(start), int(end or start) + 1))
+            return ports
+        elif self.set_type == "hash:net":
+            host_suffix = "/32" if self.ip_type == IPV4 else "/128"
+            return set(m[:-len(host_suffix)] if m.endswith(host_suffix)
+                       else m for m in members)
+        return set(members)
+
     def owned_ipset_names(self):
         """
         This method is safe to call from another greenlet; it only accesses
@@ -326,6 +449,31 @@ class ActiveIpset(RefCountedActor):
         except KeyError:
             _log.info("%s was not in ipset %s", member, self.name)
 
+    @actor_message()
+    def reconcile(self, dataplane_state):
+        """
+        Compares the given dataplane state of our ipsets against what we
+        last programmed.  If it has drifted, the ipset is reprogrammed at
+        the end of the batch.
+
+        :param dict dataplane_state: map from ipset name to (type, members)
+            for this actor's ipsets that are in the dataplane.
+        :returns bool: True if the ipset had drifted.
+        """
+        if self.programmed_members is None:
+            # We haven't programmed the ipset yet, nothing to check.
+            return False
+        programmed_members = self.programmed_members
+        self._load_dataplane_state(dataplane_state)
+        if (self._dataplane_members ==
+                self._canonical_members(programmed_members)):
+            self.programmed_members = programmed_members
+            self._dataplane_members = None
+            return False
+        _log.warning("ipset %s has drifted, reprogramming", self.name)
+        self._dataplane_members = None
+        return True
+
     @actor_message()
     def on_unreferenced(self):
         try:
@@ -341,6 +489,13 @@ class ActiveIpset(RefCountedActor):
         # the add_members / remove_members / replace_members calls actually
         # does any work, just updating state. The _finish_msg_batch call will
         # then program the real changes.
+        if self._dataplane_members is not None:
+            # First batch after loading the ipset from the dataplane.
+            canonical_members = self._canonical_members(self.members)
+            if canonical_members == self._dataplane_members:
+                _log.info("ipset %s is already programmed", self.name)
+                self.programmed_members = self.members.copy()
+            self._dataplane_members = None
         if self.members != self.programmed_members:
             self._sync_to_ipset()
 
@@ -370,8 +525,12 @@ class ActiveIpset(RefCountedActor):
             create = False
             swap = True
 
-        if create:
-            f.write("create %s hash:ip family %s\n" % (set_name, self.family))
+        if create and self.set_type == "bitmap:port":
+            # Port bitmaps have no family, but need to know their range.
+            f.write("create %s bitmap:port range 0-65535\n" % set_name)
+        elif create:
+            f.write("create %s %s family %s\n" % (set_name, self.set_type,
+                                                   self.family))
         else:
             f.write("flush %s\n" % (set_name))
 
@@ -408,6 +567,45 @@ def ipset_exists(name):
     return futils.call_silent(["ipset", "list", name]) == 0
 
 
+def load_ipset_state(prefixes):
+    """
+    Loads the type and members of all the ipsets with the given name
+    prefixes with a single "ipset save".
+
+    :param tuple[str] prefixes: prefixes of the ipset names to load.
+    :returns dict[str,tuple[str,set[str]]]: map from ipset name to
+        (type, members).
+    """
+    try:
+        data = futils.check_call(["ipset", "save"]).stdout
+    except FailedSystemCall:
+        _log.exception("Failed to load existing ipsets.")
+        return {}
+    return extract_ipset_state(data, prefixes)
+
+
+def extract_ipset_state(raw_save_output, prefixes):
+    """
+    Parses the output of "ipset save", which looks like this:
+
+        create felix-v4-tag hash:ip family inet hashsize 1024 maxelem 65536
+        add felix-v4-tag 10.0.0.1
+
+    :returns dict[str,tuple[str,set[str]]]: map from ipset name to
+        (type, members) for the ipsets with the given name prefixes.
+    """
+    ipsets = {}
+    for line in raw_save_output.splitlines():
+        words = line.split()
+        if len(words) < 3 or not words[1].startswith(prefixes):
+            continue
+        if words[0] == "create":
+            ipsets[words[1]] = (words[2], set())
+        elif words[0] == "add" and words[1] in ipsets:
+            ipsets[words[1]][1].add(words[2])
+    return ipsets
+
+
 def list_ipset_names():
     """
     List all names of ipsets. Note that this is *not* the same as the ipset
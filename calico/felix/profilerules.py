@@ -19,14 +19,27 @@ felix.profilerules
 ProfileRules actor, handles local profile chains.
 """
 
+import functools
 import logging
-from calico.felix.actor import actor_message
-from calico.felix.frules import (profile_to_chain_name,
-                                 rules_to_chain_rewrite_lines)
+
+import gevent
+
+from calico.felix.actor import actor_message, WorkTracker
+from calico.felix.frules import (CHAIN_PROFILE_PREFIX,
+                                 CHAIN_SHARED_PROFILE_PREFIX,
+                                 endpoint_to_chain_fragments,
+                                 optimise_rules, profile_to_chain_name,
+                                 reorder_rules, rule_ipset_keys, rule_key,
+                                 rules_to_chain_rewrite_lines,
+                                 rules_to_shared_chain, rules_traversed)
 from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
 
 _log = logging.getLogger(__name__)
 
+# Minimum fractional reduction in the mean number of rules that a packet
+# traverses before we reprogram a chain to put its hottest rules first.
+REORDER_MIN_GAIN = 0.1
+
 
 class RulesManager(ReferenceManager):
     """
@@ -36,19 +49,57 @@ class RulesManager(ReferenceManager):
 
     This class ensures that rules chains are properly quiesced
     before their Actors are deleted.
+
+    If ShareProfileChains is configured, the ProfileRules render their
+    rules into chains that are named after a hash of their contents and
+    hand them to this class, which ref-counts the shared chains across
+    profiles.  LocalEndpoints call watch_profile_chains() to learn the
+    names of their profile's shared chains and --goto them directly, so
+    there is no per-profile chain.  When a profile moves to new shared
+    chains, the old ones are only released once the watchers have
+    reprogrammed their chains.
+
+    If RuleReorderIntervalSecs is non-zero, this class reads the rules'
+    packet counters every interval and passes them to the ProfileRules,
+    which use them to put their hottest rules first.
     """
-    def __init__(self, ip_version, iptables_updater, ipset_manager):
+    def __init__(self, config, ip_version, iptables_updater, ipset_manager):
         super(RulesManager, self).__init__(qualifier="v%d" % ip_version)
+        self.config = config
         self.ip_version = ip_version
         self.iptables_updater = iptables_updater
         self.ipset_manager = ipset_manager
         self.rules_by_profile_id = {}
+        self.share_chains = config.SHARE_PROFILE_CHAINS
+        self.reorder_interval = config.RULE_REORDER_INT_SEC
+        self._counter_refresh_scheduled = False
+
+        # Shared chain state.
+        self.profiles_by_shared_chain = {}
+        """Map from shared chain name to set of profile IDs using it."""
+        self.shared_chains_by_profile = {}
+        """Map from profile ID to dict mapping direction to shared chain."""
+        self.programmed_shared_chains = set()
+        """Shared chains that the IptablesUpdater has confirmed."""
+        self._chain_watchers = {}
+        """Map from profile ID to set of callbacks watching its chains."""
+
+        # Changes accumulated during the current batch.
+        self._pending_updates = {}
+        self._pending_deps = {}
+        self._pending_deletes = set()
+        self._pending_callbacks = []
+        self._pending_switches = {}
+        """Map from profile ID to the shared chains that it moved off."""
 
     def _create(self, profile_id):
-        return ProfileRules(profile_id,
+        return ProfileRules(self.config,
+                            profile_id,
                             self.ip_version,
                             self.iptables_updater,
-                            self.ipset_manager)
+                            self.ipset_manager,
+                            rules_manager=(self if self.share_chains
+                                           else None))
 
     def _on_object_started(self, profile_id, active_profile):
         profile_or_none = self.rules_by_profile_id.get(profile_id)
@@ -68,6 +119,10 @@ class RulesManager(ReferenceManager):
         for dead_profile_id in missing_ids:
             self.on_rules_update(dead_profile_id, None)
 
+        if self.reorder_interval > 0 and not self._counter_refresh_scheduled:
+            self._schedule_counter_refresh()
+            self._counter_refresh_scheduled = True
+
     @actor_message()
     def on_rules_update(self, profile_id, profile):
         if profile_id is not None:
@@ -82,35 +137,253 @@ class RulesManager(ReferenceManager):
             ap = self.objects_by_id[profile_id]
             ap.on_profile_update(profile, async=True)
 
+    def _schedule_counter_refresh(self):
+        gevent.spawn_later(self.reorder_interval,
+                           functools.partial(self.refresh_rule_counters,
+                                             async=True))
+
+    @actor_message()
+    def refresh_rule_counters(self):
+        """
+        Reads the packet counters for all the profile chains in one pass
+        and hands them to the live ProfileRules.
+
+        Reschedules itself.
+        """
+        self._schedule_counter_refresh()
+        counters = self.iptables_updater.read_rule_counters(
+            (CHAIN_PROFILE_PREFIX, CHAIN_SHARED_PROFILE_PREFIX), async=False)
+        for profile_id, rules in self.objects_by_id.iteritems():
+            if not self._is_starting_or_live(profile_id):
+                continue
+            if self.share_chains:
+                chains = self.shared_chains_by_profile.get(profile_id, {})
+            else:
+                chains = rules.chain_names
+            counters_by_direction = dict(
+                (direction, counters[chain])
+                for direction, chain in chains.iteritems()
+                if chain in counters)
+            if counters_by_direction:
+                rules.on_rule_counters(counters_by_direction, async=True)
+
+    @actor_message()
+    def on_profile_chains_rendered(self, profile_id, shared_chains, callback,
+                                   to_updates=None, to_deps=None):
+        """
+        Called by a ProfileRules in shared-chain mode once it has rendered
+        its rules.
+
+        :param profile_id: ID of the profile.
+        :param shared_chains: dict mapping "inbound"/"outbound" to a tuple
+               of (shared chain name, list of rewrite lines).
+        :param callback: called with None or an exception once the
+               chains are programmed.
+        :param to_updates: the profile's to-chain, if any, which is
+               programmed along with the shared chains that it uses.
+        :param to_deps: the dependencies of to_updates.
+        """
+        _log.debug("Profile %s rendered shared chains %s", profile_id,
+                   shared_chains)
+        old_chains = self.shared_chains_by_profile.get(profile_id, {})
+        new_chains = {}
+        for direction, (chain_name, lines) in shared_chains.iteritems():
+            new_chains[direction] = chain_name
+            profiles = self.profiles_by_shared_chain.setdefault(chain_name,
+                                                                set())
+            profiles.add(profile_id)
+            self._pending_deletes.discard(chain_name)
+            if chain_name not in self.programmed_shared_chains:
+                _log.info("Shared chain %s not yet programmed, queueing it",
+                          chain_name)
+                self._pending_updates[chain_name] = lines
+        self._pending_updates.update(to_updates or {})
+        self._pending_deps.update(to_deps or {})
+        self.shared_chains_by_profile[profile_id] = new_chains
+        if new_chains != old_chains:
+            # Tell the watchers at the end of the batch and release the old
+            # chains once they've moved over.
+            self._pending_switches.setdefault(profile_id, old_chains)
+        self._pending_callbacks.append(callback)
+
+    @actor_message()
+    def on_profile_chains_released(self, profile_id):
+        """
+        Called by a ProfileRules in shared-chain mode when it is
+        unreferenced.  Releases its references to the shared chains; no
+        endpoint uses the profile any more.
+        """
+        _log.info("Profile %s released its shared chains", profile_id)
+        old_chains = self.shared_chains_by_profile.pop(profile_id, {})
+        old_chains.update(self._pending_switches.pop(profile_id, {}))
+        for chain_name in set(old_chains.itervalues()):
+            self._discard_shared_chain_ref(chain_name, profile_id, {})
+
+    @actor_message()
+    def watch_profile_chains(self, profile_id, callback):
+        """
+        Registers a callback to be told the names of the profile's shared
+        chains, now if they are known and then whenever they change.
+
+        :param callback: called with the profile ID and a dict mapping
+               "inbound"/"outbound" to the shared chain name.
+        """
+        self._chain_watchers.setdefault(profile_id, set()).add(callback)
+        chains = self.shared_chains_by_profile.get(profile_id)
+        if chains and profile_id not in self._pending_switches:
+            # Already sent to the IptablesUpdater, ahead of anything the
+            # watcher sends.
+            callback(profile_id, dict(chains))
+
+    @actor_message()
+    def unwatch_profile_chains(self, profile_id, callback):
+        watchers = self._chain_watchers.get(profile_id, set())
+        watchers.discard(callback)
+        if not watchers:
+            self._chain_watchers.pop(profile_id, None)
+
+    @actor_message()
+    def on_profile_chains_switched(self, profile_id, old_chains):
+        """
+        Called once the watchers of a profile have moved off its old
+        shared chains, which we can now release.
+        """
+        new_chains = self.shared_chains_by_profile.get(profile_id, {})
+        for chain_name in old_chains.itervalues():
+            self._discard_shared_chain_ref(chain_name, profile_id,
+                                           new_chains)
+
+    def _discard_shared_chain_ref(self, chain_name, profile_id, new_chains):
+        if chain_name in new_chains.values():
+            # Still in use by this profile.
+            return
+        profiles = self.profiles_by_shared_chain.get(chain_name)
+        if profiles is None:
+            # Already released.
+            return
+        profiles.discard(profile_id)
+        if not profiles:
+            _log.info("Shared chain %s no longer in use", chain_name)
+            self.profiles_by_shared_chain.pop(chain_name, None)
+            self.programmed_shared_chains.discard(chain_name)
+            self._pending_updates.pop(chain_name, None)
+            self._pending_deletes.add(chain_name)
+
+    @actor_message()
+    def on_shared_chains_programmed(self, chain_names, error):
+        """
+        Completion callback from the IptablesUpdater for a batch of
+        shared chains.
+        """
+        if error is not None:
+            _log.error("Failed to program shared chains %s: %r",
+                       chain_names, error)
+            return
+        for chain_name in chain_names:
+            if chain_name in self.profiles_by_shared_chain:
+                self.programmed_shared_chains.add(chain_name)
+
+    def _finish_msg_batch(self, batch, results):
+        """
+        Overrides Actor._finish_msg_batch() to send the shared chain updates
+        accumulated in this batch to the IptablesUpdater in one go.
+        """
+        super(RulesManager, self)._finish_msg_batch(batch, results)
+        if self._pending_updates:
+            shared_chains = [c for c in self._pending_updates
+                             if c in self.profiles_by_shared_chain]
+            callbacks = self._pending_callbacks
+            on_programmed = self.on_shared_chains_programmed
+
+            def callback(error):
+                on_programmed(shared_chains, error, async=True)
+                for cb in callbacks:
+                    cb(error)
+
+            self.iptables_updater.rewrite_chains(self._pending_updates,
+                                                 self._pending_deps,
+                                                 async=True,
+                                                 callback=callback)
+        else:
+            for cb in self._pending_callbacks:
+                cb(None)
+        if self._pending_deletes:
+            self.iptables_updater.delete_chains(self._pending_deletes,
+                                                async=True)
+        # Queued behind the rewrite so that the watchers' chains never
+        # reference a shared chain that doesn't exist yet.
+        for profile_id, old_chains in self._pending_switches.iteritems():
+            self._notify_chain_watchers(profile_id, old_chains)
+        self._pending_updates = {}
+        self._pending_deps = {}
+        self._pending_deletes = set()
+        self._pending_callbacks = []
+        self._pending_switches = {}
+
+    def _notify_chain_watchers(self, profile_id, old_chains):
+        chains = self.shared_chains_by_profile[profile_id]
+        on_switched = functools.partial(self.on_profile_chains_switched,
+                                        profile_id, old_chains, async=True)
+        tracker = WorkTracker("switch %s to %s" % (profile_id, chains),
+                              on_switched)
+        with tracker:
+            # Tracks the watchers' reprogramming through to the dataplane.
+            for callback in self._chain_watchers.get(profile_id, ()):
+                callback(profile_id, dict(chains))
+
 
 class ProfileRules(RefCountedActor):
     """
     Actor that owns the per-profile rules chains.
+
+    If ShareProfileToChains is configured, it also owns the profile's
+    to-chain, which the dispatch chains use in place of a to-chain per
+    endpoint.
     """
-    def __init__(self, profile_id, ip_version, iptables_updater, ipset_mgr):
+    def __init__(self, config, profile_id, ip_version, iptables_updater,
+                 ipset_mgr, rules_manager=None):
         super(ProfileRules, self).__init__(qualifier=profile_id)
         assert profile_id is not None
 
+        self.config = config
         self.id = profile_id
         self.ip_version = ip_version
         self.ipset_mgr = ipset_mgr
         self._iptables_updater = iptables_updater
+        self._rules_mgr = rules_manager
+        """RulesManager to hand our chains to, if sharing chains."""
         self.notified_ready = False
 
-        self.ipset_refs = RefHelper(self, ipset_mgr, self._maybe_update)
+        self.ipset_refs = RefHelper(self, ipset_mgr, self._on_ipsets_ready)
 
         self._profile = None
         """
         :type dict|None: filled in by first update.  Reset to None on delete.
         """
+        self._optimised_profile = None
+        """
+        :type dict|None: the inbound_rules and outbound_rules of _profile,
+            after passing through frules.optimise_rules().
+        """
         self.dead = False
 
+        self._dirty = False
+        """True if we need to reprogram our chains at the end of the batch."""
+
+        self._rule_weights = {}
+        """Map from direction to dict mapping rule_key() to packet count."""
+        self._programmed_rules = {}
+        """Map from direction to the list of rules that we last rendered."""
+
         self.chain_names = {
             "inbound": profile_to_chain_name("inbound", profile_id),
             "outbound": profile_to_chain_name("outbound", profile_id),
         }
         _log.info("Profile %s has chain names %s",
                   profile_id, self.chain_names)
+        self.to_chain_name = None
+        if config.SHARE_TO_CHAINS:
+            self.to_chain_name = profile_to_chain_name("to", profile_id)
 
     @actor_message()
     def on_profile_update(self, profile):
@@ -122,8 +395,9 @@ class ProfileRules(RefCountedActor):
         assert profile is None or profile["id"] == self.id
         assert not self.dead, "Shouldn't receive updates after we're dead."
 
-        old_tags = extract_tags_from_profile(self._profile)
-        new_tags = extract_tags_from_profile(profile)
+        optimised_profile = self._optimise_profile(profile)
+        old_tags = extract_tags_from_profile(self._optimised_profile)
+        new_tags = extract_tags_from_profile(optimised_profile)
 
         removed_tags = old_tags - new_tags
         added_tags = new_tags - old_tags
@@ -135,7 +409,38 @@ class ProfileRules(RefCountedActor):
             self.ipset_refs.acquire_ref(tag)
 
         self._profile = profile
-        self._maybe_update()
+        self._optimised_profile = optimised_profile
+        self._dirty = True
+
+    def _optimise_profile(self, profile):
+        """
+        :returns: dict containing the optimised inbound_rules and
+            outbound_rules of the profile, or None if profile is None.
+        """
+        if profile is None:
+            return None
+        optimised_profile = {}
+        for rules_key in ("inbound_rules", "outbound_rules"):
+            rules = profile.get(rules_key, [])
+            optimised_rules = optimise_rules(rules, self.ip_version)
+            _log.debug("Profile %s: optimised %s %s down to %s",
+                       self.id, len(rules), rules_key, len(optimised_rules))
+            optimised_profile[rules_key] = optimised_rules
+        return optimised_profile
+
+    def _on_ipsets_ready(self):
+        """
+        Callback from our RefHelper once all our ipsets are available.
+        """
+        self._dirty = True
+
+    def _finish_msg_batch(self, batch, results):
+        """
+        Overrides Actor._finish_msg_batch() to program our chains at most
+        once per batch.
+        """
+        if self._dirty:
+            self._maybe_update()
 
     def _maybe_update(self):
         if self.dead:
@@ -146,6 +451,7 @@ class ProfileRules(RefCountedActor):
         else:
             _log.info("Ready to program rules for %s", self.id)
             self._update_chains()
+            self._dirty = False
 
     @actor_message()
     def on_unreferenced(self):
@@ -156,14 +462,27 @@ class ProfileRules(RefCountedActor):
         try:
             _log.info("%s unreferenced, removing our chains", self)
             self.dead = True
+            self._dirty = False
+            # Any rewrite that we sent earlier is queued ahead of this
+            # delete.
             chains = []
-            for direction in ["inbound", "outbound"]:
-                chain_name = self.chain_names[direction]
-                chains.append(chain_name)
-            self._iptables_updater.delete_chains(chains, async=False)
+            if self._rules_mgr is not None:
+                # The manager owns the chains, it'll queue the release
+                # before our cleanup notification.
+                self._rules_mgr.on_profile_chains_released(self.id,
+                                                           async=True)
+            else:
+                for direction in ["inbound", "outbound"]:
+                    chain_name = self.chain_names[direction]
+                    chains.append(chain_name)
+            if self.to_chain_name is not None:
+                chains.append(self.to_chain_name)
+            if chains:
+                self._iptables_updater.delete_chains(chains, async=False)
             self.ipset_refs.discard_all()
             self.ipset_refs = None # Break ref cycle.
             self._profile = None
+            self._optimised_profile = None
         finally:
             self._notify_cleanup_complete()
 
@@ -171,33 +490,109 @@ class ProfileRules(RefCountedActor):
         """
         Updates the chains in the dataplane.
         """
-        _log.info("%s Programming iptables with our chains: %s")
+        _log.info("%s Programming iptables with our chains", self)
         updates = {}
+        tag_to_ip_set_name = {}
+        for tag, ipset in self.ipset_refs.iteritems():
+            tag_to_ip_set_name[tag] = ipset.name
         for direction in ("inbound", "outbound"):
             _log.debug("Updating %s chain for profile %s", direction,
                        self.id)
-            new_profile = self._profile or {}
+            new_profile = self._optimised_profile or {}
             _log.debug("Profile %s: %s", self.id, self._profile)
             rules_key = "%s_rules" % direction
-            new_rules = new_profile.get(rules_key, [])
-            chain_name = self.chain_names[direction]
-            tag_to_ip_set_name = {}
-            for tag, ipset in self.ipset_refs.iteritems():
-                tag_to_ip_set_name[tag] = ipset.name
-            updates[chain_name] = rules_to_chain_rewrite_lines(
-                chain_name,
-                new_rules,
-                self.ip_version,
-                tag_to_ip_set_name,
-                on_allow="RETURN")
+            new_rules = reorder_rules(new_profile.get(rules_key, []),
+                                      self._rule_weights.get(direction, {}))
+            self._programmed_rules[direction] = new_rules
+            if self._rules_mgr is not None:
+                updates[direction] = rules_to_shared_chain(
+                    direction,
+                    new_rules,
+                    self.ip_version,
+                    tag_to_ip_set_name,
+                    on_allow="RETURN")
+            else:
+                chain_name = self.chain_names[direction]
+                updates[chain_name] = rules_to_chain_rewrite_lines(
+                    chain_name,
+                    new_rules,
+                    self.ip_version,
+                    tag_to_ip_set_name,
+                    on_allow="RETURN")
         _log.debug("Queueing programming for rules %s: %s", self.id,
                    updates)
-        self._iptables_updater.rewrite_chains(updates, {}, async=False)
-        # TODO Isolate exceptions from programming the chains to this profile.
-        # PLW: Radical thought - could we just say that the profile should be
-        # OK, and therefore we don't care? In other words, do we need to handle
-        # the error cleverly in the short term, or could we just say that since
-        # we built the rules they really should always work.
+        to_updates = {}
+        to_deps = {}
+        if self.to_chain_name is not None:
+            if self._rules_mgr is not None:
+                in_chain_name = updates["inbound"][0]
+            else:
+                in_chain_name = self.chain_names["inbound"]
+            to_updates[self.to_chain_name] = endpoint_to_chain_fragments(
+                self.to_chain_name,
+                self.ip_version,
+                in_chain_name,
+                self.config.CONNTRACK_FAST_PATH)
+            to_deps[self.to_chain_name] = set([in_chain_name])
+        callback = functools.partial(self.on_chains_programmed, async=True)
+        if self._rules_mgr is not None:
+            self._rules_mgr.on_profile_chains_rendered(self.id, updates,
+                                                       callback,
+                                                       to_updates=to_updates,
+                                                       to_deps=to_deps,
+                                                       async=True)
+        else:
+            updates.update(to_updates)
+            self._iptables_updater.rewrite_chains(updates, to_deps,
+                                                  async=True,
+                                                  callback=callback)
+
+    @actor_message()
+    def on_rule_counters(self, counters_by_direction):
+        """
+        Called periodically, if enabled, with the packet counters of our
+        chains.  Reprograms the chains, with the hottest rules first, if
+        that reduces the number of rules that packets traverse by enough.
+
+        :param dict counters_by_direction: map from direction to the
+            packet count for each rule in the chain, in order.
+        """
+        if self.dead:
+            return
+        for direction, counters in counters_by_direction.iteritems():
+            rules = self._programmed_rules.get(direction, [])
+            if len(counters) != len(rules) + 1:
+                # Every rule renders to one line once optimised, plus the
+                # default DROP; if not, we can't attribute the counters.
+                _log.debug("%s: can't attribute %s counters to %s rules",
+                           self, len(counters), len(rules))
+                continue
+            weights = dict((rule_key(r), c) for (r, c) in zip(rules, counters))
+            self._rule_weights[direction] = weights
+            old_cost = rules_traversed(rules, weights)
+            new_cost = rules_traversed(reorder_rules(rules, weights), weights)
+            gain = (old_cost - new_cost) / old_cost if old_cost else 0
+            if gain >= REORDER_MIN_GAIN:
+                _log.info("%s: reordering %s rules reduces mean rules "
+                          "traversed from %.2f to %.2f", self, direction,
+                          old_cost, new_cost)
+                self._dirty = True
+
+    @actor_message()
+    def on_chains_programmed(self, error):
+        """
+        Completion callback from the IptablesUpdater.
+
+        :param error: None on success, or the exception.
+        """
+        if self.dead:
+            _log.debug("%s: ignoring programming result after death", self)
+            return
+        if error is not None:
+            # We built the rules so they really should always work; leave
+            # the old chains in place and retry on the next update.
+            _log.error("%s: failed to program chains: %r", self, error)
+            return
         if not self.notified_ready:
             self._notify_ready()
             self.notified_ready = True
@@ -214,5 +609,11 @@ def extract_tags_from_profile(profile):
 
 
 def extract_tags_from_rule(rule):
-    return set(rule[key] for key in ["src_tag", "dst_tag"]
+    """
+    :returns: set of the ipset keys used by the rule; that is, its tags
+        plus keys for any sets of networks or ports added by the optimiser.
+    """
+    tags = set(rule[key] for key in ["src_tag", "dst_tag"]
                if key in rule and rule[key] is not None)
+    tags.update(rule_ipset_keys(rule).itervalues())
+    return tags
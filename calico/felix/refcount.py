@@ -118,6 +118,7 @@ class ReferenceManager(Actor):
             _log.debug("No more references to object with id %s", object_id)
             if obj.ref_mgmt_state == CREATED:
                 _log.debug("%s was never started, discarding", obj)
+                obj._discard_queued_messages()
             else:
                 _log.debug("%s is running, cleaning it up", obj)
                 obj.ref_mgmt_state = STOPPING
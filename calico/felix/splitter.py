@@ -21,22 +21,38 @@ Simple object that just splits notifications out for IPv4 and IPv6.
 """
 import functools
 import logging
+import random
+import time
 import gevent
-from calico.felix.actor import Actor, actor_message
+from calico.felix.actor import Actor, actor_message, WorkTracker
+from calico.felix.frules import install_metadata_rules
 
 _log = logging.getLogger(__name__)
 
+# Fraction by which we randomly vary the dataplane reconcile interval so
+# that hosts don't all do their reconcile in step.
+RECONCILE_JITTER = 0.1
+
 
 class UpdateSplitter(Actor):
     def __init__(self, config, ipsets_mgrs, rules_managers, endpoint_managers,
-                 iptables_updaters):
+                 iptables_updaters, nat_updaters=()):
         super(UpdateSplitter, self).__init__()
         self.config = config
         self.ipsets_mgrs = ipsets_mgrs
         self.iptables_updaters = iptables_updaters
+        self.nat_updaters = list(nat_updaters)
         self.rules_mgrs = rules_managers
         self.endpoint_mgrs = endpoint_managers
-        self._cleanup_scheduled = False
+        # Greenlet that will trigger the next dataplane reconcile, if one
+        # is scheduled.
+        self._reconcile_greenlet = None
+        # Greenlet running the current dataplane reconcile, if any.
+        self._reconcile_worker = None
+        # Generation number of the most recent snapshot and of the most
+        # recent snapshot that has been fully applied to the dataplane.
+        self._snapshot_generation = 0
+        self._converged_generation = 0
 
     @actor_message()
     def apply_snapshot(self, rules_by_prof_id, tags_by_prof_id,
@@ -44,46 +60,76 @@ class UpdateSplitter(Actor):
         """
         Replaces the whole cache state with the input.  Applies deltas vs the
         current active state.
+
+        Once all the work that the snapshot triggers has been committed to
+        the dataplane, cleans up orphaned ipsets and chains.
         """
-        # Step 1: fire in data update events to the profile and tag managers
-        # so they can build their indexes before we activate anything.
-        _log.info("Applying snapshot. STAGE 1a: rules.")
-        for rules_mgr in self.rules_mgrs:
-            rules_mgr.apply_snapshot(rules_by_prof_id, async=True)
-        _log.info("Applying snapshot. STAGE 1b: tags.")
-        for ipset_mgr in self.ipsets_mgrs:
-            ipset_mgr.apply_snapshot(tags_by_prof_id, endpoints_by_id,
-                                     async=True)
+        self._snapshot_generation += 1
+        generation = self._snapshot_generation
+        tracker = WorkTracker("snapshot %s" % generation,
+                              functools.partial(self.on_snapshot_converged,
+                                                generation, time.time(),
+                                                async=True))
+        # Any messages that we send inside the with block, and the messages
+        # that they trigger, are tracked.
+        with tracker:
+            # Step 1: fire in data update events to the profile and tag
+            # managers so they can build their indexes before we activate
+            # anything.
+            _log.info("Applying snapshot. STAGE 1a: rules.")
+            for rules_mgr in self.rules_mgrs:
+                rules_mgr.apply_snapshot(rules_by_prof_id, async=True)
+            _log.info("Applying snapshot. STAGE 1b: tags.")
+            for ipset_mgr in self.ipsets_mgrs:
+                ipset_mgr.apply_snapshot(tags_by_prof_id, endpoints_by_id,
+                                         async=True)
 
-        # Step 2: fire in update events into the endpoint manager, which will
-        # recursively trigger activation of profiles and tags.
-        _log.info("Applying snapshot. STAGE 2: endpoints->endpoint mgr.")
-        for ep_mgr in self.endpoint_mgrs:
-            ep_mgr.apply_snapshot(endpoints_by_id, async=True)
+            # Step 2: fire in update events into the endpoint manager, which
+            # will recursively trigger activation of profiles and tags.
+            _log.info("Applying snapshot. STAGE 2: endpoints->endpoint mgr.")
+            for ep_mgr in self.endpoint_mgrs:
+                ep_mgr.apply_snapshot(endpoints_by_id, async=True)
 
         _log.info("Applying snapshot. DONE. %s rules, %s tags, "
                   "%s endpoints", len(rules_by_prof_id), len(tags_by_prof_id),
                   len(endpoints_by_id))
 
-        # Since we don't wait for all the above processing to finish, set a
-        # timer to clean up orphaned ipsets and tables later.  If the snapshot
-        # takes longer than this timer to apply then we might do the cleanup
-        # before the snapshot is finished.  That would cause dropped packets
-        # until applying the snapshot finishes.
-        if not self._cleanup_scheduled:
-            _log.info("No cleanup scheduled, scheduling one.")
-            gevent.spawn_later(self.config.STARTUP_CLEANUP_DELAY,
-                               functools.partial(self.trigger_cleanup,
-                                                 async=True))
-            self._cleanup_scheduled = True
+        # We expect the snapshot to converge well before the old cleanup
+        # delay, warn if it doesn't.
+        gevent.spawn_later(self.config.STARTUP_CLEANUP_DELAY,
+                           self._check_snapshot_converged, generation)
+
+        if self._reconcile_greenlet is None:
+            self._schedule_reconcile()
+
+    @actor_message()
+    def on_snapshot_converged(self, generation, start_time):
+        """
+        Called once all the work triggered by the given snapshot has been
+        committed to the dataplane.
+        """
+        _log.info("Snapshot %s converged in %.2fs", generation,
+                  time.time() - start_time)
+        self._converged_generation = max(self._converged_generation,
+                                         generation)
+        if generation == self._snapshot_generation:
+            self.trigger_cleanup()
+        else:
+            # A newer snapshot is in progress, it may use ipsets and chains
+            # that this one doesn't.  Wait for it to converge.
+            _log.info("Snapshot %s has been superseded, not cleaning up",
+                      generation)
+
+    def _check_snapshot_converged(self, generation):
+        if self._converged_generation < generation:
+            _log.warning("Snapshot %s still hasn't converged after %ss",
+                         generation, self.config.STARTUP_CLEANUP_DELAY)
 
     @actor_message()
     def trigger_cleanup(self):
         """
-        Called from a separate greenlet, asks the managers to clean up
-        unused ipsets and iptables.
+        Asks the managers to clean up unused ipsets and iptables.
         """
-        self._cleanup_scheduled = False
         _log.info("Triggering a cleanup of orphaned ipsets/chains")
         try:
             # Need to clean up iptables first because they reference ipsets
@@ -99,6 +145,105 @@ class UpdateSplitter(Actor):
         except Exception:
             _log.exception("ipsets cleanup failed, will retry on resync.")
 
+    @actor_message()
+    def on_config_update(self, changed):
+        """
+        Applies a change to the config while Felix is running.
+
+        :param set[str] changed: names of the config attributes that have
+            changed.  Those in config.RESTART_REQUIRED never get here.
+        """
+        if changed & set(["METADATA_IP", "METADATA_PORT"]):
+            _log.info("Metadata config changed, updating NAT rules.")
+            for nat_updater in self.nat_updaters:
+                install_metadata_rules(self.config, nat_updater)
+        if "RESYNC_INT_SEC" in changed and self._snapshot_generation:
+            # Replace the pending reconcile so that a shorter interval
+            # takes effect now rather than after the old one.
+            _log.info("Dataplane reconcile interval changed to %ss",
+                      self.config.RESYNC_INT_SEC)
+            self._schedule_reconcile()
+
+    def _schedule_reconcile(self):
+        if self._reconcile_greenlet is not None:
+            self._reconcile_greenlet.kill(block=False)
+            self._reconcile_greenlet = None
+        if self.config.RESYNC_INT_SEC <= 0:
+            _log.debug("Periodic dataplane reconcile disabled")
+            return
+        delay = self.config.RESYNC_INT_SEC * random.uniform(
+            1 - RECONCILE_JITTER, 1 + RECONCILE_JITTER)
+        _log.debug("Next dataplane reconcile in %.1fs", delay)
+        self._reconcile_greenlet = gevent.spawn_later(
+            delay, functools.partial(self.reconcile_dataplane, async=True))
+
+    @actor_message()
+    def reconcile_dataplane(self):
+        """
+        Called periodically from a separate greenlet, asks the managers
+        to compare their programmed state against the dataplane and to
+        repair anything that has drifted, for example because another
+        tool modified it.
+
+        The reconcile runs in its own greenlet so that we carry on
+        passing updates from etcd to the managers while it runs.
+
+        Reschedules itself.
+        """
+        self._schedule_reconcile()
+        if (self._reconcile_worker is not None and
+                not self._reconcile_worker.ready()):
+            _log.warning("Previous dataplane reconcile still running, "
+                         "skipping this one.")
+            return
+        self._reconcile_worker = gevent.spawn(self._reconcile_dataplane)
+
+    def _reconcile_dataplane(self):
+        """
+        Runs in its own greenlet.  Sends the reconcile requests to the
+        managers and waits for the results.  Only sends messages, it
+        doesn't touch our state.
+        """
+        _log.info("Reconciling dataplane state")
+        start = time.time()
+        # Reconcile ipsets before iptables because the iptables rules
+        # reference them.  The actors of each kind work in parallel.
+        repairs = []
+        for what, actors in [("ipsets", self.ipsets_mgrs),
+                             ("chains", (self.iptables_updaters +
+                                         self.nat_updaters)),
+                             ("routes", self.endpoint_mgrs)]:
+            results = [actor.reconcile(async=True) for actor in actors]
+            num_repaired = 0
+            for result in results:
+                try:
+                    num_repaired += result.get()
+                except Exception:
+                    _log.exception("Failed to reconcile %s, will retry next "
+                                   "time.", what)
+            repairs.append("%s %s" % (num_repaired, what))
+        _log.info("Dataplane reconcile finished in %.2fs, repaired: %s",
+                  time.time() - start, ", ".join(repairs))
+
+    @actor_message()
+    def on_updates(self, updates):
+        """
+        Processes a batch of updates from etcd in one go.
+
+        :param list[tuple] updates: list of (update type, ID, value) where
+            the update type is "rules", "tags" or "endpoint" and the ID and
+            value are as for the corresponding on_..._update method.
+        """
+        _log.debug("Processing batch of %s updates", len(updates))
+        handlers = {
+            "rules": self.on_rules_update,
+            "tags": self.on_tags_update,
+            "endpoint": self.on_endpoint_update,
+        }
+        for update_type, obj_id, value in updates:
+            # Calls to our own messages are processed immediately.
+            handlers[update_type](obj_id, value)
+
     @actor_message()
     def on_rules_update(self, profile_id, rules):
         """
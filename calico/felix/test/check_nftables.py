@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.check_nftables
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Manual functional test and benchmark of the nftables dataplane.  Not a
+test case because it needs to be run as root, with nft (and, for the
+benchmark, iptables-restore) installed:
+
+    python -m calico.felix.test.check_nftables
+
+It creates a pair of network namespaces, one for "Felix" and one for an
+endpoint, joined by a veth, and re-runs itself inside the first.  The
+namespaces are deleted afterwards.
+"""
+import logging
+from subprocess import call, check_call, check_output, CalledProcessError
+import sys
+import time
+
+from calico.felix.dispatch import DispatchChains
+from calico.felix.endpoint import _get_endpoint_rules, chain_names
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.fnftables import (NftablesDispatchChains, NftablesUpdater,
+                                    TO_ENDPOINT_MAP, FROM_ENDPOINT_MAP)
+from calico.felix.frules import (install_global_rules,
+                                 rules_to_chain_rewrite_lines)
+
+_log = logging.getLogger(__name__)
+
+HOST_NS = "felix-nft-host"
+EP_NS = "felix-nft-ep"
+IFACE = "tapnftchk"
+HOST_IP = "10.65.0.1"
+EP_IP = "10.65.0.2"
+PROFILE_ID = "prof1"
+
+BENCHMARK_SIZES = [100, 1000]
+
+
+class Config(object):
+    IFACE_PREFIX = "tap"
+    METADATA_IP = None
+    METADATA_PORT = None
+    CONNTRACK_FAST_PATH = False
+
+
+def setup_namespaces():
+    teardown_namespaces()
+    check_call(["ip", "netns", "add", HOST_NS])
+    check_call(["ip", "netns", "add", EP_NS])
+    check_call(["ip", "link", "add", IFACE, "netns", HOST_NS,
+                "type", "veth", "peer", "name", "eth0", "netns", EP_NS])
+    in_ns(HOST_NS, ["ip", "addr", "add", HOST_IP + "/24", "dev", IFACE])
+    in_ns(HOST_NS, ["ip", "link", "set", IFACE, "up"])
+    in_ns(EP_NS, ["ip", "addr", "add", EP_IP + "/24", "dev", "eth0"])
+    in_ns(EP_NS, ["ip", "link", "set", "eth0", "up"])
+
+
+def teardown_namespaces():
+    for ns in (HOST_NS, EP_NS):
+        call(["ip", "netns", "delete", ns])
+
+
+def in_ns(ns, cmd):
+    check_call(["ip", "netns", "exec", ns] + cmd)
+
+
+def ping_ok():
+    """
+    :returns: True if the endpoint can ping the host.
+    """
+    return call(["ip", "netns", "exec", EP_NS,
+                 "ping", "-c", "1", "-W", "1", HOST_IP]) == 0
+
+
+def profile_chains(allow_outbound):
+    updates = {}
+    for direction, suffix, allow in [("inbound", "i", True),
+                                     ("outbound", "o", allow_outbound)]:
+        chain = "felix-p-%s-%s" % (PROFILE_ID, suffix)
+        rules = [{"action": "allow" if allow else "deny"}]
+        updates[chain] = rules_to_chain_rewrite_lines(chain, rules, 4, {},
+                                                      on_allow="RETURN")
+    return updates
+
+
+def program_endpoint(updater, mac):
+    updates, deps = _get_endpoint_rules(IFACE[3:], IFACE, 4, [EP_IP], mac,
+                                        PROFILE_ID)
+    updater.rewrite_chains(updates, deps, async=False)
+
+
+def check_functional():
+    config = Config()
+    v4_updater = NftablesUpdater("filter", ip_version=4)
+    v6_updater = NftablesUpdater("filter", ip_version=6)
+    nat_updater = NftablesUpdater("nat", ip_version=4)
+    dispatch = NftablesDispatchChains(config, 4, v4_updater)
+    for actor in (v4_updater, v6_updater, nat_updater, dispatch):
+        actor.start()
+    install_global_rules(config, v4_updater, v6_updater, nat_updater)
+    mac = check_output(["ip", "netns", "exec", EP_NS, "cat",
+                        "/sys/class/net/eth0/address"]).strip()
+
+    print "-------"
+    print "Test: Endpoint with an allow profile can reach the host."
+    print "-------"
+    v4_updater.rewrite_chains(profile_chains(True), {}, async=False)
+    program_endpoint(v4_updater, mac)
+    dispatch.on_endpoint_added(IFACE, "ep1", async=False)
+    maps = check_output(["nft", "list", "map", "ip", "felix-filter",
+                         FROM_ENDPOINT_MAP])
+    print maps
+    assert IFACE in maps, "Expected %s in the verdict map" % IFACE
+    assert ping_ok(), "Expected ping to succeed"
+    print "OK"
+
+    print "-------"
+    print "Test: Deny profile blocks the endpoint."
+    print "-------"
+    v4_updater.rewrite_chains(profile_chains(False), {}, async=False)
+    assert not ping_ok(), "Expected ping to fail"
+    print "OK"
+
+    print "-------"
+    print "Test: Endpoint removed from the verdict maps is dropped."
+    print "-------"
+    v4_updater.rewrite_chains(profile_chains(True), {}, async=False)
+    dispatch.on_endpoint_removed(IFACE, async=False)
+    maps = check_output(["nft", "list", "map", "ip", "felix-filter",
+                         TO_ENDPOINT_MAP])
+    assert IFACE not in maps, "Expected %s to be removed" % IFACE
+    assert not ping_ok(), "Expected ping to fail"
+    v4_updater.delete_chains(chain_names(IFACE[3:]), async=False)
+    print "OK"
+
+
+def benchmark():
+    """
+    Compares the time to commit the chains for N endpoints, and then to
+    add one more endpoint, and the number of dispatch rules that a packet
+    traverses.
+    """
+    config = Config()
+    print "-------"
+    print "Benchmark: commit latency and dispatch rules per packet."
+    print "-------"
+    print "%-10s %8s %12s %12s %14s" % ("backend", "N", "commit N (s)",
+                                       "add 1 (s)", "rules/packet")
+    for backend in ("iptables", "nftables"):
+        for n in BENCHMARK_SIZES:
+            if backend == "nftables":
+                updater = NftablesUpdater("filter", ip_version=4)
+                dispatch = NftablesDispatchChains(config, 4, updater)
+            else:
+                updater = IptablesUpdater("filter", ip_version=4)
+                dispatch = DispatchChains(config, 4, updater)
+            updater.start()
+            dispatch.start()
+            ifaces = ["tap%05x" % i for i in xrange(n + 1)]
+            updates = {}
+            deps = {}
+            for iface in ifaces:
+                upd, dep = _get_endpoint_rules(iface[3:], iface, 4,
+                                               ["10.66.0.1"],
+                                               "aa:bb:cc:dd:ee:ff",
+                                               PROFILE_ID)
+                updates.update(upd)
+                deps.update(dep)
+            start = time.time()
+            updater.rewrite_chains(updates, deps, async=False)
+            dispatch.apply_snapshot(dict((i, i) for i in ifaces[:-1]),
+                                    async=False)
+            commit_time = time.time() - start
+            start = time.time()
+            dispatch.on_endpoint_added(ifaces[-1], ifaces[-1], async=False)
+            add_time = time.time() - start
+            if backend == "nftables":
+                rules_per_packet = 1.0
+            else:
+                rules_per_packet = dispatch_rules_per_packet(ifaces)
+            print "%-10s %8s %12.3f %12.3f %14.1f" % (
+                backend, n, commit_time, add_time, rules_per_packet)
+            cleanup_tables()
+
+
+def dispatch_rules_per_packet(ifaces):
+    """
+    :returns: the mean number of rules in the iptables dispatch chains
+        that a packet to one of the interfaces traverses.
+    """
+    total = 0
+    output = check_output(["iptables-save", "--table", "filter"])
+    rules = [l.split() for l in output.splitlines() if l.startswith("-A ")]
+    for iface in ifaces:
+        chain = "felix-TO-ENDPOINT"
+        while chain is not None:
+            next_chain = None
+            for words in [w for w in rules if w[1] == chain]:
+                total += 1
+                if "-o" not in words:
+                    continue
+                match = words[words.index("-o") + 1]
+                if match == iface or (match.endswith("+") and
+                                      iface.startswith(match[:-1])):
+                    target = words[words.index("-g") + 1]
+                    if target.startswith("felix-TO-EP-PFX-"):
+                        next_chain = target
+                    break
+            chain = next_chain
+    return float(total) / len(ifaces)
+
+
+def cleanup_tables():
+    call(["nft", "delete", "table", "ip", "felix-filter"])
+    call(["iptables", "--table", "filter", "--flush"])
+    call(["iptables", "--table", "filter", "--delete-chain"])
+
+
+def main():
+    if "--in-namespace" in sys.argv:
+        try:
+            check_functional()
+            cleanup_tables()
+            benchmark()
+        finally:
+            cleanup_tables()
+        return
+    try:
+        setup_namespaces()
+        check_call(["ip", "netns", "exec", HOST_NS, sys.executable, "-m",
+                    "calico.felix.test.check_nftables", "--in-namespace"])
+    except CalledProcessError:
+        print "FAILED"
+        sys.exit(1)
+    finally:
+        print "-------"
+        print "Cleaning up..."
+        teardown_namespaces()
+
+if __name__ == "__main__":
+    main()
@@ -83,6 +83,25 @@ class TestActor(BaseTestCase):
         # Then we should get a start, batch of only a and a finish.
         self.assertEqual(self._actor.actions, ["sb", "a", "a", "b", "a", "fb"])
 
+    def test_work_tracker(self):
+        """
+        Tests that a WorkTracker follows the messages that are sent while
+        processing a tracked message.
+        """
+        other = ActorForTesting()
+        m_callback = mock.Mock()
+        with actor.WorkTracker("test", m_callback):
+            self._actor.do_forward(other, async=True)
+        # An untracked message in the same batch doesn't hold it up.
+        other.do_b(async=True)
+        self.assertFalse(m_callback.called)
+        self.run_actor_loop()
+        # The forwarded message is still queued.
+        self.assertFalse(m_callback.called)
+        other._step()
+        m_callback.assert_called_once_with()
+        self.assertEqual(other.actions, ["sb", "b", "a", "fb"])
+
     def test_exception(self):
         """
         Tests an exception raised by an event method is returned to the
@@ -282,6 +301,11 @@ class ActorForTesting(actor.Actor):
     def do_c2(self):
         return "c2"
 
+    @actor_message()
+    def do_forward(self, other):
+        self._batch_actions.append("forward")
+        other.do_a(async=True)
+
     @actor_message(needs_own_batch=True)
     def do_own_batch(self):
         self._batch_actions.append("own")
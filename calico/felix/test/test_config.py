@@ -22,7 +22,7 @@ Top level tests for Felix configuration.
 from collections import namedtuple
 import etcd
 import logging
-from mock import patch
+from mock import Mock, patch
 import socket
 import sys
 from calico.felix.config import Config, ConfigException
@@ -101,6 +101,13 @@ class TestConfig(unittest.TestCase):
             self.assertEqual(config.HOSTNAME, host)
             self.assertEqual(config.IFACE_PREFIX, "blah")
             self.assertEqual(config.RESYNC_INT_SEC, 123)
+            self.assertEqual(config.ROUTE_REFRESH_INT_SEC, 60)
+            self.assertFalse(config.SHARE_PROFILE_CHAINS)
+            self.assertFalse(config.SHARE_TO_CHAINS)
+            self.assertEqual(config.RULE_REORDER_INT_SEC, 0)
+            self.assertFalse(config.CONNTRACK_FAST_PATH)
+            self.assertEqual(config.ANTI_SPOOF_IPSET_THRESHOLD, 0)
+            self.assertEqual(config.DATAPLANE_DRIVER, "iptables")
 
     def test_invalid_port(self):
 
@@ -136,6 +143,30 @@ class TestConfig(unittest.TestCase):
 
         self.assertEqual(config.LOGFILE, None)
 
+    def test_update_config_changes(self):
+        config = Config("calico/felix/test/data/felix_missing.cfg")
+        config.update_config({"InterfacePrefix": "blah"})
+
+        # Reloading the same config changes nothing.
+        changed = config.update_config({"InterfacePrefix": "blah"})
+        self.assertEqual(changed, set())
+
+        changed = config.update_config({"InterfacePrefix": "blah",
+                                        "LogSeverityFile": "DEBUG",
+                                        "ResyncIntervalSecs": "10"})
+        self.assertEqual(changed, set(["LOGLEVFILE", "RESYNC_INT_SEC"]))
+        self.assertEqual(config.RESYNC_INT_SEC, 10)
+
+        # Invalid config leaves the old values in place.
+        with self.assertRaisesRegexp(ConfigException,
+                                     "Invalid DataplaneDriver"):
+            config.update_config({"InterfacePrefix": "other",
+                                  "DataplaneDriver": "foo"})
+        self.assertEqual(config.IFACE_PREFIX, "blah")
+        self.assertEqual(config.DATAPLANE_DRIVER, "iptables")
+        self.assertEqual(config.RESYNC_INT_SEC, 10)
+        self.assertEqual(config.LOGLEVFILE, logging.DEBUG)
+
     def xtest_no_metadata(self):
         # Metadata can be excluded by explicitly saying "none"
         host = socket.gethostname()
@@ -149,7 +180,7 @@ class TestConfig(unittest.TestCase):
         result = StubEtcdResult(host_path)
 
         config = Config("calico/felix/test/data/felix_missing.cfg")
-        etcd_watcher = EtcdWatcher(config)
+        etcd_watcher = EtcdWatcher(config, Mock())
         result = etcd_watcher.load_config(async=True)
         result.get()
 
@@ -169,7 +200,7 @@ class TestConfig(unittest.TestCase):
             result = StubEtcdResult(host_path)
 
             config = Config("calico/felix/test/data/felix_missing.cfg")
-            etcd_watcher = EtcdWatcher(config)
+            etcd_watcher = EtcdWatcher(config, Mock())
             result = etcd_watcher.load_config(async=True)
             result.get()
 
@@ -186,7 +217,7 @@ class TestConfig(unittest.TestCase):
             result = StubEtcdResult(host_path)
 
             config = Config("calico/felix/test/data/felix_missing.cfg")
-            etcd_watcher = EtcdWatcher(config)
+            etcd_watcher = EtcdWatcher(config, Mock())
             result = etcd_watcher.load_config(async=True)
             result.get()
 
@@ -203,7 +234,7 @@ class TestConfig(unittest.TestCase):
             result = StubEtcdResult(host_path)
 
             config = Config("calico/felix/test/data/felix_missing.cfg")
-            etcd_watcher = EtcdWatcher(config)
+            etcd_watcher = EtcdWatcher(config, Mock())
             result = etcd_watcher.load_config(async=True)
             result.get()
 
@@ -217,7 +248,7 @@ class TestConfig(unittest.TestCase):
             result = StubEtcdResult(host_path)
 
             config = Config("calico/felix/test/data/felix_missing.cfg")
-            etcd_watcher = EtcdWatcher(config)
+            etcd_watcher = EtcdWatcher(config, Mock())
             result = etcd_watcher.load_config(async=True)
             result.get()
 
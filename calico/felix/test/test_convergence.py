@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_convergence
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the ConvergenceTracker actor.
+"""
+import logging
+
+from calico.felix.convergence import ConvergenceTracker
+from calico.felix.test.base import BaseTestCase
+from calico.felix.test.test_actor import ActorForTesting
+
+_log = logging.getLogger(__name__)
+
+
+class TestConvergenceTracker(BaseTestCase):
+    def setUp(self):
+        super(TestConvergenceTracker, self).setUp()
+        self.tracker = ConvergenceTracker()
+        self.actor = ActorForTesting()
+
+    def test_applied_through_index(self):
+        with self.tracker.track_indexes([10], "snapshot"):
+            self.actor.do_a(async=True)
+        # Update with no work to do, it's applied straight away.
+        with self.tracker.track_indexes([11], "update"):
+            pass
+        self.step_actor(self.tracker)
+        # Nothing counts as applied until the snapshot is.
+        self.assertEqual(self.tracker.applied_through_index, None)
+
+        self.step_actor(self.actor)
+        self.step_actor(self.tracker)
+        self.assertEqual(self.tracker.applied_through_index, 11)
+
+        # Updates that finish out of order.
+        with self.tracker.track_indexes([12], "update"):
+            self.actor.do_a(async=True)
+        with self.tracker.track_indexes([13, 14], "update"):
+            pass
+        self.step_actor(self.tracker)
+        self.assertEqual(self.tracker.applied_through_index, 11)
+        self.step_actor(self.actor)
+        self.step_actor(self.tracker)
+        self.assertEqual(self.tracker.applied_through_index, 14)
+
+        stats = self.tracker.get_stats(async=True)
+        self.step_actor(self.tracker)
+        stats = stats.get()
+        self.assertEqual(stats["applied_through_index"], 14)
+        self.assertEqual(
+            sum(c for _, c in stats["latency_histograms"]["update"]), 4)
+        self.assertEqual(
+            sum(c for _, c in stats["latency_histograms"]["snapshot"]), 1)
+
+    def test_applied_through_all_streams(self):
+        self.tracker.on_streams_confirmed({"profiles": 10, "hosts": 10},
+                                          async=True)
+        with self.tracker.track_indexes([10], "snapshot"):
+            pass
+        self.step_actor(self.tracker)
+        self.assertEqual(self.tracker.applied_through_index, 10)
+
+        # An update on one stream doesn't mean that the other has been
+        # read that far.
+        with self.tracker.track_indexes([15], "update"):
+            pass
+        self.tracker.on_streams_confirmed({"profiles": 15}, async=True)
+        self.step_actor(self.tracker)
+        self.assertEqual(self.tracker.applied_through_index, 10)
+
+        self.tracker.on_streams_confirmed({"hosts": 20}, async=True)
+        self.step_actor(self.tracker)
+        self.assertEqual(self.tracker.applied_through_index, 15)
+
+    def test_wait_for_index(self):
+        self.tracker.start()
+        with self.tracker.track_indexes([10], "snapshot"):
+            pass
+        self.assertTrue(self.tracker.wait_for_index(10, timeout=1))
+        self.assertTrue(self.tracker.wait_for_index(5, timeout=1))
+        self.assertFalse(self.tracker.wait_for_index(11, timeout=0.01))
+        # A waiter that timed out no longer holds the streams up.
+        self.tracker.get_stats(async=False)
+        self.assertFalse(self.tracker._waiters)
+        self.assertFalse(self.tracker._waiters_present.is_set())
@@ -18,9 +18,11 @@ felix.test.test_devices
 
 Test the device handling code.
 """
+import errno
 import logging
 import mock
 import os
+import socket
 import sys
 import uuid
 from contextlib import nested
@@ -33,6 +35,7 @@ else:
 import calico.felix.devices as devices
 import calico.felix.futils as futils
 import calico.felix.test.stub_utils as stub_utils
+from calico.felix.test.base import BaseTestCase
 
 # Logger
 log = logging.getLogger(__name__)
@@ -179,6 +182,104 @@ class TestDevices(unittest.TestCase):
                                    str(proxy_target), "dev", if_name])]
             m_check_call.assert_has_calls(ip_calls)
 
+    def test_set_routes_nl_batch(self):
+        """
+        Test that set_routes queues netlink requests rather than forking
+        when given a batch.
+        """
+        tap = "tap" + str(uuid.uuid4())[:11]
+        m_batch = mock.Mock()
+        with nested(mock.patch('calico.felix.devices.list_interface_ips',
+                               return_value=set(["1.2.3.4", "1.2.3.5"])),
+                    mock.patch('calico.felix.futils.check_call')) as \
+                (_, m_check_call):
+            devices.set_routes(futils.IPV4, set(["1.2.3.5", "1.2.3.6"]), tap,
+                               "aa:bb:cc:dd:ee:ff", nl_batch=m_batch)
+        self.assertFalse(m_check_call.called)
+        self.assertEqual(m_batch.mock_calls, [
+            mock.call.del_neighbour(futils.IPV4, "1.2.3.4", tap),
+            mock.call.del_route(futils.IPV4, "1.2.3.4", tap),
+            mock.call.add_neighbour(futils.IPV4, "1.2.3.6",
+                                    "aa:bb:cc:dd:ee:ff", tap),
+            mock.call.add_route(futils.IPV4, "1.2.3.6", tap),
+        ])
+
+    def test_set_routes_route_table(self):
+        """
+        Test that set_routes uses the route table, rather than listing
+        routes, when given one.
+        """
+        m_table = mock.Mock()
+        m_table.diff.return_value = (set(["1.2.3.4"]), set(["1.2.3.6"]))
+        m_batch = mock.Mock()
+        with mock.patch('calico.felix.devices.list_interface_ips') as m_list:
+            devices.set_routes(futils.IPV4, set(["1.2.3.6"]), "tap1",
+                               "aa:bb:cc:dd:ee:ff", nl_batch=m_batch,
+                               route_table=m_table)
+        self.assertFalse(m_list.called)
+        m_table.diff.assert_called_once_with(futils.IPV4, "tap1",
+                                             set(["1.2.3.6"]))
+        m_batch.del_route.assert_called_once_with(futils.IPV4, "1.2.3.4",
+                                                  "tap1")
+        m_batch.add_route.assert_called_once_with(futils.IPV4, "1.2.3.6",
+                                                  "tap1")
+
+    def test_configure_interface_ipv4_cached(self):
+        """
+        Test that configure_interface_ipv4 only writes the sysctls once
+        when given a cache, until the cache is invalidated.
+        """
+        if_name = "tap3e5a2b34222"
+        cache = devices.SysctlCache()
+        m_open = mock.mock_open()
+        with nested(mock.patch('__builtin__.open', m_open, create=True),
+                    mock.patch('calico.felix.fnetlink.interface_index',
+                               return_value=10)):
+            devices.configure_interface_ipv4(if_name, sysctl_cache=cache)
+            self.assertEqual(m_open.call_count, 3)
+            devices.configure_interface_ipv4(if_name, sysctl_cache=cache)
+            self.assertEqual(m_open.call_count, 3)
+
+            # Same index: still cached.
+            cache.on_link_update(if_name, 10, deleted=False)
+            devices.configure_interface_ipv4(if_name, sysctl_cache=cache)
+            self.assertEqual(m_open.call_count, 3)
+
+            # Interface recreated with a new index: rewrite.
+            cache.on_link_update(if_name, 11, deleted=False)
+            devices.configure_interface_ipv4(if_name, sysctl_cache=cache)
+            self.assertEqual(m_open.call_count, 6)
+
+            cache.on_link_update(if_name, 10, deleted=True)
+            devices.configure_interface_ipv4(if_name, sysctl_cache=cache)
+            self.assertEqual(m_open.call_count, 9)
+
+    def test_configure_interface_ipv6_cached(self):
+        """
+        Test that the IPv6 sysctl and proxy target are skipped when already
+        applied, but a new proxy target is still programmed.
+        """
+        if_name = "tap3e5a2b34222"
+        cache = devices.SysctlCache()
+        m_open = mock.mock_open()
+        with nested(mock.patch('__builtin__.open', m_open, create=True),
+                    mock.patch('calico.felix.fnetlink.interface_index',
+                               return_value=10),
+                    mock.patch('calico.felix.futils.check_call')) as \
+                (_, _, m_check_call):
+            devices.configure_interface_ipv6(if_name, "2001::1",
+                                             sysctl_cache=cache)
+            devices.configure_interface_ipv6(if_name, "2001::1",
+                                             sysctl_cache=cache)
+            self.assertEqual(m_open.call_count, 1)
+            self.assertEqual(m_check_call.call_count, 1)
+            devices.configure_interface_ipv6(if_name, "2001::2",
+                                             sysctl_cache=cache)
+            self.assertEqual(m_open.call_count, 1)
+            m_check_call.assert_called_with(["ip", "-6", "neigh", "add",
+                                             "proxy", "2001::2", "dev",
+                                             if_name])
+
     def test_interface_up1(self):
         """
         Test that the interface_up returns True when an interface is up.
@@ -216,3 +317,31 @@ class TestDevices(unittest.TestCase):
             )
             self.assertTrue(file_handle.read.called)
             self.assertFalse(is_up)
+
+
+class TestInterfaceWatcher(BaseTestCase):
+    @mock.patch("socket.socket", autospec=True)
+    def test_resync_after_overflow(self, m_socket):
+        m_splitter = mock.Mock()
+        m_programmer = mock.Mock()
+        m_programmer.route_table.interfaces.return_value = [("tap1", 5)]
+        m_sysctls = mock.Mock()
+        watcher = devices.InterfaceWatcher(m_splitter,
+                                           route_programmer=m_programmer,
+                                           sysctl_cache=m_sysctls)
+        # Overflow, then a different error to get us out of the loop.
+        m_socket.return_value.recv.side_effect = [
+            socket.error(errno.ENOBUFS, "No buffer space available"),
+            socket.error(errno.EBADF, "Bad file descriptor"),
+        ]
+        result = watcher.watch_interfaces(async=True)
+        self.step_actor(watcher)
+        with self.assertRaises(socket.error) as cm:
+            result.get()
+        self.assertEqual(cm.exception.errno, errno.EBADF)
+
+        m_programmer.refresh_route_table.assert_called_once_with()
+        m_sysctls.on_link_update.assert_called_once_with("tap1", 5,
+                                                         deleted=False)
+        m_splitter.on_interface_update.assert_called_once_with("tap1",
+                                                               async=True)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_dispatch
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the dispatch chains actor.
+"""
+import logging
+
+from mock import Mock
+
+from calico.felix.dispatch import DispatchChains
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestDispatchChains(BaseTestCase):
+    def setUp(self):
+        super(TestDispatchChains, self).setUp()
+        self.m_config = Mock()
+        self.m_config.IFACE_PREFIX = "tap"
+        self.m_ipt = Mock(spec=IptablesUpdater)
+        self.dispatch = DispatchChains(self.m_config, 4, self.m_ipt)
+
+    def rewritten_chains(self):
+        """
+        :returns: dict mapping chain name to the updates passed to the most
+            recent rewrite_chains() call and resets the mock.
+        """
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 1)
+        updates = self.m_ipt.rewrite_chains.call_args[0][0]
+        self.m_ipt.reset_mock()
+        return updates
+
+    def test_snapshot_writes_buckets_and_root(self):
+        self.dispatch.apply_snapshot({"tapabc": "ep1", "tapb12": "ep2"},
+                                     async=True)
+        self.step_actor(self.dispatch)
+        updates = self.rewritten_chains()
+        self.assertEqual(updates["felix-TO-ENDPOINT"], [
+            "--append felix-TO-ENDPOINT --out-interface tapab+ "
+            "--goto felix-TO-EP-PFX-ab",
+            "--append felix-TO-ENDPOINT --out-interface tapb1+ "
+            "--goto felix-TO-EP-PFX-b1",
+            "--append felix-TO-ENDPOINT --jump DROP",
+        ])
+        self.assertEqual(updates["felix-FROM-EP-PFX-ab"], [
+            "--append felix-FROM-EP-PFX-ab --in-interface tapabc "
+            "--goto felix-from-abc",
+            "--append felix-FROM-EP-PFX-ab --jump DROP",
+        ])
+        self.assertEqual(set(updates.keys()), set([
+            "felix-TO-ENDPOINT", "felix-FROM-ENDPOINT",
+            "felix-TO-EP-PFX-ab", "felix-FROM-EP-PFX-ab",
+            "felix-TO-EP-PFX-b1", "felix-FROM-EP-PFX-b1",
+        ]))
+
+    def test_add_to_existing_bucket_only_rewrites_bucket(self):
+        self.dispatch.apply_snapshot({"tapabc": "ep1"}, async=True)
+        self.step_actor(self.dispatch)
+        self.m_ipt.reset_mock()
+
+        self.dispatch.on_endpoint_added("tapabd", "ep2", async=True)
+        self.step_actor(self.dispatch)
+        updates = self.rewritten_chains()
+        self.assertEqual(set(updates.keys()),
+                         set(["felix-TO-EP-PFX-ab", "felix-FROM-EP-PFX-ab"]))
+        self.assertEqual(len(updates["felix-TO-EP-PFX-ab"]), 3)
+
+        # Repeating the add is a no-op.
+        self.dispatch.on_endpoint_added("tapabd", "ep2", async=True)
+        self.step_actor(self.dispatch)
+        self.assertFalse(self.m_ipt.rewrite_chains.called)
+
+    def test_shared_to_chain(self):
+        self.dispatch.on_endpoint_added("tapabc", "ep1",
+                                        to_chain="felix-p-prof1-t",
+                                        async=True)
+        self.step_actor(self.dispatch)
+        updates = self.rewritten_chains()
+        self.assertEqual(updates["felix-TO-EP-PFX-ab"][0],
+                         "--append felix-TO-EP-PFX-ab --out-interface tapabc "
+                         "--goto felix-p-prof1-t")
+        self.assertEqual(updates["felix-FROM-EP-PFX-ab"][0],
+                         "--append felix-FROM-EP-PFX-ab --in-interface tapabc "
+                         "--goto felix-from-abc")
+
+        # A snapshot keeps the shared to-chain.
+        self.dispatch.apply_snapshot({"tapabc": "ep1"}, async=True)
+        self.step_actor(self.dispatch)
+        updates = self.rewritten_chains()
+        self.assertTrue(updates["felix-TO-EP-PFX-ab"][0].endswith(
+            "--goto felix-p-prof1-t"))
+
+    def test_remove_last_in_bucket_deletes_bucket(self):
+        self.dispatch.apply_snapshot({"tapabc": "ep1", "tapb12": "ep2"},
+                                     async=True)
+        self.step_actor(self.dispatch)
+        self.m_ipt.reset_mock()
+
+        self.dispatch.on_endpoint_removed("tapb12", async=True)
+        self.step_actor(self.dispatch)
+        self.m_ipt.delete_chains.assert_called_once_with(
+            ["felix-TO-EP-PFX-b1", "felix-FROM-EP-PFX-b1"], async=False)
+        updates = self.rewritten_chains()
+        self.assertEqual(set(updates.keys()),
+                         set(["felix-TO-ENDPOINT", "felix-FROM-ENDPOINT"]))
+        self.assertEqual(updates["felix-FROM-ENDPOINT"], [
+            "--append felix-FROM-ENDPOINT --in-interface tapab+ "
+            "--goto felix-FROM-EP-PFX-ab",
+            "--append felix-FROM-ENDPOINT --jump DROP",
+        ])
+
+    def test_unbucketable_iface_in_root(self):
+        self.dispatch.on_endpoint_added("tap", "ep1", async=True)
+        self.step_actor(self.dispatch)
+        updates = self.rewritten_chains()
+        self.assertEqual(updates["felix-TO-ENDPOINT"], [
+            "--append felix-TO-ENDPOINT --out-interface tap "
+            "--goto felix-to-",
+            "--append felix-TO-ENDPOINT --jump DROP",
+        ])
@@ -21,8 +21,10 @@ Tests of endpoint module.
 import logging
 import itertools
 from contextlib import nested
+from subprocess import CalledProcessError
 from calico.felix.endpoint import EndpointManager
 from calico.felix.fiptables import IptablesUpdater
+from calico.felix.ipsets import IpsetManager
 from calico.felix.dispatch import DispatchChains
 from calico.felix.profilerules import RulesManager
 from gevent.event import AsyncResult
@@ -50,3 +52,202 @@ class TestEndpointManager(BaseTestCase):
         self.m_rules_mgr = Mock(autospec=RulesManager)
         self.ep_mgr = EndpointManager(self.m_config, self.m_ipt_upds,
                                       self.m_disp_chns, self.m_rules_mgr)
+
+
+class TestLocalEndpoint(BaseTestCase):
+    def setUp(self):
+        super(TestLocalEndpoint, self).setUp()
+        self.m_config = Mock(spec=config.Config)
+        self.m_config.IFACE_PREFIX = "tap"
+        self.m_config.CONNTRACK_FAST_PATH = False
+        self.m_config.SHARE_PROFILE_CHAINS = False
+        self.m_config.SHARE_TO_CHAINS = False
+        self.m_config.ANTI_SPOOF_IPSET_THRESHOLD = 0
+        self.m_ipt = Mock(spec=IptablesUpdater)
+        self.m_disp = Mock(spec=DispatchChains)
+        self.m_rules_mgr = Mock(spec=RulesManager)
+        self.ep = endpoint.LocalEndpoint(self.m_config, "ep1", "IPv4",
+                                         self.m_ipt, self.m_disp,
+                                         self.m_rules_mgr)
+        self.ep._manager = Mock(spec=EndpointManager)
+        self.ep._id = "ep1"
+        self.m_devices = patch("calico.felix.endpoint.devices").start()
+
+    def tearDown(self):
+        patch.stopall()
+        super(TestLocalEndpoint, self).tearDown()
+
+    def endpoint(self, **kwargs):
+        ep = {"name": "tapabcdef", "profile_id": "prof1",
+              "mac": "aa:bb:cc:dd:ee:ff", "ipv4_nets": ["10.0.0.1/32"],
+              "state": "active"}
+        ep.update(kwargs)
+        return ep
+
+    def test_updates_programmed_once_per_batch(self):
+        self.ep.on_endpoint_update(self.endpoint(), async=True)
+        self.ep.on_endpoint_update(self.endpoint(ipv4_nets=["10.0.0.2/32"]),
+                                   async=True)
+        self.ep.on_interface_update(async=True)
+        self.step_actor(self.ep)
+        self.assertEqual(self.m_devices.set_routes.call_count, 1)
+        self.assertEqual(self.m_devices.set_routes.call_args[0][1],
+                         set(["10.0.0.2"]))
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 1)
+        self.assertEqual(self.m_ipt.rewrite_chains.call_args[1]["async"],
+                         True)
+        # Not added to the dispatch chains until our chains are in place.
+        self.assertFalse(self.m_disp.on_endpoint_added.called)
+
+        callback = self.m_ipt.rewrite_chains.call_args[1]["callback"]
+        callback(None)
+        self.step_actor(self.ep)
+        self.m_disp.on_endpoint_added.assert_called_once_with(
+            "tapabcdef", "ep1", async=True)
+
+    def test_failed_programming_removes_chains(self):
+        self.ep.on_endpoint_update(self.endpoint(), async=True)
+        self.step_actor(self.ep)
+        callback = self.m_ipt.rewrite_chains.call_args[1]["callback"]
+        callback(CalledProcessError(1, "iptables-restore"))
+        self.step_actor(self.ep)
+        self.assertFalse(self.m_disp.on_endpoint_added.called)
+        self.m_disp.on_endpoint_removed.assert_called_once_with(
+            "tapabcdef", async=True)
+        self.m_ipt.delete_chains.assert_called_once_with(
+            ("felix-to-abcdef", "felix-from-abcdef"), async=True)
+        self.assertTrue(self.ep._failed)
+
+    def test_stale_callback_ignored(self):
+        self.ep.on_endpoint_update(self.endpoint(), async=True)
+        self.step_actor(self.ep)
+        callback = self.m_ipt.rewrite_chains.call_args[1]["callback"]
+
+        # Endpoint is deleted before the IptablesUpdater calls back.
+        self.ep.on_endpoint_update(None, async=True)
+        self.ep.on_unreferenced(async=True)
+        self.step_actor(self.ep)
+        self.m_ipt.delete_chains.assert_called_once_with(
+            ("felix-to-abcdef", "felix-from-abcdef"), async=True)
+        self.ep._manager.on_object_cleanup_complete.assert_called_once_with(
+            "ep1", self.ep, async=True)
+
+        callback(None)
+        self.step_actor(self.ep)
+        self.assertFalse(self.m_disp.on_endpoint_added.called)
+
+    def test_shared_to_chain(self):
+        self.m_config.SHARE_TO_CHAINS = True
+        self.ep.on_endpoint_update(self.endpoint(), async=True)
+        self.step_actor(self.ep)
+        updates, _ = self.m_ipt.rewrite_chains.call_args[0]
+        self.assertEqual(updates.keys(), ["felix-from-abcdef"])
+
+        callback = self.m_ipt.rewrite_chains.call_args[1]["callback"]
+        callback(None)
+        self.step_actor(self.ep)
+        self.m_disp.on_endpoint_added.assert_called_once_with(
+            "tapabcdef", "ep1", to_chain="felix-p-prof1-t", async=True)
+
+        self.ep.on_endpoint_update(None, async=True)
+        self.step_actor(self.ep)
+        self.m_ipt.delete_chains.assert_called_once_with(
+            ("felix-from-abcdef",), async=True)
+
+    def test_shared_profile_chains(self):
+        self.m_config.SHARE_PROFILE_CHAINS = True
+        self.ep.on_endpoint_update(self.endpoint(), async=True)
+        self.step_actor(self.ep)
+        self.m_rules_mgr.watch_profile_chains.assert_called_once_with(
+            "prof1", self.ep._on_profile_chains, async=True)
+        # Waits for the names of the shared chains.
+        self.assertFalse(self.m_ipt.rewrite_chains.called)
+
+        # Chains for a profile that we no longer use are ignored.
+        chains = {"inbound": "felix-ps-1234-i", "outbound": "felix-ps-5678-o"}
+        self.ep.on_profile_chains_updated("prof2", chains, async=True)
+        self.step_actor(self.ep)
+        self.assertFalse(self.m_ipt.rewrite_chains.called)
+
+        self.ep.on_profile_chains_updated("prof1", chains, async=True)
+        self.step_actor(self.ep)
+        updates, deps = self.m_ipt.rewrite_chains.call_args[0]
+        self.assertEqual(deps["felix-to-abcdef"], set(["felix-ps-1234-i"]))
+        self.assertEqual(deps["felix-from-abcdef"], set(["felix-ps-5678-o"]))
+        self.assertTrue(updates["felix-from-abcdef"][-2].endswith(
+            "--goto felix-ps-5678-o"))
+
+        self.ep.on_endpoint_update(self.endpoint(profile_id="prof2"),
+                                   async=True)
+        self.step_actor(self.ep)
+        self.m_rules_mgr.unwatch_profile_chains.assert_called_once_with(
+            "prof1", self.ep._on_profile_chains, async=True)
+        self.m_rules_mgr.watch_profile_chains.assert_called_with(
+            "prof2", self.ep._on_profile_chains, async=True)
+        # Leaves the old chains in place until it hears about the new ones.
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 1)
+        self.assertFalse(self.m_ipt.delete_chains.called)
+
+    def test_antispoof_ipset(self):
+        self.m_config.ANTI_SPOOF_IPSET_THRESHOLD = 2
+        m_ipset_mgr = Mock(spec=IpsetManager)
+        self.ep = endpoint.LocalEndpoint(self.m_config, "ep1", "IPv4",
+                                         self.m_ipt, self.m_disp,
+                                         self.m_rules_mgr,
+                                         ipset_manager=m_ipset_mgr)
+        self.ep._manager = Mock(spec=EndpointManager)
+        self.ep._id = "ep1"
+        nets = ["10.0.0.1/32", "10.0.0.2/32", "10.0.0.3/32"]
+        self.ep.on_endpoint_update(self.endpoint(ipv4_nets=nets), async=True)
+        self.step_actor(self.ep)
+        # Waits for the ipset before programming the chains.
+        key = ("nets", tuple(nets))
+        self.assertEqual(m_ipset_mgr.get_and_incref.call_args[0][0], key)
+        self.assertFalse(self.m_ipt.rewrite_chains.called)
+
+        m_ipset = Mock()
+        m_ipset.name = "felix-v4-nets"
+        self.ep.ipset_refs.on_ref_acquired(key, m_ipset, async=True)
+        self.step_actor(self.ep)
+        updates, _ = self.m_ipt.rewrite_chains.call_args[0]
+        from_chain = updates["felix-from-abcdef"]
+        self.assertEqual(len([r for r in from_chain if "--goto" in r]), 1)
+        self.assertTrue(
+            "--match set --match-set felix-v4-nets src --match mac "
+            "--mac-source AA:BB:CC:DD:EE:FF --goto felix-p-prof1-o" in
+            from_chain[-2])
+
+        # The ipset is released only after the chains are gone.
+        self.ep.on_endpoint_update(None, async=True)
+        self.step_actor(self.ep)
+        self.m_ipt.delete_chains.assert_called_once_with(
+            ("felix-to-abcdef", "felix-from-abcdef"), async=False)
+        m_ipset_mgr.decref.assert_called_once_with(key, async=True)
+
+    def test_antispoof_ipset_released_if_delete_fails(self):
+        self.m_config.ANTI_SPOOF_IPSET_THRESHOLD = 2
+        m_ipset_mgr = Mock(spec=IpsetManager)
+        self.ep = endpoint.LocalEndpoint(self.m_config, "ep1", "IPv4",
+                                         self.m_ipt, self.m_disp,
+                                         self.m_rules_mgr,
+                                         ipset_manager=m_ipset_mgr)
+        self.ep._manager = Mock(spec=EndpointManager)
+        self.ep._id = "ep1"
+        nets = ["10.0.0.1/32", "10.0.0.2/32", "10.0.0.3/32"]
+        self.ep.on_endpoint_update(self.endpoint(ipv4_nets=nets), async=True)
+        self.step_actor(self.ep)
+        key = ("nets", tuple(nets))
+        m_ipset = Mock()
+        m_ipset.name = "felix-v4-nets"
+        self.ep.ipset_refs.on_ref_acquired(key, m_ipset, async=True)
+        self.step_actor(self.ep)
+
+        self.m_ipt.delete_chains.side_effect = CalledProcessError(1, "foo")
+        self.ep.on_endpoint_update(None, async=True)
+        self.ep.on_unreferenced(async=True)
+        self.step_actor(self.ep)
+        self.assertTrue(self.ep._failed)
+        m_ipset_mgr.decref.assert_called_once_with(key, async=True)
+        self.assertEqual(self.ep.ipset_refs, None)
+        self.ep._manager.on_object_cleanup_complete.assert_called_once_with(
+            "ep1", self.ep, async=True)
@@ -52,6 +52,12 @@ class TestBasic(BaseTestCase):
         m_config.HOSTNAME = "myhost"
         m_config.IFACE_PREFIX = "tap"
         m_config.METADATA_IP = None
+        m_config.SHARE_PROFILE_CHAINS = False
+        m_config.SHARE_TO_CHAINS = False
+        m_config.RULE_REORDER_INT_SEC = 0
+        m_config.CONNTRACK_FAST_PATH = False
+        m_config.ANTI_SPOOF_IPSET_THRESHOLD = 0
+        m_config.DATAPLANE_DRIVER = "iptables"
         self.assertRaises(TestException,
                           felix._main_greenlet, m_config)
         m_load.assert_called_once_with(async=False)
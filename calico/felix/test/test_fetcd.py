@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fetcd
+~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the EtcdWatcher.
+"""
+import logging
+
+import gevent
+from mock import Mock, MagicMock, patch
+from urllib3.exceptions import ReadTimeoutError
+
+from calico.datamodel_v1 import key_for_endpoint
+from calico.felix.config import Config
+from calico.felix.convergence import ConvergenceTracker
+from calico.felix import fetcd, futils
+from calico.felix.fetcd import EtcdWatcher, RestartRequired
+from calico.felix.splitter import UpdateSplitter
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+def tags_node(profile_id, tags, modified_index):
+    return Mock(key="/calico/v1/policy/profile/%s/tags" % profile_id,
+                value='["%s"]' % '", "'.join(tags),
+                modifiedIndex=modified_index,
+                action="get")
+
+
+def endpoint_node(host, endpoint_id, modified_index):
+    return Mock(key=key_for_endpoint(host, "docker", "wl", endpoint_id),
+                value="{}", modifiedIndex=modified_index, action="get")
+
+
+class TestEtcdWatcher(BaseTestCase):
+    def setUp(self):
+        super(TestEtcdWatcher, self).setUp()
+        m_config = Mock(spec=Config)
+        m_config.HOSTNAME = "myhost"
+        m_config.IFACE_PREFIX = "tap"
+        self.m_config = m_config
+        self.m_tracker = MagicMock(spec=ConvergenceTracker)
+        self.watcher = EtcdWatcher(m_config, self.m_tracker)
+        self.m_splitter = Mock(spec=UpdateSplitter)
+
+    def test_resync_sends_delta(self):
+        self.watcher._apply_snapshot(10, [tags_node("prof1", ["a"], 2),
+                                          tags_node("prof2", ["b"], 3),
+                                          tags_node("prof3", ["c"], 4)],
+                                     self.m_splitter)
+        tags_by_id = self.m_splitter.apply_snapshot.call_args[0][1]
+        self.assertEqual(tags_by_id, {"prof1": ["a"], "prof2": ["b"],
+                                      "prof3": ["c"]})
+
+        # prof1 unchanged, prof2 updated, prof3 deleted, prof4 created.
+        self.watcher._apply_snapshot_delta(
+            20,
+            [tags_node("prof1", ["a"], 2),
+             tags_node("prof2", ["b", "c"], 15),
+             tags_node("prof4", ["d"], 16)],
+            ["profiles"],
+            self.m_splitter)
+        self.assertEqual(self.m_splitter.apply_snapshot.call_count, 1)
+        updates = self.m_splitter.on_updates.call_args[0][0]
+        self.assertEqual(sorted(updates), [
+            ("tags", "prof2", ["b", "c"]),
+            ("tags", "prof3", None),
+            ("tags", "prof4", ["d"]),
+        ])
+        self.m_tracker.track_indexes.assert_called_with([20], "resync")
+
+        # Nothing changed since the last resync.
+        self.m_splitter.on_updates.reset_mock()
+        self.watcher._apply_snapshot_delta(
+            30,
+            [tags_node("prof1", ["a"], 2),
+             tags_node("prof2", ["b", "c"], 15),
+             tags_node("prof4", ["d"], 16)],
+            ["profiles"],
+            self.m_splitter)
+        self.assertFalse(self.m_splitter.on_updates.called)
+
+    def test_updates_tracked_for_resync(self):
+        self.watcher._apply_snapshot(10, [tags_node("prof1", ["a"], 2)],
+                                     self.m_splitter)
+        updates = []
+        self.watcher._parse_update(tags_node("prof1", ["b"], 11), updates)
+        self.assertEqual(updates, [("tags", "prof1", ["b"])])
+
+        # A resync that sees the same update doesn't resend it.
+        self.watcher._apply_snapshot_delta(
+            20, [tags_node("prof1", ["b"], 11)], ["profiles"],
+            self.m_splitter)
+        self.assertFalse(self.m_splitter.on_updates.called)
+
+    def test_stream_resync_scope(self):
+        self.watcher._apply_snapshot(10, [tags_node("prof1", ["a"], 2),
+                                          endpoint_node("myhost", "ep1", 3),
+                                          endpoint_node("other", "ep2", 4)],
+                                     self.m_splitter)
+        self.assertEqual(self.watcher._stream_for_key(
+            key_for_endpoint("myhost", "docker", "wl", "ep1")), "hosts")
+        self.assertEqual(self.watcher._stream_for_key(
+            "/calico/v1/policy/profile/prof1/tags"), "profiles")
+
+        # A resync of the profiles stream only looks at profiles, the
+        # endpoints aren't deleted.
+        self.watcher._apply_snapshot_delta(20, [], ["profiles"],
+                                           self.m_splitter)
+        updates = self.m_splitter.on_updates.call_args[0][0]
+        self.assertEqual(updates, [("tags", "prof1", None)])
+
+    def test_streams_confirmed(self):
+        self.watcher._apply_snapshot(10, [], self.m_splitter)
+        self.watcher._pollers["profiles"] = Mock()
+        resync = self.watcher._dispatch_events(
+            [("profiles", self.watcher._pollers["profiles"], 0,
+              tags_node("prof1", ["a"], 11))],
+            self.m_splitter)
+        self.assertEqual(resync, set())
+        self.m_tracker.track_indexes.assert_called_with([11], "update", 0)
+        self.m_tracker.on_streams_confirmed.assert_called_once_with(
+            {"profiles": 11}, async=True)
+
+    def test_idle_stream_confirmed_promptly(self):
+        tracker = ConvergenceTracker()
+        tracker.start()
+        self.watcher.convergence_tracker = tracker
+        self.watcher.client = Mock()
+
+        def read(key, **kwargs):
+            if key == fetcd.VERSION_DIR:
+                return Mock(etcd_index=20)
+            # Nothing has changed in the ready stream since the snapshot.
+            self.assertEqual(key, fetcd.READY_KEY)
+            self.assertEqual(kwargs["waitIndex"], 11)
+            raise ReadTimeoutError(None, None, "timed out")
+        self.watcher.client.read.side_effect = read
+        checker = gevent.spawn(self.watcher._check_idle_streams)
+        try:
+            tracker.on_streams_confirmed({"ready": 10, "hosts": 10},
+                                         async=True)
+            with tracker.track_indexes([10], "snapshot"):
+                pass
+            # An endpoint update arrives on the hosts stream.
+            with tracker.track_indexes([15], "update"):
+                pass
+            tracker.on_streams_confirmed({"hosts": 15}, async=True)
+            self.assertTrue(tracker.wait_for_index(15, timeout=1))
+        finally:
+            checker.kill()
+            tracker.greenlet.kill()
+
+    def test_stale_events_discarded(self):
+        self.watcher._apply_snapshot(10, [], self.m_splitter)
+        old_poller = Mock()
+        self.watcher._pollers["profiles"] = Mock()
+        resync = self.watcher._dispatch_events(
+            [("profiles", old_poller, 0, tags_node("prof1", ["a"], 11))],
+            self.m_splitter)
+        self.assertEqual(resync, set())
+        self.assertFalse(self.m_splitter.on_updates.called)
+
+        resync = self.watcher._dispatch_events(
+            [("profiles", self.watcher._pollers["profiles"], 0, None)],
+            self.m_splitter)
+        self.assertEqual(resync, set(["profiles"]))
+
+    def test_config_change_reloads_config(self):
+        self.watcher._apply_snapshot(10, [], self.m_splitter)
+        self.watcher._pollers["config"] = Mock()
+        self.m_config.update_config.return_value = set(["RESYNC_INT_SEC"])
+        response = Mock(key="/calico/v1/config/ResyncIntervalSecs",
+                        value="10", modifiedIndex=11, action="set")
+        with patch.object(self.watcher, "_load_config_dict",
+                          return_value={"ResyncIntervalSecs": "10"}):
+            resync = self.watcher._dispatch_events(
+                [("config", self.watcher._pollers["config"], 0, response)],
+                self.m_splitter)
+        self.assertEqual(resync, set())
+        self.m_config.update_config.assert_called_once_with(
+            {"ResyncIntervalSecs": "10"})
+        self.m_splitter.on_config_update.assert_called_once_with(
+            set(["RESYNC_INT_SEC"]), async=False)
+
+    def test_config_change_needing_restart(self):
+        self.m_config.update_config.return_value = set(["IFACE_PREFIX",
+                                                        "RESYNC_INT_SEC"])
+        with patch.object(self.watcher, "_load_config_dict",
+                          return_value={}):
+            self.assertRaises(RestartRequired, self.watcher._reload_config,
+                              self.m_splitter)
+        self.assertFalse(self.m_splitter.on_config_update.called)
+
+
+class TestValidationCache(BaseTestCase):
+    def setUp(self):
+        super(TestValidationCache, self).setUp()
+        self._cache_patch = patch("calico.felix.fetcd._validation_cache",
+                                  futils.LRUCache(10))
+        self._cache_patch.start()
+
+    def tearDown(self):
+        self._cache_patch.stop()
+        super(TestValidationCache, self).tearDown()
+
+    def test_identical_rules_shared(self):
+        value = ('{"inbound_rules": [{"src_net": "10.0.0.0/8"}], '
+                 '"outbound_rules": []}')
+        node = Mock(key="/calico/v1/policy/profile/prof1/rules",
+                    value=value, action="set")
+        _, rules1 = fetcd.parse_if_rules(node)
+        node.key = "/calico/v1/policy/profile/prof2/rules"
+        _, rules2 = fetcd.parse_if_rules(node)
+        self.assertEqual(rules1["id"], "prof1")
+        self.assertEqual(rules2["id"], "prof2")
+        self.assertEqual(rules1["inbound_rules"], rules2["inbound_rules"])
+        stats = fetcd.validation_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_failures_cached(self):
+        node = Mock(key="/calico/v1/policy/profile/prof1/tags",
+                    value='["a", 1]', action="set")
+        self.assertEqual(fetcd.parse_if_tags(node), ("prof1", None))
+        self.assertEqual(fetcd.parse_if_tags(node), ("prof1", None))
+        self.assertEqual(fetcd.validation_cache_stats()["hits"], 1)
+
+    def test_endpoint_key_includes_prefix(self):
+        m_config = Mock(spec=Config)
+        m_config.IFACE_PREFIX = "tap"
+        node = Mock(key=key_for_endpoint("host1", "docker", "wl", "ep1"),
+                    value='{"state": "active", "name": "tap1234", '
+                          '"mac": "aa:bb:cc:dd:ee:ff", "profile_id": "p", '
+                          '"ipv4_nets": ["10.0.0.1/32"], "ipv6_nets": []}',
+                    action="set")
+        _, endpoint = fetcd.parse_if_endpoint(m_config, node)
+        self.assertEqual(endpoint["host"], "host1")
+        self.assertEqual(endpoint["id"], "ep1")
+        m_config.IFACE_PREFIX = "veth"
+        self.assertEqual(fetcd.parse_if_endpoint(m_config, node),
+                         ("ep1", None))
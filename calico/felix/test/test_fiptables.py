@@ -20,46 +20,194 @@ Tests of iptables handling function.
 """
 
 import logging
+
+from mock import Mock
+
 from calico.felix import fiptables
 from calico.felix.test.base import BaseTestCase
 
 _log = logging.getLogger(__name__)
 
 
-EXTRACT_UNREF_TESTS = [
-("""Chain INPUT (policy DROP)
-target     prot opt source               destination
-felix-INPUT  all  --  anywhere             anywhere
-ACCEPT     tcp  --  anywhere             anywhere             tcp dpt:domain
+class TestIptablesUpdater(BaseTestCase):
 
-Chain FORWARD (policy DROP)
-target     prot opt source               destination
-felix-FORWARD  all  --  anywhere             anywhere
-ufw-track-forward  all  --  anywhere             anywhere
+    def test_extract_chain_graph(self):
+        save_output = "\n".join([
+            "*filter",
+            ":FORWARD DROP [0:0]",
+            ":felix-FORWARD - [0:0]",
+            ":felix-empty - [0:0]",
+            "-A FORWARD -j felix-FORWARD",
+            "-A felix-FORWARD -i tap+ -g felix-FROM-ENDPOINT",
+            "-A felix-FORWARD -j ACCEPT",
+            "COMMIT",
+        ])
+        self.assertEqual(fiptables.extract_chain_graph(save_output), {
+            "FORWARD": set(["felix-FORWARD"]),
+            "felix-FORWARD": set(["felix-FROM-ENDPOINT", "ACCEPT"]),
+            "felix-empty": set(),
+        })
 
-Chain DOCKER (1 references)
-target     prot opt source               destination
+    def test_cleanup_deletes_unreachable_chains(self):
+        updater = fiptables.IptablesUpdater("filter", ip_version=4)
+        updater._execute_iptables = Mock()
+        updater.explicitly_prog_chains = set(["felix-FORWARD"])
+        updater._load_chain_graph = Mock(return_value={
+            "FORWARD": set(["felix-FORWARD"]),
+            "felix-FORWARD": set(["felix-a", "ACCEPT"]),
+            "felix-a": set(),
+            # An orphan that references another orphan and a live chain.
+            "felix-old": set(["felix-old-2", "felix-a"]),
+            "felix-old-2": set(),
+            # Orphans in a loop.
+            "felix-loop-1": set(["felix-loop-2"]),
+            "felix-loop-2": set(["felix-loop-1"]),
+        })
+        updater.cleanup(async=True)
+        self.step_actor(updater)
+        self.assertEqual(updater._execute_iptables.call_count, 1)
+        lines = updater._execute_iptables.call_args[0][0]
+        orphans = set(["felix-old", "felix-old-2", "felix-loop-1",
+                       "felix-loop-2"])
+        # All the chains are flushed before any are deleted.
+        self.assertEqual(set(lines[1:5]), set(":%s -" % c for c in orphans))
+        self.assertEqual(set(lines[5:9]),
+                         set("--delete-chain %s" % c for c in orphans))
+        self.assertEqual(lines[9:], ["COMMIT"])
 
-Chain felix-FORWARD (1 references)
-target     prot opt source               destination
-felix-FROM-ENDPOINT  all  --  anywhere             anywhere
-felix-TO-ENDPOINT  all  --  anywhere             anywhere
-Chain-with-bad-name   all  --  anywhere             anywhere
-ACCEPT     all  --  anywhere             anywhere
+    def test_extract_rule_counters(self):
+        save_output = "\n".join([
+            "*filter",
+            ":felix-p-abcd-i - [0:0]",
+            ":felix-other - [0:0]",
+            "[5:300] -A felix-p-abcd-i -p tcp -j RETURN",
+            "[0:0] -A felix-other -j ACCEPT",
+            "[12:720] -A felix-p-abcd-i -p udp -j RETURN",
+            "[1:60] -A felix-p-abcd-i -m comment --comment \"Default DROP "
+            "rule:\" -j DROP",
+            "COMMIT",
+        ])
+        self.assertEqual(
+            fiptables.extract_rule_counters(save_output, ("felix-p-",)),
+            {"felix-p-abcd-i": [5, 12, 1]})
 
-Chain felix-temp (0 references)
-target     prot opt source               destination
-felix-FROM-ENDPOINT  all  --  anywhere             anywhere
-ACCEPT     all  --  anywhere             anywhere
-""",
-set(["felix-temp"])),
-]
+    def test_extract_chain_digests(self):
+        lines = fiptables._add_digest_comment(
+            ["--flush felix-a", "--append felix-a --jump ACCEPT"], "0123abcd")
+        self.assertEqual(lines[1], '--append felix-a -m comment --comment '
+                                   '"felix-hash:0123abcd" --jump ACCEPT')
+        save_output = "\n".join([
+            "*filter",
+            ":felix-a - [0:0]",
+            ":felix-b - [0:0]",
+            "-A felix-a -m comment --comment \"felix-hash:0123abcd\" "
+            "-j ACCEPT",
+            "-A felix-a -j DROP",
+            "-A felix-b -j ACCEPT",
+            "-A felix-b -m comment --comment \"felix-hash:4567\" -j DROP",
+            "COMMIT",
+        ])
+        # Only the first rule in each chain counts.
+        self.assertEqual(fiptables.extract_chain_digests(save_output),
+                         {"felix-a": "0123abcd"})
 
+    def test_unchanged_chains_skipped(self):
+        updater = fiptables.IptablesUpdater("filter", ip_version=4)
+        updater._execute_iptables = Mock()
+        rules = ["--append felix-a --jump felix-b"]
+        deps = {"felix-a": set(["felix-b"])}
+        # Simulate finding felix-a already programmed at start of day.
+        digest = fiptables.chain_digest(["--flush felix-a"] + rules)
+        updater._load_existing_chain_state = Mock(
+            return_value={"felix-a": (digest, 1)})
+        updater.rewrite_chains({"felix-a": rules}, deps, async=True)
+        self.step_actor(updater)
+        lines = updater._execute_iptables.call_args[0][0]
+        # Only the missing felix-b stub gets written.
+        self.assertEqual(lines[:2], ["*filter", ":felix-b -"])
+        self.assertFalse([l for l in lines if "felix-a" in l])
 
-class TestIptablesUpdater(BaseTestCase):
+        # Rewriting with the same contents is a no-op.
+        updater._execute_iptables.reset_mock()
+        updater.rewrite_chains({"felix-a": rules}, deps, async=True)
+        self.step_actor(updater)
+        self.assertFalse(updater._execute_iptables.called)
+        self.assertEqual(updater._load_existing_chain_state.call_count, 1)
+
+    def test_modified_chains_rewritten_at_start_of_day(self):
+        updater = fiptables.IptablesUpdater("filter", ip_version=4)
+        updater._execute_iptables = Mock()
+        rules = ["--append felix-a --jump ACCEPT"]
+        # felix-a has the right comment on its first rule but someone has
+        # appended a rule to it.
+        digest = fiptables.chain_digest(["--flush felix-a"] + rules)
+        updater._load_existing_chain_state = Mock(
+            return_value={"felix-a": (digest, 2)})
+        updater.rewrite_chains({"felix-a": rules}, {}, async=True)
+        self.step_actor(updater)
+        lines = updater._execute_iptables.call_args[0][0]
+        self.assertTrue(":felix-a -" in lines)
+
+    def test_reconcile_repairs_drift(self):
+        updater = fiptables.IptablesUpdater("filter", ip_version=4)
+        updater._execute_iptables = Mock()
+        updater._load_existing_chain_state = Mock(return_value={})
+        updater.rewrite_chains(
+            {"felix-a": ["--append felix-a --jump ACCEPT"],
+             "felix-b": ["--append felix-b --jump DROP"]}, {}, async=True)
+        self.step_actor(updater)
+        digests = updater.programmed_digests
+        updater._execute_iptables.reset_mock()
+
+        # felix-a is intact, felix-b has had a rule inserted.
+        updater._load_chain_state = Mock(return_value={
+            "felix-a": (digests["felix-a"], 1),
+            "felix-b": (None, 2),
+        })
+        result = updater.reconcile(async=True)
+        self.step_actor(updater)
+        self.assertEqual(result.get(), 1)
+        lines = updater._execute_iptables.call_args[0][0]
+        self.assertTrue(":felix-b -" in lines)
+        self.assertFalse(":felix-a -" in lines)
+
+    def test_reconcile_reinserts_rules(self):
+        updater = fiptables.IptablesUpdater("filter", ip_version=4)
+        updater._execute_iptables = Mock()
+        updater._load_existing_chain_state = Mock(return_value={})
+        for rule in ["FORWARD --jump felix-FORWARD",
+                     "INPUT --jump felix-INPUT"]:
+            updater.ensure_rule_inserted(rule, async=True)
+            self.step_actor(updater)
+        updater._execute_iptables.reset_mock()
+
+        # Someone has flushed the INPUT chain.
+        updater._load_chain_state = Mock(return_value={})
+        updater._load_chain_graph = Mock(return_value={
+            "FORWARD": set(["felix-FORWARD"]),
+            "INPUT": set(),
+        })
+        result = updater.reconcile(async=True)
+        self.step_actor(updater)
+        self.assertEqual(result.get(), 1)
+        updater._execute_iptables.assert_called_once_with(
+            ["*filter",
+             "--delete INPUT --jump felix-INPUT",
+             "--insert INPUT --jump felix-INPUT",
+             "COMMIT"])
 
-    def test_extract_unreffed_chains(self):
-        for inp, exp in EXTRACT_UNREF_TESTS:
-            output = fiptables.extract_unreffed_chains(inp)
-            self.assertEqual(exp, output, "Expected\n\n%s\n\nTo parse as: %s\n"
-                                          "but got: %s" % (inp, exp, output))
\ No newline at end of file
+    def test_extract_chain_state(self):
+        save_output = "\n".join([
+            "*filter",
+            ":FORWARD ACCEPT [0:0]",
+            ":felix-a - [0:0]",
+            ":felix-empty - [0:0]",
+            "-A felix-a -m comment --comment \"felix-hash:0123abcd\" "
+            "-j ACCEPT",
+            "-A felix-a -j DROP",
+            "COMMIT",
+        ])
+        self.assertEqual(fiptables.extract_chain_state(save_output),
+                         {"FORWARD": (None, 0),
+                          "felix-a": ("0123abcd", 2),
+                          "felix-empty": (None, 0)})
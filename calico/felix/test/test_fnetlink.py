@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fnetlink
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the netlink route programmer.
+"""
+import errno
+import logging
+import socket
+import struct
+
+import mock
+
+from calico.felix import fnetlink
+from calico.felix.fnetlink import (NetlinkBatch, NetlinkRouteProgrammer,
+                                   NetlinkError, RouteTable, NLMSG_HDR_FORMAT,
+                                   NLMSG_HDR_LEN)
+from calico.felix.futils import IPV4, IPV6
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+def ack(seq, err=0):
+    """
+    :returns: an NLMSG_ERROR message acknowledging the given sequence
+        number (with a truncated copy of the request header).
+    """
+    body = struct.pack("=i", -err) + struct.pack(NLMSG_HDR_FORMAT,
+                                                 0, 0, 0, seq, 0)
+    return struct.pack(NLMSG_HDR_FORMAT, NLMSG_HDR_LEN + len(body),
+                       fnetlink.NLMSG_ERROR, 0, seq, 0) + body
+
+
+def split_messages(data):
+    """
+    :returns: list of (msg_type, flags, seq, payload) for each message in
+        the datagram.
+    """
+    msgs = []
+    while data:
+        length, msg_type, flags, seq, _ = struct.unpack(
+            NLMSG_HDR_FORMAT, data[:NLMSG_HDR_LEN])
+        msgs.append((msg_type, flags, seq, data[NLMSG_HDR_LEN:length]))
+        data = data[length:]
+    return msgs
+
+
+def route_payload(ip_type, ip, ifindex, table=fnetlink.RT_TABLE_MAIN):
+    """
+    :returns: the payload of an RTM_NEWROUTE message for a host route.
+    """
+    family, dst = fnetlink._pack_addr(ip_type, ip)
+    return (struct.pack(fnetlink.RTMSG_FORMAT, family, len(dst) * 8, 0, 0,
+                        table, fnetlink.RTPROT_BOOT, fnetlink.RT_SCOPE_LINK,
+                        fnetlink.RTN_UNICAST, 0) +
+            fnetlink._pack_attr(fnetlink.RTA_DST, dst) +
+            fnetlink._pack_attr(fnetlink.RTA_OIF, struct.pack("=i", ifindex)))
+
+
+def link_payload(ifindex, name, flags=fnetlink.IFF_UP):
+    """
+    :returns: the payload of an RTM_NEWLINK message.
+    """
+    return (struct.pack(fnetlink.IFINFOMSG_FORMAT, 0, 0, 0, ifindex, flags,
+                        0) +
+            fnetlink._pack_attr(fnetlink.IFLA_IFNAME, name + "\0"))
+
+
+class TestNetlinkBatch(BaseTestCase):
+    def setUp(self):
+        super(TestNetlinkBatch, self).setUp()
+        self.m_ifindex = mock.patch("calico.felix.fnetlink.interface_index",
+                                    return_value=7).start()
+        self.batch = NetlinkBatch()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        super(TestNetlinkBatch, self).tearDown()
+
+    def test_add_route_v4(self):
+        self.batch.add_route(IPV4, "10.0.0.1", "tap1234")
+        (msg_type, flags, payload, _, is_delete, route), = self.batch.requests
+        self.assertEqual(msg_type, fnetlink.RTM_NEWROUTE)
+        self.assertTrue(flags & fnetlink.NLM_F_REPLACE)
+        self.assertFalse(is_delete)
+        family, dst_len, _, _, table, _, scope, _, _ = struct.unpack(
+            fnetlink.RTMSG_FORMAT, payload[:12])
+        self.assertEqual((family, dst_len, table, scope),
+                         (socket.AF_INET, 32, fnetlink.RT_TABLE_MAIN,
+                          fnetlink.RT_SCOPE_LINK))
+        # RTA_DST then RTA_OIF.
+        self.assertEqual(payload[12:],
+                         struct.pack("=HH", 8, fnetlink.RTA_DST) +
+                         socket.inet_aton("10.0.0.1") +
+                         struct.pack("=HHi", 8, fnetlink.RTA_OIF, 7))
+        self.m_ifindex.assert_called_once_with("tap1234")
+        self.assertEqual(route, (IPV4, "10.0.0.1", 7, "tap1234"))
+
+    def test_add_route_v6(self):
+        self.batch.add_route(IPV6, "2001::1", "tap1234")
+        _, _, payload, _, _, _ = self.batch.requests[0]
+        family, dst_len, _, _, _, _, scope, _, _ = struct.unpack(
+            fnetlink.RTMSG_FORMAT, payload[:12])
+        self.assertEqual((family, dst_len, scope),
+                         (socket.AF_INET6, 128, fnetlink.RT_SCOPE_UNIVERSE))
+
+    def test_neighbours(self):
+        self.batch.add_neighbour(IPV4, "10.0.0.1", "aa:bb:cc:dd:ee:ff",
+                                 "tap1234")
+        self.batch.add_proxy_neighbour(IPV6, "2001::1", "tap1234")
+        self.batch.del_neighbour(IPV4, "10.0.0.1", "tap1234")
+        self.assertEqual(len(self.batch), 3)
+        # The interface index is only looked up once per batch.
+        self.m_ifindex.assert_called_once_with("tap1234")
+
+        _, _, payload, _, _, _ = self.batch.requests[0]
+        _, _, _, ifindex, state, ntf, _ = struct.unpack(
+            fnetlink.NDMSG_FORMAT, payload[:12])
+        self.assertEqual((ifindex, state, ntf),
+                         (7, fnetlink.NUD_PERMANENT, 0))
+        self.assertTrue(payload.endswith(
+            struct.pack("=HH", 10, fnetlink.NDA_LLADDR) +
+            "\xaa\xbb\xcc\xdd\xee\xff\0\0"))
+
+        _, _, payload, _, _, _ = self.batch.requests[1]
+        _, _, _, _, _, ntf, _ = struct.unpack(fnetlink.NDMSG_FORMAT,
+                                              payload[:12])
+        self.assertEqual(ntf, fnetlink.NTF_PROXY)
+
+        msg_type, _, _, _, is_delete, route = self.batch.requests[2]
+        self.assertEqual(msg_type, fnetlink.RTM_DELNEIGH)
+        self.assertTrue(is_delete)
+
+
+class TestNetlinkRouteProgrammer(BaseTestCase):
+    def setUp(self):
+        super(TestNetlinkRouteProgrammer, self).setUp()
+        mock.patch("calico.felix.fnetlink.interface_index",
+                   return_value=7).start()
+        self.m_sock = mock.Mock()
+        mock.patch("socket.socket", return_value=self.m_sock).start()
+        self.programmer = NetlinkRouteProgrammer()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        super(TestNetlinkRouteProgrammer, self).tearDown()
+
+    def set_acks(self, errors):
+        """
+        Arranges for the socket to ACK each request sent with the
+        corresponding errno in errors, split across two datagrams.
+        """
+        def on_send(data, _addr):
+            seqs = [seq for _, _, seq, _ in split_messages(data)]
+            acks = [ack(seq, err) for seq, err in zip(seqs, errors)]
+            self.m_sock.recv.side_effect = ["".join(acks[:1]),
+                                            "".join(acks[1:])]
+        self.m_sock.sendto.side_effect = on_send
+
+    def test_execute_single_send(self):
+        batch = NetlinkBatch()
+        batch.add_neighbour(IPV4, "10.0.0.1", "aa:bb:cc:dd:ee:ff", "tap1")
+        batch.add_route(IPV4, "10.0.0.1", "tap1")
+        batch.del_route(IPV4, "10.0.0.2", "tap1")
+        self.set_acks([0, 0, 0])
+        self.programmer.execute(batch)
+        self.assertEqual(self.m_sock.sendto.call_count, 1)
+        msgs = split_messages(self.m_sock.sendto.call_args[0][0])
+        self.assertEqual([m[0] for m in msgs],
+                         [fnetlink.RTM_NEWNEIGH, fnetlink.RTM_NEWROUTE,
+                          fnetlink.RTM_DELROUTE])
+        for _, flags, _, _ in msgs:
+            self.assertTrue(flags & fnetlink.NLM_F_ACK)
+        # Routes are recorded in the table as soon as they're ACKed.
+        self.assertEqual(
+            self.programmer.route_table.interface_ips(IPV4, "tap1"),
+            set(["10.0.0.1"]))
+
+    def test_execute_empty(self):
+        self.programmer.execute(NetlinkBatch())
+        self.assertFalse(self.m_sock.sendto.called)
+
+    def test_execute_chunks(self):
+        self.programmer.max_batch_size = 2
+        batch = NetlinkBatch()
+        for ii in xrange(3):
+            batch.add_route(IPV4, "10.0.0.%s" % ii, "tap1")
+        self.set_acks([0, 0])
+        self.programmer.execute(batch)
+        self.assertEqual(self.m_sock.sendto.call_count, 2)
+
+    def test_execute_failure(self):
+        batch = NetlinkBatch()
+        batch.add_route(IPV4, "10.0.0.1", "tap1")
+        batch.add_route(IPV4, "10.0.0.2", "tap1")
+        batch.del_route(IPV4, "10.0.0.3", "tap1")
+        self.set_acks([0, errno.ENODEV, errno.ESRCH])
+        with self.assertRaises(NetlinkError) as cm:
+            self.programmer.execute(batch)
+        # Deleting a missing route is not an error.
+        self.assertEqual(cm.exception.failures,
+                         [("add route 10.0.0.2 dev tap1", errno.ENODEV)])
+
+    def test_socket_error_reopens(self):
+        batch = NetlinkBatch()
+        batch.add_route(IPV4, "10.0.0.1", "tap1")
+        self.m_sock.sendto.side_effect = socket.error()
+        self.assertRaises(socket.error, self.programmer.execute, batch)
+        self.assertTrue(self.m_sock.close.called)
+        self.assertEqual(self.programmer._sock, None)
+
+
+class TestRouteTable(BaseTestCase):
+    def setUp(self):
+        super(TestRouteTable, self).setUp()
+        self.table = RouteTable()
+        self.table.load(
+            [(fnetlink.RTM_NEWLINK, link_payload(7, "tap1")),
+             (fnetlink.RTM_NEWLINK, link_payload(8, "tap2"))],
+            [(fnetlink.RTM_NEWROUTE, route_payload(IPV4, "10.0.0.1", 7)),
+             (fnetlink.RTM_NEWROUTE, route_payload(IPV4, "10.0.0.2", 7)),
+             (fnetlink.RTM_NEWROUTE, route_payload(IPV6, "2001::1", 8)),
+             # Not in the main table, so ignored.
+             (fnetlink.RTM_NEWROUTE, route_payload(IPV4, "10.0.0.3", 8,
+                                                   table=255))],
+            [IPV4, IPV6])
+
+    def test_load_and_diff(self):
+        self.assertEqual(self.table.interface_ips(IPV4, "tap1"),
+                         set(["10.0.0.1", "10.0.0.2"]))
+        self.assertEqual(self.table.interface_ips(IPV4, "tap2"), set())
+        self.assertEqual(self.table.interface_ips(IPV6, "tap2"),
+                         set(["2001::1"]))
+        self.assertEqual(self.table.diff(IPV4, "tap1",
+                                         set(["10.0.0.2", "10.0.0.4"])),
+                         (set(["10.0.0.1"]), set(["10.0.0.4"])))
+
+    def test_route_notifications(self):
+        self.table.handle_message(fnetlink.RTM_NEWROUTE,
+                                  route_payload(IPV4, "10.0.0.5", 8))
+        self.table.handle_message(fnetlink.RTM_DELROUTE,
+                                  route_payload(IPV4, "10.0.0.1", 7))
+        self.assertEqual(self.table.interface_ips(IPV4, "tap1"),
+                         set(["10.0.0.2"]))
+        self.assertEqual(self.table.interface_ips(IPV4, "tap2"),
+                         set(["10.0.0.5"]))
+
+    def test_link_down_and_delete(self):
+        self.table.handle_message(fnetlink.RTM_NEWLINK,
+                                  link_payload(7, "tap1", flags=0))
+        self.assertEqual(self.table.interface_ips(IPV4, "tap1"), set())
+        self.table.handle_message(fnetlink.RTM_DELLINK,
+                                  link_payload(8, "tap2"))
+        with mock.patch("calico.felix.fnetlink.interface_index",
+                        side_effect=IOError()):
+            self.assertEqual(self.table.interface_ips(IPV6, "tap2"), set())
+
+    def test_route_programmed_on_recreated_iface(self):
+        self.table.on_route_programmed(IPV4, "10.0.0.9", 9, "tap1")
+        # tap1 now has index 9; the routes on the old index are gone.
+        self.assertEqual(self.table.interface_ips(IPV4, "tap1"),
+                         set(["10.0.0.9"]))
+        self.table.on_route_programmed(IPV4, "10.0.0.9", 9, "tap1",
+                                       present=False)
+        self.assertEqual(self.table.interface_ips(IPV4, "tap1"), set())
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fnftables
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the nftables dataplane.  See check_nftables.py for a functional
+test and benchmark, which need root.
+"""
+import logging
+from subprocess import CalledProcessError
+
+from mock import Mock, patch
+
+from calico.felix import fnftables
+from calico.felix.dispatch import DispatchChains
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.fnftables import (iptables_to_nft_rule,
+                                    NftablesDispatchChains, NftablesUpdater,
+                                    NftSet)
+from calico.felix.futils import IPV4
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+TRANSLATION_TESTS = [
+    (4, "--append felix-p-x-i --protocol tcp --match multiport "
+        "--destination-ports 22,8000:8080 --jump RETURN",
+     "meta l4proto tcp th dport { 22, 8000-8080 } counter return"),
+    (4, "--append felix-p-x-i --protocol udp --source 10.0.0.0/8 "
+        "--match set --match-set felix-v4-tag dst --jump DROP",
+     "meta l4proto udp ip saddr 10.0.0.0/8 ip daddr @felix-v4-tag "
+     "counter drop"),
+    (6, "--append felix-to-abc --jump RETURN --protocol ipv6-icmp "
+        "--icmpv6-type 130",
+     "meta l4proto ipv6-icmp icmpv6 type 130 counter return"),
+    (4, "--append felix-from-abc --src 10.0.0.1 --match mac "
+        "--mac-source AA:BB:CC:DD:EE:FF --goto felix-p-prof-o",
+     "ip saddr 10.0.0.1 ether saddr aa:bb:cc:dd:ee:ff counter "
+     "goto felix-p-prof-o"),
+    (6, "--append felix-FORWARD ! --protocol ipv6-icmp --in-interface tap+ "
+        "--match conntrack --ctstate INVALID --jump DROP",
+     'meta l4proto != ipv6-icmp iifname "tap*" ct state invalid counter '
+     'drop'),
+    (4, "--append felix-FORWARD --jump felix-FROM-ENDPOINT "
+        "--in-interface tap+",
+     'iifname "tap*" counter jump felix-FROM-ENDPOINT'),
+    (4, '--append felix-x --jump DROP -m comment --comment '
+        '"Default DROP rule:"',
+     'counter drop comment "Default DROP rule:"'),
+    (4, "--append felix-PREROUTING --protocol tcp --dport 80 "
+        "--destination 169.254.169.254/32 "
+        "--jump DNAT --to-destination 127.0.0.1:9697",
+     "meta l4proto tcp th dport 80 ip daddr 169.254.169.254/32 counter "
+     "dnat to 127.0.0.1:9697"),
+]
+
+
+class TestTranslation(BaseTestCase):
+    def test_translations(self):
+        for ip_version, fragment, expected in TRANSLATION_TESTS:
+            chain, rule = iptables_to_nft_rule(fragment, ip_version)
+            self.assertEqual(chain, fragment.split()[1])
+            self.assertEqual(rule, expected)
+
+    def test_port_set(self):
+        name = fnftables.nft_set_name(IPV4, "ports:80,443", "bitmap:port")
+        self.assertTrue(name.startswith("felix-v4p-"))
+        _, rule = iptables_to_nft_rule(
+            "--append c --protocol tcp --match set "
+            "--match-set %s src --jump RETURN" % name, 4)
+        self.assertEqual(rule,
+                         "meta l4proto tcp th sport @%s counter "
+                         "return" % name)
+
+        # A tag can't be mistaken for a set of ports.
+        name = fnftables.nft_set_name(IPV4, "v4p-ports")
+        _, rule = iptables_to_nft_rule(
+            "--append c --match set --match-set %s src --jump RETURN" % name,
+            4)
+        self.assertEqual(rule, "ip saddr @%s counter return" % name)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, iptables_to_nft_rule,
+                          "--append c --match limit --limit 5 --jump DROP",
+                          4)
+        self.assertRaises(ValueError, iptables_to_nft_rule,
+                          "--append c ! --jump DROP", 4)
+
+
+class TestNftablesUpdater(BaseTestCase):
+    def setUp(self):
+        super(TestNftablesUpdater, self).setUp()
+        self.updater = NftablesUpdater("filter", ip_version=4)
+        self.m_execute = Mock()
+        self.updater._execute_iptables = self.m_execute
+        self.updater._load_existing_chain_state = Mock(return_value={})
+
+    def test_chains_and_maps_in_one_transaction(self):
+        m_callback = Mock()
+        self.updater.rewrite_chains(
+            {"felix-TO-ENDPOINT": ["oifname vmap @felix-to-endpoint"]},
+            {"felix-TO-ENDPOINT": set(["felix-to-a"])},
+            verdict_map_updates={
+                "felix-to-endpoint": {"tapa": "goto felix-to-a"}},
+            callback=m_callback, async=True)
+        self.step_actor(self.updater)
+        m_callback.assert_called_once_with(None)
+        self.assertEqual(self.m_execute.call_count, 1)
+        lines = self.m_execute.call_args[0][0]
+        spec = "ip felix-filter"
+        self.assertEqual(lines[0], "add table %s" % spec)
+        # Chains first, so that the map elements can refer to them.
+        self.assertEqual(set(lines[1:3]), set([
+            "add chain %s felix-TO-ENDPOINT" % spec,
+            "add chain %s felix-to-a" % spec,
+        ]))
+        self.assertEqual(lines[3:6], [
+            "add map %s felix-to-endpoint { type ifname : verdict; }" % spec,
+            "flush map %s felix-to-endpoint" % spec,
+            'add element %s felix-to-endpoint { "tapa" : goto felix-to-a }' %
+            spec,
+        ])
+        # The missing endpoint chain is stubbed out.
+        self.assertTrue('add rule %s felix-to-a counter drop comment '
+                        '"WARNING Missing chain DROP:"' % spec in lines)
+        self.assertEqual(lines[-1],
+                         "add rule %s felix-TO-ENDPOINT oifname vmap "
+                         "@felix-to-endpoint" % spec)
+
+        # Later updates to the map are incremental.
+        self.updater.rewrite_chains(
+            {}, {},
+            verdict_map_updates={
+                "felix-to-endpoint": {"tapa": None,
+                                      "tapb": "goto felix-to-b"}},
+            async=True)
+        self.step_actor(self.updater)
+        lines = self.m_execute.call_args[0][0]
+        self.assertFalse("flush map %s felix-to-endpoint" % spec in lines)
+        self.assertTrue('delete element %s felix-to-endpoint { "tapa" }' %
+                        spec in lines)
+        self.assertTrue('add element %s felix-to-endpoint '
+                        '{ "tapb" : goto felix-to-b }' % spec in lines)
+        self.assertEqual(self.updater.programmed_map_elements,
+                         {"felix-to-endpoint": {"tapb": "goto felix-to-b"}})
+
+    def test_map_elements_hold_chains(self):
+        self.updater.rewrite_chains(
+            {"felix-to-a": ["--append felix-to-a --jump DROP"]}, {},
+            verdict_map_updates={
+                "felix-to-endpoint": {"tapa": "goto felix-to-a"}},
+            async=True)
+        self.step_actor(self.updater)
+        self.assertEqual(self.updater.requiring_chains["felix-to-a"],
+                         set(["felix-to-endpoint[tapa]"]))
+
+        # While the element refers to the chain, deleting it only stubs it
+        # out.
+        self.updater.delete_chains(["felix-to-a"], async=True)
+        self.step_actor(self.updater)
+        lines = self.m_execute.call_args[0][0]
+        self.assertTrue('add rule ip felix-filter felix-to-a counter drop '
+                        'comment "WARNING Missing chain DROP:"' in lines)
+        self.assertFalse("delete chain ip felix-filter felix-to-a" in lines)
+
+        # Removing the element releases the chain.
+        self.updater.rewrite_chains(
+            {}, {},
+            verdict_map_updates={"felix-to-endpoint": {"tapa": None}},
+            async=True)
+        self.step_actor(self.updater)
+        lines = self.m_execute.call_args[0][0]
+        self.assertTrue("delete chain ip felix-filter felix-to-a" in lines)
+        self.assertEqual(self.updater.requiring_chains, {})
+
+    def test_untranslatable_rule_fails_request(self):
+        m_callback = Mock()
+        self.updater.rewrite_chains(
+            {"felix-x": ["--append felix-x --match limit --limit 5"]}, {},
+            callback=m_callback, async=True)
+        self.step_actor(self.updater)
+        self.assertTrue(isinstance(m_callback.call_args[0][0],
+                                   CalledProcessError))
+        self.assertFalse(self.m_execute.called)
+
+    def test_ensure_rule_inserted(self):
+        self.updater.ensure_rule_inserted("FORWARD --jump felix-FORWARD",
+                                          async=True)
+        self.step_actor(self.updater)
+        lines = self.m_execute.call_args[0][0]
+        self.assertEqual(lines[1:], [
+            "add chain ip felix-filter FORWARD { type filter hook forward "
+            "priority 0; policy accept; }",
+            "flush chain ip felix-filter FORWARD",
+            "add rule ip felix-filter FORWARD counter jump felix-FORWARD",
+        ])
+
+
+class TestNftablesDispatchChains(BaseTestCase):
+    def setUp(self):
+        super(TestNftablesDispatchChains, self).setUp()
+        self.m_config = Mock()
+        self.m_config.IFACE_PREFIX = "tap"
+        self.m_ipt = Mock(spec=NftablesUpdater)
+        self.dispatch = NftablesDispatchChains(self.m_config, 4, self.m_ipt)
+
+    def test_add_and_remove(self):
+        self.dispatch.apply_snapshot({"tapabc": "ep1", "tapb12": "ep2"},
+                                     async=True)
+        self.step_actor(self.dispatch)
+        updates, deps = self.m_ipt.rewrite_chains.call_args[0]
+        self.assertEqual(updates["felix-TO-ENDPOINT"], [
+            "oifname vmap @felix-to-endpoint",
+            "--append felix-TO-ENDPOINT --jump DROP",
+        ])
+        # The updater tracks the chains that the map elements refer to.
+        self.assertEqual(deps, {})
+        map_updates = self.m_ipt.rewrite_chains.call_args[1][
+            "verdict_map_updates"]
+        self.assertEqual(map_updates["felix-to-endpoint"], {
+            "tapabc": "goto felix-to-abc",
+            "tapb12": "goto felix-to-b12",
+        })
+
+        # Only the changes are sent and the top-level chains are left alone.
+        self.dispatch.on_endpoint_removed("tapb12", async=True)
+        self.dispatch.on_endpoint_added("tapabc", "ep1",
+                                        to_chain="felix-p-prof-t",
+                                        async=True)
+        self.dispatch.on_endpoint_added("tapc", "ep3", async=True)
+        self.dispatch.on_endpoint_removed("tapc", async=True)
+        self.step_actor(self.dispatch)
+        updates, deps = self.m_ipt.rewrite_chains.call_args[0]
+        self.assertEqual(updates, {})
+        map_updates = self.m_ipt.rewrite_chains.call_args[1][
+            "verdict_map_updates"]
+        self.assertEqual(map_updates, {
+            "felix-to-endpoint": {"tapb12": None,
+                                  "tapabc": "goto felix-p-prof-t"},
+            "felix-from-endpoint": {"tapb12": None},
+        })
+
+        # No-op changes don't result in an update.
+        self.m_ipt.rewrite_chains.reset_mock()
+        self.dispatch.on_endpoint_removed("tapb12", async=True)
+        self.step_actor(self.dispatch)
+        self.assertFalse(self.m_ipt.rewrite_chains.called)
+
+    def test_rules_traversed(self):
+        """
+        Microbenchmark: rules that a packet traverses to reach its
+        endpoint chain with the bucketed iptables dispatch chains versus
+        the verdict map.
+        """
+        ifaces = dict(("tap%04x" % n, "ep%s" % n) for n in xrange(1000))
+        m_ipt = Mock(spec=IptablesUpdater)
+        ipt_dispatch = DispatchChains(self.m_config, 4, m_ipt)
+        ipt_dispatch.apply_snapshot(ifaces, async=True)
+        self.step_actor(ipt_dispatch)
+        chains = m_ipt.rewrite_chains.call_args[0][0]
+        total = 0
+        for iface in ifaces:
+            total += _traverse(chains, "felix-TO-ENDPOINT", iface)
+        ipt_mean = float(total) / len(ifaces)
+        _log.info("Mean dispatch rules traversed, iptables: %.1f, "
+                  "nftables: 1", ipt_mean)
+        # With 1000 interfaces in 16 buckets, iptables needs tens of rules
+        # per packet; the verdict map needs one rule and one lookup.
+        self.assertTrue(ipt_mean > 30)
+
+
+def _traverse(chains, chain, iface):
+    """
+    :returns: the number of rules that a packet to the given interface
+        traverses in the dispatch chains before it reaches an endpoint
+        chain.
+    """
+    count = 0
+    for rule in chains[chain]:
+        count += 1
+        words = rule.split()
+        if "--out-interface" not in words:
+            continue
+        match = words[words.index("--out-interface") + 1]
+        if match == iface or (match.endswith("+") and
+                              iface.startswith(match[:-1])):
+            target = words[words.index("--goto") + 1]
+            if target in chains:
+                return count + _traverse(chains, target, iface)
+            return count
+    return count
+
+
+class TestNftSet(BaseTestCase):
+    def setUp(self):
+        super(TestNftSet, self).setUp()
+        self.nft_set = NftSet("ports:80,8080", IPV4, set_type="bitmap:port")
+        self.nft_set._manager = Mock()
+        self.nft_set._id = "ports:80,8080"
+
+    @patch("calico.felix.fnftables._run_nft", autospec=True)
+    def test_incremental_updates(self, m_run_nft):
+        # The tag has characters that nft doesn't allow in a name.
+        self.assertTrue(fnftables.NFT_NAME_RE.match(self.nft_set.name))
+        name = "ip felix-filter %s" % self.nft_set.name
+        self.nft_set.replace_members(set(["80", "8080-8090"]), async=True)
+        self.step_actor(self.nft_set)
+        self.assertEqual(m_run_nft.call_args[0][0], [
+            "add table ip felix-filter",
+            "add set %s { type inet_service; flags interval; "
+            "auto-merge; }" % name,
+            "flush set %s" % name,
+            "add element %s { 80, 8080-8090 }" % name,
+        ])
+        m_manager = self.nft_set._manager
+        m_manager.on_object_startup_complete.assert_called_once_with(
+            "ports:80,8080", self.nft_set, async=True)
+
+        self.nft_set.replace_members(set(["80", "443"]), async=True)
+        self.step_actor(self.nft_set)
+        self.assertEqual(m_run_nft.call_args[0][0], [
+            "delete element %s { 8080-8090 }" % name,
+            "add element %s { 443 }" % name,
+        ])
+
+
+class TestExtract(BaseTestCase):
+    def test_chain_graph_and_counters(self):
+        raw = """table ip felix-filter {
+	map felix-to-endpoint {
+		type ifname : verdict
+		elements = { "tapa" : goto felix-to-a }
+	}
+
+	set felix-v4-tag {
+		type ipv4_addr
+	}
+
+	chain FORWARD {
+		type filter hook forward priority filter; policy accept;
+		counter packets 10 bytes 800 jump felix-FORWARD
+	}
+
+	chain felix-FORWARD {
+		oifname vmap @felix-to-endpoint
+	}
+
+	chain felix-to-a {
+		counter packets 3 bytes 180 return
+		counter packets 0 bytes 0 drop comment "Default DROP rule:"
+	}
+
+	chain felix-orphan {
+		counter packets 0 bytes 0 drop
+	}
+}
+"""
+        self.assertEqual(fnftables.extract_nft_chain_graph(raw), {
+            "@felix-to-endpoint": set(["felix-to-a"]),
+            "FORWARD": set(["felix-FORWARD"]),
+            "felix-FORWARD": set(),
+            "felix-to-a": set(),
+            "felix-orphan": set(),
+        })
+        self.assertEqual(fnftables.extract_nft_rule_counters(raw,
+                                                             ("felix-to-",)),
+                         {"felix-to-a": [3, 0]})
+        self.assertEqual(fnftables.extract_nft_set_names(raw),
+                         ["felix-v4-tag"])
+        self.assertEqual(fnftables.extract_nft_chain_rule_counts(raw),
+                         {"FORWARD": 1, "felix-FORWARD": 1, "felix-to-a": 2,
+                          "felix-orphan": 1})
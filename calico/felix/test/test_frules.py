@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_frules
+~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of iptables rule generation.
+"""
+import logging
+import re
+
+import mock
+
+from calico.felix import frules, futils
+from calico.felix.endpoint import _get_endpoint_rules
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+class TestRuleCache(BaseTestCase):
+    def setUp(self):
+        super(TestRuleCache, self).setUp()
+        self._cache_patch = mock.patch("calico.felix.frules._rule_cache",
+                                       futils.LRUCache(10))
+        self._cache_patch.start()
+
+    def tearDown(self):
+        self._cache_patch.stop()
+        super(TestRuleCache, self).tearDown()
+
+    def test_shared_between_chains(self):
+        rule = {"protocol": "tcp", "dst_ports": range(1, 20),
+                "src_tag": "tag1"}
+        frags = frules.rule_to_iptables_fragments(
+            "chain-a", rule, 4, {"tag1": "felix-v4-tag1"})
+        self.assertEqual(frags, [
+            "--append chain-a --protocol tcp --match set --match-set "
+            "felix-v4-tag1 src --match multiport --destination-ports "
+            "1,2,3,4,5,6,7,8,9,10,11,12,13,14,15 --jump ACCEPT",
+            "--append chain-a --protocol tcp --match set --match-set "
+            "felix-v4-tag1 src --match multiport --destination-ports "
+            "16,17,18,19 --jump ACCEPT",
+        ])
+        # Same rule in another chain (with key order shuffled) hits the
+        # cache and only the chain name differs.
+        frags_b = frules.rule_to_iptables_fragments(
+            "chain-b", dict(reversed(rule.items())), 4,
+            {"tag1": "felix-v4-tag1", "tag2": "felix-v4-tag2"})
+        self.assertEqual(frags_b,
+                         [f.replace("chain-a", "chain-b") for f in frags])
+        stats = frules.rule_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_key_covers_rendering_inputs(self):
+        rule = {"action": "deny", "src_tag": "tag1"}
+        tags = {"tag1": "felix-v4-tag1"}
+        frules.rule_to_iptables_fragments("c", rule, 4, tags)
+        frules.rule_to_iptables_fragments("c", rule, 6, tags)
+        frules.rule_to_iptables_fragments("c", rule, 4, tags,
+                                          on_deny="RETURN")
+        frags = frules.rule_to_iptables_fragments(
+            "c", rule, 4, {"tag1": "felix-v4-other"})
+        self.assertEqual(frags, ["--append c --match set --match-set "
+                                 "felix-v4-other src --jump DROP"])
+        self.assertEqual(frules.rule_cache_stats()["misses"], 4)
+
+
+class TestOptimiseRules(BaseTestCase):
+    def test_drops_shadowed_rules(self):
+        rules = [
+            {"protocol": "tcp", "src_net": "10.0.0.0/8"},
+            {"protocol": "tcp", "src_net": "10.0.0.0/8"},
+            {"protocol": "tcp", "src_net": "10.1.0.0/16", "dst_ports": [80],
+             "action": "deny"},
+            {"protocol": "tcp", "dst_ports": ["1:100"]},
+            {"protocol": "tcp", "dst_ports": [22, "50:60"]},
+            {"protocol": "udp", "dst_ports": [22]},
+            {"protocol": "tcp", "dst_ports": [22], "ip_version": 6},
+        ]
+        self.assertEqual(frules.optimise_rules(rules, 4), [
+            {"protocol": "tcp", "src_net": "10.0.0.0/8", "action": "allow"},
+            {"protocol": "tcp", "dst_ports": ["1:100"], "action": "allow"},
+            {"protocol": "udp", "dst_ports": [22], "action": "allow"},
+        ])
+
+    def test_merges_ports(self):
+        rules = [
+            {"protocol": "tcp", "dst_ports": [80]},
+            {"protocol": "tcp", "dst_ports": [443]},
+            {"protocol": "tcp", "dst_ports": [8080], "action": "deny"},
+            {"protocol": "tcp", "dst_ports": [22]},
+        ]
+        self.assertEqual(frules.optimise_rules(rules, 4), [
+            {"protocol": "tcp", "dst_ports": [80, 443], "action": "allow"},
+            {"protocol": "tcp", "dst_ports": [8080], "action": "deny"},
+            {"protocol": "tcp", "dst_ports": [22], "action": "allow"},
+        ])
+
+    def test_collapses_nets(self):
+        nets = ["10.0.%s.0/24" % n for n in range(frules.NET_SET_MIN_SIZE)]
+        rules = [{"protocol": "tcp", "src_net": n, "dst_ports": [p]}
+                 for p in (80, 443) for n in nets]
+        rules.append({"protocol": "tcp", "src_net": "fd00::/64"})
+        optimised = frules.optimise_rules(rules, 4)
+        self.assertEqual(optimised, [
+            {"protocol": "tcp", "src_net_set": tuple(sorted(nets)),
+             "dst_ports": [80, 443], "action": "allow"},
+            # IPv6 net ignored, as it would be by the renderer.
+            {"protocol": "tcp", "action": "allow"},
+        ])
+        ipset_key = frules.net_set_ipset_key(sorted(nets))
+        frags = frules.rules_to_chain_rewrite_lines(
+            "c", optimised, 4, {ipset_key: "felix-v4-nets"})
+        self.assertEqual(
+            frags[0],
+            "--append c --protocol tcp --match set --match-set "
+            "felix-v4-nets src --match multiport --destination-ports "
+            "80,443 --jump ACCEPT")
+
+    def test_short_run_not_collapsed(self):
+        rules = [{"src_net": "10.0.%s.0/24" % n}
+                 for n in range(frules.NET_SET_MIN_SIZE - 1)]
+        self.assertEqual(len(frules.optimise_rules(rules, 4)),
+                         frules.NET_SET_MIN_SIZE - 1)
+
+    def test_bad_rules_unaltered(self):
+        rules = [{"protocol": "tcp", "dst_ports": ["foo"]}]
+        self.assertEqual(frules.optimise_rules(rules, 4), rules)
+
+    def test_long_port_lists_use_port_sets(self):
+        rules = [{"protocol": "tcp",
+                  "src_ports": range(1000, 1100),
+                  "dst_ports": range(2000, 2100) + ["3000:3010"]}]
+        optimised = frules.optimise_rules(rules, 4)
+        self.assertEqual(len(optimised), 1)
+        rule = optimised[0]
+        self.assertFalse("src_ports" in rule or "dst_ports" in rule)
+        self.assertEqual(len(rule["src_port_set"]), 100)
+        self.assertEqual(rule["dst_port_set"][-1], "3000:3010")
+        tags = {
+            frules.port_set_ipset_key(rule["src_port_set"]): "felix-v4-sp",
+            frules.port_set_ipset_key(rule["dst_port_set"]): "felix-v4-dp",
+        }
+        # One rule, rather than the cross product of multiport chunks.
+        self.assertEqual(
+            frules.rules_to_chain_rewrite_lines("c", optimised, 4, tags)[0],
+            "--append c --protocol tcp "
+            "--match set --match-set felix-v4-sp src "
+            "--match set --match-set felix-v4-dp dst --jump ACCEPT")
+
+
+class TestReorderRules(BaseTestCase):
+    def test_reorder_within_runs(self):
+        a1, a2, d1, a3, a4 = rules = [
+            {"protocol": "tcp", "action": "allow"},
+            {"protocol": "udp", "action": "allow"},
+            {"src_net": "10.0.0.1/32", "action": "deny"},
+            {"dst_ports": [80], "protocol": "tcp", "action": "allow"},
+            {"dst_ports": [22], "protocol": "tcp", "action": "allow"},
+        ]
+        weights = dict((frules.rule_key(r), w) for (r, w) in
+                       zip(rules, [1, 10, 0, 5, 50]))
+        reordered = frules.reorder_rules(rules, weights)
+        # The deny rule stays put; rules only move within their run.
+        self.assertEqual(reordered, [a2, a1, d1, a4, a3])
+        self.assertTrue(frules.rules_traversed(reordered, weights) <
+                        frules.rules_traversed(rules, weights))
+
+    def test_no_weights_stable(self):
+        rules = [{"protocol": "tcp"}, {"protocol": "udp"}]
+        self.assertEqual(frules.reorder_rules(rules, {}), rules)
+        self.assertEqual(frules.rules_traversed(rules, {}), 0.0)
+
+
+def _rule_matches(rule, packet):
+    """
+    Crude matcher for the handful of iptables matches that the global and
+    endpoint chains use.  Anything it doesn't understand matches.
+    """
+    for opt, key in [("--in-interface", "in"), ("--out-interface", "out")]:
+        m = re.search(opt + r" (\S+)", rule)
+        if m:
+            iface = m.group(1)
+            if iface.endswith("+"):
+                if not packet[key].startswith(iface[:-1]):
+                    return False
+            elif packet[key] != iface:
+                return False
+    m = re.search(r"(! )?--protocol (\S+)", rule)
+    if m and (m.group(2) == packet["protocol"]) == bool(m.group(1)):
+        return False
+    m = re.search(r"--ctstate (\S+)", rule)
+    if m and packet["state"] not in m.group(1).split(","):
+        return False
+    m = re.search(r"--dport (\S+)", rule)
+    if m and m.group(1) != str(packet["dport"]):
+        return False
+    return True
+
+
+def _traverse(chains, chain, packet):
+    """
+    :returns: tuple of (number of rules evaluated, verdict or None if the
+        packet returned from the chain).
+    """
+    count = 0
+    for rule in chains[chain]:
+        if rule.startswith("--flush"):
+            continue
+        count += 1
+        if not _rule_matches(rule, packet):
+            continue
+        m = re.search(r"--(jump|goto) (\S+)", rule)
+        if not m:
+            continue
+        action, target = m.groups()
+        if target in ("ACCEPT", "DROP"):
+            return count, target
+        if target == "RETURN":
+            return count, None
+        sub_count, verdict = _traverse(chains, target, packet)
+        count += sub_count
+        if verdict or action == "goto":
+            return count, verdict
+    return count, None
+
+
+class TestConntrackFastPath(BaseTestCase):
+    """
+    Microbenchmark of the number of rules that an established packet
+    traverses, with and without the conntrack fast path.
+    """
+    NUM_ENDPOINTS = 50
+
+    def rules_traversed(self, fast_path):
+        m_config = mock.Mock()
+        m_config.IFACE_PREFIX = "tap"
+        m_config.METADATA_IP = None
+        m_config.CONNTRACK_FAST_PATH = fast_path
+        m_v4_upd = mock.Mock(spec=IptablesUpdater)
+        m_v6_upd = mock.Mock(spec=IptablesUpdater)
+        m_nat_upd = mock.Mock(spec=IptablesUpdater)
+        frules.install_global_rules(m_config, m_v4_upd, m_v6_upd, m_nat_upd)
+        chains = dict(m_v4_upd.rewrite_chains.call_args[0][0])
+
+        # Linear dispatch chain, with our endpoint last.
+        chains[frules.CHAIN_FROM_ENDPOINT] = [
+            "--append %s --in-interface tap%s --goto felix-from-%s" %
+            (frules.CHAIN_FROM_ENDPOINT, n, n)
+            for n in range(self.NUM_ENDPOINTS)
+        ]
+        suffix = str(self.NUM_ENDPOINTS - 1)
+        updates, _ = _get_endpoint_rules(suffix, "tap" + suffix, 4,
+                                         ["10.0.0.1"], "aa:bb:cc:dd:ee:ff",
+                                         "prof1",
+                                         conntrack_fast_path=fast_path)
+        chains.update(updates)
+        chains["felix-p-prof1-o"] = ["--append felix-p-prof1-o --jump DROP"]
+
+        packet = {"in": "tap" + suffix, "out": "eth0", "protocol": "tcp",
+                  "state": "ESTABLISHED", "dport": 80}
+        count, verdict = _traverse(chains, frules.CHAIN_FORWARD, packet)
+        self.assertEqual(verdict, "ACCEPT")
+        return count
+
+    def test_fast_path_traverses_fewer_rules(self):
+        slow = self.rules_traversed(False)
+        fast = self.rules_traversed(True)
+        _log.info("Rules traversed per established packet: %s without "
+                  "fast path, %s with", slow, fast)
+        self.assertTrue(slow > self.NUM_ENDPOINTS)
+        self.assertEqual(fast, 2)
+
+    def test_endpoint_chains_skip_conntrack(self):
+        updates, _ = _get_endpoint_rules("1", "tap1", 4, ["10.0.0.1"],
+                                         "aa:bb:cc:dd:ee:ff", "prof1",
+                                         conntrack_fast_path=True)
+        for chain in updates.values():
+            self.assertFalse(any("conntrack" in r for r in chain))
+        updates, _ = _get_endpoint_rules("1", "tap1", 6, ["fd00::1"],
+                                         "aa:bb:cc:dd:ee:ff", "prof1",
+                                         conntrack_fast_path=True)
+        for chain in updates.values():
+            self.assertEqual(
+                [r for r in chain if "conntrack" in r],
+                [r for r in chain if "ipv6-icmp --match conntrack" in r])
@@ -126,3 +126,29 @@ class TestFutils(unittest.TestCase):
                                           "should have given output "
                                           "%r but got %r" %
                                           (inp, length, exp, output))
+
+    def test_lru_cache(self):
+        cache = futils.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # "b" is now least recently used so it gets evicted.
+        cache.put("c", 3)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), 3)
+        # Overwriting doesn't evict.
+        cache.put("a", 4)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 4)
+        self.assertEqual(cache.stats(), {"size": 2, "max_size": 2,
+                                         "hits": 3, "misses": 1,
+                                         "evictions": 1})
+
+    def test_backoff(self):
+        backoff = futils.Backoff(1, 5, jitter=0.5)
+        delays = [backoff.next_delay() for _ in xrange(5)]
+        for delay, nominal in zip(delays, [1, 2, 4, 5, 5]):
+            self.assertTrue(nominal * 0.5 <= delay <= nominal * 1.5)
+        backoff.reset()
+        self.assertTrue(backoff.next_delay() <= 1.5)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_profilerules
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the ProfileRules actor.
+"""
+import logging
+from subprocess import CalledProcessError
+
+from mock import Mock
+
+from calico.felix.actor import _active_work_trackers
+from calico.felix.config import Config
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.ipsets import IpsetManager
+from calico.felix.profilerules import ProfileRules, RulesManager
+from calico.felix.test.base import BaseTestCase
+
+_log = logging.getLogger(__name__)
+
+
+def config(share_chains=False, share_to_chains=False):
+    m_config = Mock(spec=Config)
+    m_config.SHARE_PROFILE_CHAINS = share_chains
+    m_config.SHARE_TO_CHAINS = share_to_chains
+    m_config.RULE_REORDER_INT_SEC = 0
+    m_config.CONNTRACK_FAST_PATH = False
+    return m_config
+
+
+def profile(rule_count):
+    # Alternate the actions so that the optimiser can't merge the rules.
+    return {
+        "id": "prof1",
+        "inbound_rules": [{"protocol": "tcp", "dst_ports": [n],
+                           "action": "allow" if n % 2 else "deny"}
+                          for n in range(1, rule_count + 1)],
+        "outbound_rules": [],
+    }
+
+
+class TestProfileRules(BaseTestCase):
+    def setUp(self):
+        super(TestProfileRules, self).setUp()
+        self.m_ipt = Mock(spec=IptablesUpdater)
+        self.m_ipset_mgr = Mock(spec=IpsetManager)
+        self.rules = ProfileRules(config(), "prof1", 4, self.m_ipt,
+                                  self.m_ipset_mgr)
+        self.m_mgr = Mock(spec=RulesManager)
+        self.rules._manager = self.m_mgr
+        self.rules._id = "prof1"
+
+    def test_one_rewrite_per_batch(self):
+        for n in xrange(1, 6):
+            self.rules.on_profile_update(profile(n), async=True)
+        self.step_actor(self.rules)
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 1)
+        updates, deps = self.m_ipt.rewrite_chains.call_args[0]
+        # The last update in the batch wins (plus the default DROP).
+        self.assertEqual(len(updates["felix-p-prof1-i"]), 6)
+        self.assertEqual(self.m_ipt.rewrite_chains.call_args[1]["async"],
+                         True)
+        # Not ready until the IptablesUpdater calls us back.
+        self.assertFalse(self.m_mgr.on_object_startup_complete.called)
+
+        callback = self.m_ipt.rewrite_chains.call_args[1]["callback"]
+        callback(None)
+        self.step_actor(self.rules)
+        self.m_mgr.on_object_startup_complete.assert_called_once_with(
+            "prof1", self.rules, async=True)
+
+    def test_failure_not_ready(self):
+        self.rules.on_profile_update(profile(1), async=True)
+        self.step_actor(self.rules)
+        callback = self.m_ipt.rewrite_chains.call_args[1]["callback"]
+        callback(CalledProcessError(1, "iptables-restore"))
+        self.step_actor(self.rules)
+        self.assertFalse(self.m_mgr.on_object_startup_complete.called)
+        # No immediate retry; we wait for the next update.
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 1)
+
+    def test_net_runs_use_ipset(self):
+        nets = ["10.0.0.%s/32" % n for n in range(1, 9)]
+        prof = {
+            "id": "prof1",
+            "inbound_rules": [{"src_net": n} for n in nets],
+            "outbound_rules": [],
+        }
+        self.rules.on_profile_update(prof, async=True)
+        self.step_actor(self.rules)
+        self.assertEqual(
+            self.m_ipset_mgr.get_and_incref.call_args[0][0],
+            ("nets", tuple(sorted(nets))))
+
+    def test_reorder_hot_rules(self):
+        prof = {
+            "id": "prof1",
+            "inbound_rules": [{"protocol": "tcp", "dst_ports": [22]},
+                              {"protocol": "udp", "dst_ports": [53]}],
+            "outbound_rules": [],
+        }
+        self.rules.on_profile_update(prof, async=True)
+        self.step_actor(self.rules)
+        updates, _ = self.m_ipt.rewrite_chains.call_args[0]
+        self.assertTrue("tcp" in updates["felix-p-prof1-i"][0])
+
+        # Counters that don't justify a reorder.
+        self.rules.on_rule_counters({"inbound": [100, 101, 0]}, async=True)
+        self.step_actor(self.rules)
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 1)
+
+        # UDP rule is much hotter, it should be moved first.
+        self.rules.on_rule_counters({"inbound": [1, 1000, 0]}, async=True)
+        self.step_actor(self.rules)
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 2)
+        updates, _ = self.m_ipt.rewrite_chains.call_args[0]
+        self.assertTrue("udp" in updates["felix-p-prof1-i"][0])
+
+    def test_unreferenced_skips_pending_update(self):
+        self.rules.on_profile_update(profile(1), async=True)
+        self.rules.on_unreferenced(async=True)
+        self.step_actor(self.rules)
+        self.assertFalse(self.m_ipt.rewrite_chains.called)
+        self.m_ipt.delete_chains.assert_called_once_with(
+            ["felix-p-prof1-i", "felix-p-prof1-o"], async=False)
+        self.m_mgr.on_object_cleanup_complete.assert_called_once_with(
+            "prof1", self.rules, async=True)
+
+    def test_shared_to_chain(self):
+        self.rules = ProfileRules(config(share_to_chains=True), "prof1", 4,
+                                  self.m_ipt, self.m_ipset_mgr)
+        self.rules._manager = self.m_mgr
+        self.rules.on_profile_update(profile(1), async=True)
+        self.step_actor(self.rules)
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 1)
+        updates, deps = self.m_ipt.rewrite_chains.call_args[0]
+        self.assertEqual(updates["felix-p-prof1-t"][-1],
+                         "--append felix-p-prof1-t --goto felix-p-prof1-i")
+        self.assertEqual(deps["felix-p-prof1-t"], set(["felix-p-prof1-i"]))
+
+        self.rules.on_unreferenced(async=True)
+        self.step_actor(self.rules)
+        self.m_ipt.delete_chains.assert_called_once_with(
+            ["felix-p-prof1-i", "felix-p-prof1-o", "felix-p-prof1-t"],
+            async=False)
+
+
+class TestSharedProfileRules(BaseTestCase):
+    def setUp(self):
+        super(TestSharedProfileRules, self).setUp()
+        self.m_ipt = Mock(spec=IptablesUpdater)
+        self.m_ipset_mgr = Mock(spec=IpsetManager)
+        self.rules_mgr = RulesManager(config(share_chains=True), 4,
+                                      self.m_ipt, self.m_ipset_mgr)
+
+    def render(self, profile_id, rule_count):
+        rules = ProfileRules(self.rules_mgr.config, profile_id, 4,
+                             self.m_ipt, self.m_ipset_mgr,
+                             rules_manager=self.rules_mgr)
+        prof = profile(rule_count)
+        prof["id"] = profile_id
+        rules.on_profile_update(prof, async=True)
+        self.step_actor(rules)
+        return rules
+
+    def test_identical_profiles_share_chains(self):
+        self.render("prof1", 2)
+        self.render("prof2", 2)
+        self.step_actor(self.rules_mgr)
+        self.assertEqual(self.m_ipt.rewrite_chains.call_count, 1)
+        updates, deps = self.m_ipt.rewrite_chains.call_args[0]
+        # One inbound and one outbound chain between the two profiles and
+        # no per-profile chains.
+        self.assertEqual(len(updates), 2)
+        self.assertTrue(all(c.startswith("felix-ps-") for c in updates))
+        chains = self.rules_mgr.shared_chains_by_profile
+        self.assertEqual(chains["prof1"], chains["prof2"])
+        self.assertEqual(set(chains["prof1"].values()), set(updates))
+
+        # A profile with different rules gets its own chain.
+        self.render("prof3", 3)
+        self.step_actor(self.rules_mgr)
+        updates, deps = self.m_ipt.rewrite_chains.call_args[0]
+        self.assertNotEqual(chains["prof3"]["inbound"],
+                            chains["prof1"]["inbound"])
+        self.assertTrue(chains["prof3"]["inbound"] in updates)
+
+    def test_shared_chain_deleted_with_last_ref(self):
+        rules1 = self.render("prof1", 2)
+        rules2 = self.render("prof2", 2)
+        self.step_actor(self.rules_mgr)
+        updates, _ = self.m_ipt.rewrite_chains.call_args[0]
+        shared = set(updates)
+        self.m_ipt.rewrite_chains.call_args[1]["callback"](None)
+        self.step_actor(self.rules_mgr)
+        self.assertEqual(self.rules_mgr.programmed_shared_chains, shared)
+
+        rules1._manager = Mock(spec=RulesManager)
+        rules1.on_unreferenced(async=True)
+        self.step_actor(rules1)
+        self.step_actor(self.rules_mgr)
+        self.assertFalse(self.m_ipt.delete_chains.called)
+
+        rules2._manager = Mock(spec=RulesManager)
+        rules2.on_unreferenced(async=True)
+        self.step_actor(rules2)
+        self.step_actor(self.rules_mgr)
+        self.m_ipt.delete_chains.assert_called_once_with(shared, async=True)
+        self.assertEqual(self.rules_mgr.programmed_shared_chains, set())
+
+    def test_old_chains_deleted_once_watchers_move(self):
+        # Stands in for a LocalEndpoint, whose reprogramming is tracked
+        # until we release the trackers.
+        trackers = []
+
+        def on_chains(profile_id, chains):
+            for tracker in _active_work_trackers():
+                tracker.incref()
+                trackers.append(tracker)
+        m_watcher = Mock(side_effect=on_chains)
+        self.rules_mgr.watch_profile_chains("prof1", m_watcher, async=True)
+        self.step_actor(self.rules_mgr)
+        self.assertFalse(m_watcher.called)
+
+        rules = self.render("prof1", 2)
+        self.step_actor(self.rules_mgr)
+        old_chains = dict(self.rules_mgr.shared_chains_by_profile["prof1"])
+        m_watcher.assert_called_once_with("prof1", old_chains)
+
+        # Late watchers are told straight away.
+        m_late_watcher = Mock()
+        self.rules_mgr.watch_profile_chains("prof1", m_late_watcher,
+                                            async=True)
+        self.step_actor(self.rules_mgr)
+        m_late_watcher.assert_called_once_with("prof1", old_chains)
+        self.rules_mgr.unwatch_profile_chains("prof1", m_late_watcher,
+                                              async=True)
+
+        prof = profile(3)
+        rules.on_profile_update(prof, async=True)
+        self.step_actor(rules)
+        self.step_actor(self.rules_mgr)
+        new_chains = self.rules_mgr.shared_chains_by_profile["prof1"]
+        m_watcher.assert_called_with("prof1", new_chains)
+        self.assertEqual(m_late_watcher.call_count, 1)
+        self.assertFalse(self.m_ipt.delete_chains.called)
+
+        for tracker in trackers:
+            tracker.decref()
+        self.step_actor(self.rules_mgr)
+        self.m_ipt.delete_chains.assert_called_once_with(
+            set([old_chains["inbound"]]), async=True)